@@ -0,0 +1,104 @@
+"""
+Shared setup for benchmarks, run outside of the dev appserver
+
+Point APPENGINE_SDK at an unpacked App Engine SDK, then run a benchmark
+script directly, eg. python bench/precondition_bench.py
+"""
+import sys, os, os.path
+base_dir = os.path.dirname( os.path.dirname(os.path.abspath(__file__)) )
+sdk_dir = os.environ.get('APPENGINE_SDK', '/usr/local/google_appengine')
+sys.path[0:0] = [ os.path.join(base_dir, d) for d in (
+    'lib', 'extlib', 'controllers'
+)] + [ sdk_dir ] + [ os.path.join(sdk_dir, 'lib', d) for d in (
+    'django', 'webob', 'yaml/lib'
+)]
+
+os.environ.setdefault('APPLICATION_ID', 'fxsync-bench')
+os.environ.setdefault('AUTH_DOMAIN', 'gmail.com')
+os.environ.setdefault('SERVER_SOFTWARE', 'Development/bench')
+os.environ.setdefault('USER_EMAIL', '')
+
+import time, base64, threading
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_file_stub
+from google.appengine.api import user_service_stub
+from google.appengine.api.memcache import memcache_stub
+
+def setup_stubs(rpc_latency=0):
+    """Install fresh in-memory datastore, memcache and user service stubs,
+    with a hook counting datastore RPCs by call name. A non-zero latency in
+    seconds is added to every RPC, to simulate the production services."""
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3',
+        datastore_file_stub.DatastoreFileStub(
+            os.environ['APPLICATION_ID'], None, None
+        ))
+    apiproxy_stub_map.apiproxy.RegisterStub('memcache',
+        memcache_stub.MemcacheServiceStub())
+    apiproxy_stub_map.apiproxy.RegisterStub('user',
+        user_service_stub.UserServiceStub())
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'bench_rpc_counter', rpc_counter.hook, 'datastore_v3'
+    )
+    if rpc_latency:
+        def latency_hook(service, call, request, response):
+            time.sleep(rpc_latency)
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'bench_rpc_latency', latency_hook
+        )
+
+class RpcCounter(object):
+    """Pre-call hook tallying datastore RPCs by call name"""
+
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def hook(self, service, call, request, response):
+        self.lock.acquire()
+        try:
+            self.counts[call] = self.counts.get(call, 0) + 1
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.counts = {}
+
+    def total(self):
+        return sum(self.counts.values())
+
+rpc_counter = RpcCounter()
+
+def auth_header(user_name, passwd):
+    """Build an HTTP Basic Auth header from user name and password"""
+    return {
+        'Authorization': 'Basic %s' % base64.b64encode(
+            '%s:%s' % (user_name, passwd)
+        )
+    }
+
+def create_profile(user_name='bench', passwd='bench-pass'):
+    """Create a sync profile to run benchmarks against"""
+    from fxsync.models import Profile
+    profile = Profile(user_name=user_name, user_id=user_name, password=passwd)
+    profile.put()
+    return profile
+
+def measure(fn, runs=100):
+    """Run a function repeatedly, returning its mean latency in ms and the
+    mean count of datastore RPCs per run, by call name"""
+    rpc_counter.reset()
+    start = time.time()
+    for i in xrange(runs):
+        fn()
+    elapsed = time.time() - start
+    rpcs = dict( (k, float(v) / runs) for k,v in rpc_counter.counts.items() )
+    return (elapsed * 1000.0 / runs, rpcs)
+
+def report(name, result):
+    """Print a one-line benchmark result"""
+    (ms, rpcs) = result
+    print '%-40s %8.2fms  %s' % (name, ms, ' '.join(
+        '%s=%.1f' % (k, v) for k, v in sorted(rpcs.items())
+    ))
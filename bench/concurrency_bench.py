@@ -0,0 +1,59 @@
+"""
+Benchmark request throughput of one instance serving concurrent requests
+
+Drives the app from several threads at once, with simulated latency on
+every RPC, since overlapping RPC waits is where threads pay off.
+"""
+from benchutil import *
+
+import sys, random
+import webtest
+from django.utils import simplejson
+import app
+
+DURATION = 5.0
+RPC_LATENCY = 0.005
+THREAD_COUNTS = (1, 2, 4, 8, 16)
+
+def worker(test_app, headers, base_url, deadline, counts):
+    """Issue a mix of reads and writes until the deadline"""
+    n = 0
+    while time.time() < deadline:
+        choice = random.random()
+        if choice < 0.5:
+            test_app.get('/sync/1.0/bench/info/collections', headers=headers)
+        elif choice < 0.8:
+            test_app.get('%s?full=1&newer=%s' % (base_url, time.time() - 60),
+                headers=headers)
+        else:
+            test_app.post(base_url, headers=headers, params=simplejson.dumps([
+                { 'id': 'w-%s' % random.randint(0, 1000),
+                  'payload': simplejson.dumps({ 'n': n }) }
+                for i in range(10)
+            ]))
+        n += 1
+    counts.append(n)
+
+def main():
+    duration = len(sys.argv) > 1 and float(sys.argv[1]) or DURATION
+    setup_stubs(rpc_latency=RPC_LATENCY)
+    profile = create_profile()
+    headers = auth_header(profile.user_name, profile.password)
+    test_app = webtest.TestApp(app.application())
+    base_url = '/sync/1.0/bench/storage/history'
+
+    for num_threads in THREAD_COUNTS:
+        counts = []
+        deadline = time.time() + duration
+        threads = [
+            threading.Thread(target=worker,
+                args=(test_app, headers, base_url, deadline, counts))
+            for i in range(num_threads)
+        ]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        print '%2d threads %8.1f requests/sec' % (
+            num_threads, sum(counts) / duration
+        )
+
+if __name__ == '__main__': main()
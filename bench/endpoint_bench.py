@@ -0,0 +1,268 @@
+"""
+Benchmark every route of the sync and user APIs at collection sizes from
+10 to 100k records, failing on regressions against stored baselines, eg.
+
+    python bench/endpoint_bench.py --sizes 10,1000
+    python bench/endpoint_bench.py --save
+
+Each case is run against a collection of each size in in-memory storage,
+reporting mean and 90th percentile latency, storage calls per request (as
+counted by fxsync.storage.instrument), and the resident memory growth and
+net objects of one more run (as measured by fxsync.memtrack, counting
+objects on every request, which is too slow to leave on while timing). Collection GETs are run in every output
+format with each filter. The retrieval cache is disabled, so that every
+GET reaches storage.
+
+Results are compared with those saved by --save in BASELINES. Any
+increase in storage calls is a failure, while latency and objects may
+grow by up to --tolerance before failing, since they vary from run to
+run and machine to machine. Cases without a baseline are only reported.
+"""
+from benchutil import *
+
+import sys
+import webtest
+from optparse import OptionParser
+from django.utils import simplejson
+from fxsync import storage, models, memtrack
+from fxsync.storage import instrument
+from google.appengine.api import memcache
+from http_bench import percentile
+import sync_api, user_api
+
+SIZES = (10, 100, 1000, 10000, 100000)
+RUNS = 10
+TOLERANCE = 0.5
+
+# Objects allowed over the baseline regardless of tolerance, so that tiny
+# counts don't fail on noise
+OBJECT_SLACK = 100
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'endpoint_baselines.json')
+
+FORMATS = (
+    ('json', 'application/json'),
+    ('newlines', 'application/newlines'),
+    ('whoisi', 'application/whoisi'),
+)
+
+# Collection GET filters, formatted with the ids and times of the
+# collection loaded
+FILTERS = (
+    ('ids', ''),
+    ('full', 'full=1'),
+    ('newer', 'full=1&newer=%(middle)s'),
+    ('older', 'full=1&older=%(middle)s'),
+    ('parentid', 'full=1&parentid=p-3'),
+    ('predecessorid', 'full=1&predecessorid=w-1'),
+    ('index range', 'full=1&index_above=1&index_below=%(half)s'),
+    ('parentid and newer', 'full=1&parentid=p-3&newer=%(middle)s'),
+    ('sort newest', 'full=1&sort=newest'),
+    ('sort oldest', 'full=1&sort=oldest'),
+    ('limit and offset', 'full=1&limit=100&offset=%(half)s'),
+    ('ids list', 'full=1&ids=%(some_ids)s'),
+)
+
+class Case(object):
+    """A request to time, and how to put things back after it"""
+
+    def __init__(self, name, method, path, body=None, headers=None,
+            restore=None, app='sync'):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.headers = headers or {}
+        self.restore = restore
+        self.app = app
+
+def wbo_data(j, n=0):
+    return { 'id': 'w-%s' % j, 'sortindex': j,
+        'parentid': 'p-%s' % (j % 10), 'predecessorid': 'w-%s' % (j - 1),
+        'payload': simplejson.dumps({ 'n': n, 'j': j }) }
+
+def load(app, headers, url, size):
+    """Fill a collection with records, returning the time by which the
+    first half were written"""
+    middle = None
+    for i in range(0, size, 100):
+        if middle is None and i >= size / 2:
+            middle = models.WBO.get_time_now()
+        app.post(url, headers=headers, params=simplejson.dumps([
+            wbo_data(j) for j in range(i, min(i + 100, size)) ]))
+    return middle or models.WBO.get_time_now()
+
+def build_cases(user_name, size, middle, post):
+    """List the cases to run against a collection of the given size"""
+    base = '/sync/1.0/%s' % user_name
+    url = base + '/storage/history'
+    some = [ 'w-%s' % j for j in range(0, size, max(1, size / 10)) ][:10]
+    values = { 'middle': middle, 'half': size / 2,
+        'some_ids': ','.join(some) }
+
+    cases = [
+        Case('info/collections', 'GET', base + '/info/collections'),
+        Case('info/collection_counts', 'GET',
+            base + '/info/collection_counts'),
+        Case('info/quota', 'GET', base + '/info/quota'),
+        Case('item GET', 'GET', url + '/w-1'),
+        Case('item PUT', 'PUT', url + '/w-1',
+            simplejson.dumps(wbo_data(1, 1))),
+        Case('item DELETE', 'DELETE', url + '/w-2',
+            restore=lambda: post([ wbo_data(2) ])),
+        Case('bulk POST 100', 'POST', url, simplejson.dumps([
+            wbo_data(j % size, 1) for j in range(100) ])),
+        Case('bulk DELETE 10', 'DELETE', url + '?ids=' + ','.join(some),
+            restore=lambda: post([ wbo_data(int(x[2:])) for x in some ])),
+        Case('user GET', 'GET', '/sync/user/1.0/%s' % user_name,
+            app='user'),
+        Case('user node', 'GET', '/sync/user/1.0/%s/node/weave' % user_name,
+            app='user'),
+    ]
+    for format_name, accept in FORMATS:
+        for filter_name, query in FILTERS:
+            cases.append(Case('GET %s, %s' % (format_name, filter_name),
+                'GET', '%s?%s' % (url, query % values),
+                headers={ 'Accept': accept }))
+    return cases
+
+def parse_rpcs(summary):
+    """Total the calls in an X-Fxsync-Rpcs header"""
+    calls = 0
+    for tally in (summary or '').split():
+        calls += int(tally.split('=')[1].split('/')[0])
+    return calls
+
+def run_case(apps, headers, case, runs):
+    """Time a case, returning its mean and 90th percentile latency in ms,
+    storage calls per request and memory measures"""
+    app = apps[case.app]
+    headers = dict(headers, **case.headers)
+    headers['X-Fxsync-Debug-Rpcs'] = '1'
+    params = { 'method': case.method, 'headers': headers }
+    if case.body is not None:
+        params['body'] = case.body
+
+    def request():
+        return app.request(case.path, **params)
+
+    latencies, rpcs = [], 0
+    for i in xrange(runs):
+        start = time.time()
+        resp = request()
+        latencies.append((time.time() - start) * 1000.0)
+        rpcs += parse_rpcs(resp.headers.get(instrument.STATS_HEADER))
+        if case.restore: case.restore()
+
+    # One more run for memory, tracking every route and counting objects
+    memtrack.stats = memtrack.MemoryStats()
+    prev = (memtrack.ROUTES, memtrack.OBJECT_SAMPLE)
+    memtrack.ROUTES, memtrack.OBJECT_SAMPLE = set([ '*' ]), 1
+    try:
+        request()
+    finally:
+        memtrack.ROUTES, memtrack.OBJECT_SAMPLE = prev
+    if case.restore: case.restore()
+    worst = memtrack.stats.as_dict()['worst'][0]
+
+    return {
+        'ms': sum(latencies) / runs,
+        'p90': percentile(latencies, 0.9),
+        'rpcs': float(rpcs) / runs,
+        'growth': worst['growth'],
+        'objects': worst['objects'],
+    }
+
+def run_size(size, runs, only=None):
+    """Run every case against a fresh collection of the given size"""
+    storage.set_backend(storage.create_backend('memory'))
+    memcache.flush_all()
+    models.known_collections.clear()
+
+    profile = create_profile()
+    headers = auth_header(profile.user_name, profile.password)
+    apps = {
+        'sync': webtest.TestApp(sync_api.application()),
+        'user': webtest.TestApp(user_api.application()),
+    }
+    url = '/sync/1.0/%s/storage/history' % profile.user_name
+    middle = load(apps['sync'], headers, url, size)
+
+    def post(data):
+        apps['sync'].post(url, headers=headers, params=simplejson.dumps(data))
+
+    results = {}
+    for case in build_cases(profile.user_name, size, middle, post):
+        if only and only not in case.name:
+            continue
+        result = run_case(apps, headers, case, runs)
+        key = '%s records, %s' % (size, case.name)
+        print '%-45s %8.2fms %8.2fms p90 %6.1f calls %7dKB %7d objects' % (
+            key, result['ms'], result['p90'], result['rpcs'],
+            result['growth'] / 1024, result['objects'])
+        results[key] = result
+    return results
+
+def compare(results, baselines, tolerance):
+    """List the ways results regressed past their baselines"""
+    failures = []
+    for key, result in sorted(results.items()):
+        baseline = baselines.get(key)
+        if baseline is None:
+            continue
+        if result['rpcs'] > baseline['rpcs']:
+            failures.append('%s: %.1f storage calls, baseline %.1f' % (
+                key, result['rpcs'], baseline['rpcs']))
+        if result['ms'] > baseline['ms'] * (1 + tolerance):
+            failures.append('%s: %.2fms, baseline %.2fms' % (
+                key, result['ms'], baseline['ms']))
+        if result['objects'] > (baseline['objects'] * (1 + tolerance) +
+                OBJECT_SLACK):
+            failures.append('%s: %d objects, baseline %d' % (
+                key, result['objects'], baseline['objects']))
+    return failures
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default=','.join(str(s) for s in SIZES),
+        help='collection sizes to run at, comma separated')
+    parser.add_option('--runs', type='int', default=RUNS,
+        help='timed runs of each case')
+    parser.add_option('--only', metavar='TEXT',
+        help='only run cases with TEXT in their names')
+    parser.add_option('--baselines', default=BASELINES)
+    parser.add_option('--tolerance', type='float', default=TOLERANCE,
+        help='fraction latency and objects may grow past baselines')
+    parser.add_option('--save', action='store_true', default=False,
+        help='save the results as the new baselines')
+    (options, args) = parser.parse_args()
+
+    setup_stubs()
+    models.RETRIEVE_CACHE_MAX_SIZE = -1
+    storage.instrument(True)
+
+    results = {}
+    for size in [ int(s) for s in options.sizes.split(',') ]:
+        results.update(run_size(size, options.runs, options.only))
+
+    baselines = {}
+    if os.path.exists(options.baselines):
+        baselines = simplejson.load(open(options.baselines))
+    if options.save:
+        baselines.update(results)
+        out = open(options.baselines, 'w')
+        try:
+            simplejson.dump(baselines, out, indent=1, sort_keys=True)
+        finally:
+            out.close()
+        print 'Saved %s baselines to %s' % (len(results), options.baselines)
+        return
+
+    failures = compare(results, baselines, options.tolerance)
+    for failure in failures:
+        print 'REGRESSION %s' % failure
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__': main()
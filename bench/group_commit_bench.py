@@ -0,0 +1,70 @@
+"""
+Benchmark concurrent writers against SQLite storage, committing each
+transaction on its own and in groups, reporting throughput and latency at
+1, 10 and 100 writers, eg. python bench/group_commit_bench.py 5
+
+Commits on their own run with synchronous=NORMAL, as by default, which
+skips the fsync on commit, while group commits are fsynced.
+"""
+from benchutil import *
+
+import sys, tempfile, shutil
+import webtest
+from django.utils import simplejson
+from fxsync import storage, models
+from google.appengine.api import memcache
+from http_bench import percentile
+import sync_api
+
+DURATION = 5.0
+WRITER_COUNTS = (1, 10, 100)
+
+def writer(test_app, profile, deadline, latencies):
+    """PUT single WBOs as one user until the deadline"""
+    headers = auth_header(profile.user_name, profile.password)
+    url = '/sync/1.0/%s/storage/history' % profile.user_name
+    n = 0
+    while time.time() < deadline:
+        start = time.time()
+        test_app.put('%s/w-%s' % (url, n % 100), headers=headers,
+            params=simplejson.dumps({ 'payload': simplejson.dumps(n) }))
+        latencies.append((time.time() - start) * 1000.0)
+        n += 1
+
+def run_backend(name, backend, duration):
+    storage.set_backend(backend)
+    memcache.flush_all()
+    models.known_collections.clear()
+    test_app = webtest.TestApp(sync_api.application())
+    profiles = [ create_profile('bench-%s' % i)
+        for i in range(max(WRITER_COUNTS)) ]
+
+    for num_writers in WRITER_COUNTS:
+        latencies = []
+        deadline = time.time() + duration
+        threads = [
+            threading.Thread(target=writer,
+                args=(test_app, profiles[i], deadline, latencies))
+            for i in range(num_writers)
+        ]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        print '%-12s %3d writers %8.1f writes/sec %7.1fms p50 %7.1fms p99' % (
+            name, num_writers, len(latencies) / duration,
+            percentile(latencies, 0.5), percentile(latencies, 0.99))
+    backend.close()
+
+def main():
+    duration = len(sys.argv) > 1 and float(sys.argv[1]) or DURATION
+    setup_stubs()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        run_backend('single', storage.create_backend('sqlite',
+            os.path.join(tmp_dir, 'single.sqlite')), duration)
+        run_backend('group', storage.create_backend('sqlite',
+            os.path.join(tmp_dir, 'group.sqlite'), group_commit=True),
+            duration)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__': main()
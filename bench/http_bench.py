@@ -0,0 +1,91 @@
+"""
+Benchmark a running server over HTTP, reporting throughput and latency
+
+Runs the same mixed workload as concurrency_bench.py, but against a live
+deployment, so that the standalone server and App Engine can be compared
+directly, eg.
+
+    python bench/http_bench.py http://localhost:8080 bench bench-pass
+    python bench/http_bench.py https://lmo-fx-sync.appspot.com bench pass
+
+The profile must already exist (see controllers/standalone.py --add-user).
+"""
+import sys, time, random, threading, base64, httplib, urlparse
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+DURATION = 10.0
+CONCURRENCY = (1, 4, 16, 64)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values: return 0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class Client(object):
+    """One keep-alive connection issuing the workload"""
+
+    def __init__(self, base_url, user_name, password):
+        url = urlparse.urlparse(base_url)
+        if 'https' == url[0]:
+            self.conn = httplib.HTTPSConnection(url[1])
+        else:
+            self.conn = httplib.HTTPConnection(url[1])
+        self.prefix = '%s/sync/1.0/%s' % (url[2].rstrip('/'), user_name)
+        self.headers = {
+            'Authorization': 'Basic %s' % base64.b64encode(
+                '%s:%s' % (user_name, password)
+            )
+        }
+
+    def request(self, method, path, body=None):
+        self.conn.request(method, self.prefix + path, body, self.headers)
+        response = self.conn.getresponse()
+        response.read()
+        if response.status >= 400:
+            raise Exception('%s %s: %s' % (method, path, response.status))
+
+    def run(self, deadline, latencies):
+        n = 0
+        while time.time() < deadline:
+            choice = random.random()
+            start = time.time()
+            if choice < 0.5:
+                self.request('GET', '/info/collections')
+            elif choice < 0.8:
+                self.request('GET', '/storage/history?full=1&newer=%s' %
+                    (time.time() - 60))
+            else:
+                self.request('POST', '/storage/history', json.dumps([
+                    { 'id': 'w-%s' % random.randint(0, 1000),
+                      'payload': json.dumps({ 'n': n }) }
+                    for i in range(10)
+                ]))
+            latencies.append((time.time() - start) * 1000.0)
+            n += 1
+
+def main():
+    if len(sys.argv) < 4:
+        raise SystemExit('usage: http_bench.py base_url user_name password '
+            '[duration]')
+    base_url, user_name, password = sys.argv[1:4]
+    duration = len(sys.argv) > 4 and float(sys.argv[4]) or DURATION
+
+    print '%8s %12s %9s %9s' % ('clients', 'requests/sec', 'p50', 'p99')
+    for num_clients in CONCURRENCY:
+        latencies = []
+        deadline = time.time() + duration
+        threads = [
+            threading.Thread(target=Client(base_url, user_name, password).run,
+                args=(deadline, latencies))
+            for i in range(num_clients)
+        ]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        print '%8d %12.1f %7.1fms %7.1fms' % (num_clients,
+            len(latencies) / duration,
+            percentile(latencies, 0.5), percentile(latencies, 0.99))
+
+if __name__ == '__main__': main()
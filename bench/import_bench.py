@@ -0,0 +1,61 @@
+"""
+Benchmark cold start latency, as the time a fresh process takes to import
+the controllers and serve its first requests
+
+Compares the single lazy entry point in controllers/app.py against
+building every controller's app up front, as separate scripts would.
+"""
+import sys, os, subprocess
+
+SETUP = """
+import time
+start = time.time()
+import benchutil
+benchutil.setup_stubs()
+import webtest
+"""
+
+REPORT = """
+print '%.2f' % ((time.time() - start) * 1000.0)
+"""
+
+CASES = (
+    ('app.py, first sync API request', """
+import app
+webtest.TestApp(app.application()).get('/sync/1.0/bench/info/quota', status=401)
+"""),
+    ('app.py, first user API request', """
+import app
+webtest.TestApp(app.application()).get('/sync/user/1.0/bench')
+"""),
+    ('app.py, one request to each API', """
+import app
+t = webtest.TestApp(app.application())
+t.get('/sync/1.0/bench/info/quota', status=401)
+t.get('/sync/user/1.0/bench')
+"""),
+    ('all controllers, first sync API request', """
+import sync_api, user_api, main
+apps = [ m.application() for m in (sync_api, user_api, main) ]
+webtest.TestApp(apps[0]).get('/sync/1.0/bench/info/quota', status=401)
+"""),
+)
+
+def run_case(code, runs):
+    """Run a case in fresh interpreters, returning the best time in ms"""
+    bench_dir = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for i in range(runs):
+        out = subprocess.Popen(
+            [ sys.executable, '-c', SETUP + code + REPORT ],
+            cwd=bench_dir, stdout=subprocess.PIPE
+        ).communicate()[0]
+        times.append(float(out.strip().splitlines()[-1]))
+    return min(times)
+
+def main():
+    runs = len(sys.argv) > 1 and int(sys.argv[1]) or 5
+    for name, code in CASES:
+        print '%-45s %8.2fms' % (name, run_case(code, runs))
+
+if __name__ == '__main__': main()
@@ -0,0 +1,69 @@
+"""
+Benchmark Collection.retrieve with and without the in-memory collection
+indexes, on the local storage backends, and report the memory each
+indexed record takes, eg. python bench/index_bench.py sqlite
+"""
+from benchutil import *
+
+import sys, tempfile, shutil
+from fxsync import storage, models
+from fxsync.models import Collection, WBO
+from google.appengine.api import memcache
+
+BACKENDS = ('sqlite', 'log')
+RECORDS = 5000
+
+def run_backend(name, backend):
+    """Load a collection of records, then time retrievals against it"""
+    storage.set_backend(backend)
+    memcache.flush_all()
+    models.known_collections.clear()
+
+    profile = create_profile()
+    collection = Collection.get_by_profile_and_name(profile, 'history')
+    now = WBO.get_time_now()
+    for i in range(0, RECORDS, 500):
+        collection.put_wbos([
+            WBO(parent=collection, key_name='w-%s' % j, collection=collection,
+                wbo_id='w-%s' % j, modified=now - RECORDS + j, sortindex=j,
+                parentid='p-%s' % (j % 10), payload='{"n": %s}' % j)
+            for j in range(i, i + 500)
+        ])
+
+    cases = (
+        ('IDs, by sortindex', dict(limit=100)),
+        ('full, by sortindex', dict(full=True, limit=100)),
+        ('IDs, newer, oldest first',
+            dict(newer=now - 500, sort='oldest', limit=100)),
+        ('IDs, parentid and index_above',
+            dict(parentid='p-3', index_above=RECORDS / 2)),
+        ('count, newer and index_below',
+            dict(count=True, newer=now - 2000, index_below=RECORDS - 100)),
+    )
+    for case, criteria in cases:
+        def retrieve():
+            result = collection.retrieve(**criteria)
+            if not criteria.get('count'): list(result)
+        report('%-14s %s' % (name, case), measure(retrieve, runs=20))
+
+    if backend.index_cache:
+        stats = backend.index_cache.stats()
+        print '%-14s %s records indexed, %s bytes, %.1f bytes per record' % (
+            name, stats['records'], stats['bytes'], stats['bytes_per_record'])
+
+def main():
+    names = sys.argv[1:] or BACKENDS
+    setup_stubs()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name in names:
+            for index in (False, True):
+                label = '%s%s' % (name, index and '+index' or '')
+                path = os.path.join(tmp_dir, label)
+                if 'sqlite' == name: path += '.sqlite'
+                run_backend(label,
+                    storage.create_backend(name, path, index=index))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,49 @@
+"""
+Benchmark the cost of X-If-Unmodified-Since preconditions on writes
+"""
+from benchutil import *
+
+import webtest
+from django.utils import simplejson
+import sync_api
+
+def main():
+    setup_stubs()
+    profile = create_profile()
+    app = webtest.TestApp(sync_api.application())
+    headers = auth_header(profile.user_name, profile.password)
+    url = '/sync/1.0/%s/storage/bench' % profile.user_name
+    wbo_json = simplejson.dumps({ 'payload': simplejson.dumps({}) })
+    bulk_json = simplejson.dumps([
+        { 'id': 'bulk-%s' % i, 'payload': simplejson.dumps({}) }
+        for i in range(25)
+    ])
+
+    def current_headers():
+        h = { 'X-If-Unmodified-Since': str(sync_api.WBO.get_time_now() + 1) }
+        h.update(headers)
+        return h
+
+    stale = { 'X-If-Unmodified-Since': '1.0' }
+    stale.update(headers)
+
+    app.put('%s/item' % url, headers=headers, params=wbo_json)
+
+    report('PUT item, no precondition', measure(lambda:
+        app.put('%s/item' % url, headers=headers, params=wbo_json)))
+    report('PUT item, precondition met', measure(lambda:
+        app.put('%s/item' % url, headers=current_headers(), params=wbo_json)))
+    report('PUT item, precondition failed', measure(lambda:
+        app.put('%s/item' % url, headers=stale, params=wbo_json, status=412)))
+
+    report('POST 25 items, no precondition', measure(lambda:
+        app.post(url, headers=headers, params=bulk_json), 20))
+    report('POST 25 items, precondition met', measure(lambda:
+        app.post(url, headers=current_headers(), params=bulk_json), 20))
+    report('POST 25 items, precondition failed', measure(lambda:
+        app.post(url, headers=stale, params=bulk_json, status=412), 20))
+
+    report('DELETE collection, precondition failed', measure(lambda:
+        app.delete(url, headers=stale, status=412)))
+
+if __name__ == '__main__': main()
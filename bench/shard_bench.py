@@ -0,0 +1,66 @@
+"""
+Benchmark write throughput with many users writing at once, to a single
+SQLite database and to a database per user, eg.
+python bench/shard_bench.py 5
+"""
+from benchutil import *
+
+import sys, tempfile, shutil
+import webtest
+from django.utils import simplejson
+from fxsync import storage, models
+from google.appengine.api import memcache
+import sync_api
+
+DURATION = 5.0
+THREAD_COUNTS = (1, 4, 16, 64)
+
+def worker(test_app, profile, deadline, counts):
+    """POST small batches as one user until the deadline"""
+    headers = auth_header(profile.user_name, profile.password)
+    url = '/sync/1.0/%s/storage/history' % profile.user_name
+    n = 0
+    while time.time() < deadline:
+        test_app.post(url, headers=headers, params=simplejson.dumps([
+            { 'id': 'w-%s' % ((n * 5 + i) % 1000),
+              'payload': simplejson.dumps({ 'n': n }) }
+            for i in range(5)
+        ]))
+        n += 1
+    counts.append(n)
+
+def run_backend(name, backend, duration):
+    storage.set_backend(backend)
+    memcache.flush_all()
+    models.known_collections.clear()
+    test_app = webtest.TestApp(sync_api.application())
+    profiles = [ create_profile('bench-%s' % i)
+        for i in range(max(THREAD_COUNTS)) ]
+
+    for num_threads in THREAD_COUNTS:
+        counts = []
+        deadline = time.time() + duration
+        threads = [
+            threading.Thread(target=worker,
+                args=(test_app, profiles[i], deadline, counts))
+            for i in range(num_threads)
+        ]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        print '%-8s %2d users %8.1f writes/sec' % (
+            name, num_threads, sum(counts) / duration)
+
+def main():
+    duration = len(sys.argv) > 1 and float(sys.argv[1]) or DURATION
+    setup_stubs()
+    models.RETRIEVE_CACHE_MAX_SIZE = -1
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        run_backend('sqlite', storage.create_backend('sqlite',
+            os.path.join(tmp_dir, 'bench.sqlite')), duration)
+        run_backend('sharded', storage.create_backend('sharded',
+            os.path.join(tmp_dir, 'shards')), duration)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__': main()
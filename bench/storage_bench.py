@@ -0,0 +1,90 @@
+"""
+Benchmark the sync API against each storage backend
+
+Runs the same requests against the datastore stub, in-memory, SQLite and
+log-structured backends, eg. python bench/storage_bench.py sqlite log
+"""
+from benchutil import *
+
+import sys, tempfile, shutil
+import webtest
+from django.utils import simplejson
+from fxsync import storage, models
+from google.appengine.api import memcache
+import sync_api
+
+BACKENDS = ('datastore', 'memory', 'sqlite', 'log')
+RECORDS = 500
+
+def run_backend(name, backend):
+    """Load a collection of records, then time the common reads and
+    writes against it"""
+    storage.set_backend(backend)
+    memcache.flush_all()
+    models.known_collections.clear()
+
+    profile = create_profile()
+    app = webtest.TestApp(sync_api.application())
+    headers = auth_header(profile.user_name, profile.password)
+    url = '/sync/1.0/%s/storage/history' % profile.user_name
+
+    for i in range(0, RECORDS, 100):
+        app.post(url, headers=headers, params=simplejson.dumps([
+            { 'id': 'w-%s' % j, 'sortindex': j,
+              'parentid': 'p-%s' % (j % 10),
+              'payload': simplejson.dumps({ 'n': j }) }
+            for j in range(i, i + 100)
+        ]))
+    newer = sync_api.WBO.get_time_now() - 3600
+
+    def get(path):
+        return app.get(path, headers=headers)
+
+    n = [0]
+    def post():
+        n[0] += 1
+        app.post(url, headers=headers, params=simplejson.dumps([
+            { 'id': 'w-%s' % (n[0] % RECORDS),
+              'payload': simplejson.dumps({ 'n': n[0] }) }
+        ]))
+
+    results = (
+        ('IDs, by sortindex', measure(lambda: get('%s?limit=100' % url))),
+        ('full=1, by sortindex',
+            measure(lambda: get('%s?full=1&limit=100' % url))),
+        ('IDs, newer',
+            measure(lambda: get('%s?newer=%s&limit=100' % (url, newer)))),
+        ('IDs, parentid and index_above', measure(lambda:
+            get('%s?parentid=p-3&index_above=100' % url))),
+        ('info/collections', measure(lambda: app.get(
+            '/sync/1.0/%s/info/collections' % profile.user_name,
+            headers=headers))),
+        ('info/collection_counts', measure(lambda: app.get(
+            '/sync/1.0/%s/info/collection_counts' % profile.user_name,
+            headers=headers))),
+        ('POST 1 item', measure(post)),
+    )
+    for case, result in results:
+        report('%-9s %s' % (name, case), result)
+
+def main():
+    names = sys.argv[1:] or BACKENDS
+    setup_stubs()
+    # Time the backends rather than the retrieval cache
+    models.RETRIEVE_CACHE_MAX_SIZE = -1
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name in names:
+            if 'sqlite' == name:
+                backend = storage.create_backend(name,
+                    os.path.join(tmp_dir, 'bench.sqlite'))
+            elif 'log' == name:
+                backend = storage.create_backend(name,
+                    os.path.join(tmp_dir, 'bench-log'))
+            else:
+                backend = storage.create_backend(name)
+            run_backend(name, backend)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,98 @@
+"""
+Controller for admin-only diagnostics of the sync service
+"""
+import sys, os
+base_dir = os.path.dirname( os.path.dirname(__file__) )
+sys.path.extend([ os.path.join(base_dir, d) for d in ( 'lib', 'extlib' ) ])
+
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp import util
+from django.utils import simplejson
+from fxsync.utils import admin_auth
+from fxsync import metrics, slowlog, profiler, sampler, memtrack
+
+def main():
+    """Main entry point for controller"""
+    util.run_wsgi_app(application())
+
+def application():
+    """Build the WSGI app for this package"""
+    return webapp.WSGIApplication([
+        (r'/sync/admin/metrics', MetricsHandler),
+        (r'/sync/admin/slow', SlowRequestsHandler),
+        (r'/sync/admin/profiles/([^/]+)', ProfileHandler),
+        (r'/sync/admin/samples', SamplesHandler),
+        (r'/sync/admin/memory', MemoryHandler),
+    ], debug=True)
+
+class MetricsHandler(webapp.RequestHandler):
+    """Request latency and throughput by route, for scraping"""
+
+    @admin_auth
+    def get(self):
+        self.response.headers['Content-Type'] = \
+            'text/plain; version=0.0.4; charset=utf-8'
+        self.response.out.write(metrics.render(metrics.collect()))
+
+class SlowRequestsHandler(webapp.RequestHandler):
+    """Recent slow collection requests, newest first, with their plans"""
+
+    @admin_auth
+    def get(self):
+        try:
+            limit = int(self.request.get('limit', slowlog.RING_SIZE))
+        except ValueError:
+            limit = -1
+        if limit < 0:
+            self.response.set_status(400, message="Bad Request")
+            self.response.out.write("Invalid limit")
+            return
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(simplejson.dumps(slowlog.records(limit)))
+
+class ProfileHandler(webapp.RequestHandler):
+    """Download of the stats of a profiled request, as pstats data or, with
+    format=collapsed, as collapsed stacks"""
+
+    @admin_auth
+    def get(self, profile_id):
+        data = profiler.load(profile_id)
+        if data is None:
+            self.response.set_status(404, message="Not Found")
+            self.response.out.write("Not Found")
+            return
+        if 'collapsed' == self.request.get('format'):
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.out.write(profiler.collapse_stacks(data['stats']))
+        else:
+            self.response.headers['Content-Type'] = \
+                'application/octet-stream'
+            self.response.headers['Content-Disposition'] = \
+                'attachment; filename="%s.prof"' % profile_id
+            self.response.out.write(profiler.dump_stats(data['stats']))
+
+class SamplesHandler(webapp.RequestHandler):
+    """Stacks sampled from requests in progress, as collapsed stacks headed
+    by route, eg. sync.StorageCollectionHandler. Takes route to export
+    only one, and clear to start counting afresh."""
+
+    @admin_auth
+    def get(self):
+        if sampler.sampler is None:
+            self.response.set_status(404, message="Not Found")
+            self.response.out.write("Sampling is off")
+            return
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write(sampler.sampler.collapsed(
+            self.request.get('route') or None,
+            bool(self.request.get('clear'))))
+
+class MemoryHandler(webapp.RequestHandler):
+    """Memory used by requests to tracked routes, by route and collection,
+    and the requests with the most growth, on this instance"""
+
+    @admin_auth
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(simplejson.dumps(dict(
+            memtrack.stats.as_dict(), tracked=sorted(memtrack.ROUTES))))
@@ -0,0 +1,80 @@
+"""
+Single WSGI entry point for all dynamic URLs
+
+Controller modules are only imported when a URL routed to them is first
+requested, so an instance serving only the sync API never pays to import
+the web UI and its template machinery.
+"""
+import sys, os
+base_dir = os.path.dirname( os.path.dirname(__file__) )
+sys.path.extend([ os.path.join(base_dir, d) for d in (
+    'lib', 'extlib', 'controllers'
+)])
+
+import types, threading
+from google.appengine.ext.webapp import util
+
+# URL path prefixes, in order of precedence, and the controller modules
+# whose application builds the WSGI app serving them.
+ROUTES = (
+    ('/_ah/warmup',     'warmup'),
+    ('/sync/user/1.0/', 'user_api'),
+    ('/sync/1.0/',      'sync_api'),
+    ('/sync/admin/',    'admin'),
+    ('/test',           'gaeunit'),
+    ('/',               'main'),
+)
+
+def main():
+    """Main entry point for controller"""
+    util.run_wsgi_app(dispatcher)
+
+def application():
+    """Get the WSGI app for all dynamic URLs"""
+    return dispatcher
+
+class LazyDispatcher(object):
+    """WSGI app dispatching on path prefix to controller apps, which are
+    imported and built on first use"""
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.apps = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        environ['fxsync.dispatcher'] = self
+        for prefix, module_name in self.routes:
+            if path.startswith(prefix):
+                return self.get_app(module_name)(environ, start_response)
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return ['Not Found']
+
+    def get_app(self, module_name):
+        """Get the WSGI app for a controller module, importing and building
+        it if necessary"""
+        app = self.apps.get(module_name)
+        if app is None:
+            self.lock.acquire()
+            try:
+                app = self.apps.get(module_name)
+                if app is None:
+                    app = self.apps[module_name] = self.load_app(module_name)
+            finally:
+                self.lock.release()
+        return app
+
+    def load_app(self, module_name):
+        """Import a controller module and build its WSGI app"""
+        module = __import__(module_name)
+        app = module.application
+        # Most controllers offer a function building the app, but some
+        # (eg. gaeunit) have the app itself.
+        if isinstance(app, types.FunctionType):
+            app = app()
+        return app
+
+dispatcher = LazyDispatcher(ROUTES)
+
+if __name__ == '__main__': main()
@@ -10,6 +10,8 @@ from google.appengine.api import users
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import util, template
 from fxsync.models import Profile, Collection, WBO
+from fxsync.context import ContextMiddleware
+from fxsync.profiler import ProfileMiddleware
 
 def main():
     """Main entry point for controller"""
@@ -17,9 +19,9 @@ def main():
 
 def application():
     """Build the WSGI app for this package"""
-    return webapp.WSGIApplication([
+    return ContextMiddleware(ProfileMiddleware(webapp.WSGIApplication([
         ('/start', StartHandler),
-    ], debug=True)
+    ], debug=True)))
 
 class StartHandler(webapp.RequestHandler):
     """Sync start page handler"""
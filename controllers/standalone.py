@@ -0,0 +1,180 @@
+"""
+Standalone server for the sync and user APIs, for self-hosting outside
+App Engine
+
+Needs the App Engine SDK (set APPENGINE_SDK to where it is unpacked) for
+the webapp framework and an in-process memcache. Data is kept in a local
+storage backend, SQLite by default, eg.
+
+    python controllers/standalone.py --port 8080 --sqlite-path sync.sqlite
+    python controllers/standalone.py --add-user someone
+
+Profiles are normally created through the web UI, which needs Google
+accounts, so --add-user creates them here instead. With --storage sharded,
+each user's data goes in a database file of its own, and --stats and
+--export work through all of them in parallel. With --sample-rate, the
+stacks of requests are sampled continuously, for /sync/admin/samples, and
+with --trace-rate, a fraction of requests are traced to files for
+chrome://tracing.
+"""
+import sys, os
+base_dir = os.path.dirname( os.path.dirname(os.path.abspath(__file__)) )
+sdk_dir = os.environ.get('APPENGINE_SDK', '/usr/local/google_appengine')
+sys.path[0:0] = [ os.path.join(base_dir, d) for d in (
+    'lib', 'extlib', 'controllers'
+)] + [ sdk_dir ] + [ os.path.join(sdk_dir, 'lib', d) for d in (
+    'django', 'webob', 'yaml/lib'
+)]
+
+os.environ.setdefault('APPLICATION_ID', 'fxsync-standalone')
+os.environ.setdefault('AUTH_DOMAIN', 'gmail.com')
+os.environ.setdefault('SERVER_SOFTWARE', 'Standalone/1.0')
+os.environ.setdefault('USER_EMAIL', '')
+os.environ.setdefault('FXSYNC_METRICS', 'local')
+
+import logging, signal, threading
+from optparse import OptionParser
+
+from django.utils import simplejson
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import user_service_stub
+from google.appengine.api.memcache import memcache_stub
+
+# Only the APIs are served, since the web UI depends on Google accounts.
+# Admin pages need FXSYNC_ADMIN_TOKEN set, and sent in a header.
+ROUTES = (
+    ('/sync/user/1.0/', 'user_api'),
+    ('/sync/1.0/',      'sync_api'),
+    ('/sync/admin/',    'admin'),
+)
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='0.0.0.0')
+    parser.add_option('--port', type='int', default=8080)
+    parser.add_option('--workers', type='int', default=16,
+        help='number of worker threads serving connections')
+    parser.add_option('--keep-alive', type='float', default=15,
+        help='seconds an idle connection is kept open, 0 to disable')
+    parser.add_option('--shutdown-timeout', type='float', default=30,
+        help='seconds to wait for in-flight requests on shutdown')
+    parser.add_option('--storage', default='sqlite',
+        help='storage backend, sqlite, sharded, log or memory')
+    parser.add_option('--sqlite-path', default='fxsync.sqlite')
+    parser.add_option('--log-path', default='fxsync-log',
+        help='directory for the log storage backend')
+    parser.add_option('--shard-path', default='fxsync-shards',
+        help='directory for the sharded storage backend')
+    parser.add_option('--max-open-shards', type='int', default=64,
+        help='user databases kept open at once, when sharded')
+    parser.add_option('--group-commit', action='store_true', default=False,
+        help='commit concurrent SQLite writes together, sharing one fsync')
+    parser.add_option('--group-commit-delay', type='float', default=2,
+        help='milliseconds a group commit waits for more writes')
+    parser.add_option('--stats', action='store_true', default=False,
+        help='print storage stats of every user, when sharded, and exit')
+    parser.add_option('--export', metavar='DIR',
+        help='export the data of every user to DIR, when sharded, and exit')
+    parser.add_option('--quiet', action='store_true', default=False,
+        help='do not log each request')
+    parser.add_option('--instrument', action='store_true', default=False,
+        help='log the storage calls of each request')
+    parser.add_option('--trace-rate', type='float',
+        default=float(os.environ.get('FXSYNC_TRACE_RATE', 0) or 0),
+        help='fraction of requests to trace, 0 to disable')
+    parser.add_option('--trace-path',
+        default=os.environ.get('FXSYNC_TRACE_PATH', 'fxsync-traces'),
+        help='directory for trace files')
+    parser.add_option('--track-memory', metavar='ROUTES',
+        default=os.environ.get('FXSYNC_MEMORY_ROUTES', ''),
+        help='routes to track memory use of, comma separated, or *')
+    parser.add_option('--sample-rate', type='float',
+        default=float(os.environ.get('FXSYNC_SAMPLE_RATE', 0) or 0),
+        help='samples a second of request stacks, 0 to disable')
+    parser.add_option('--add-user', metavar='USER_NAME',
+        help='create a profile, print its password, and exit')
+    parser.add_option('--password',
+        help='password for --add-user, generated if omitted')
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s')
+    backend = setup(options)
+
+    if options.add_user:
+        print add_user(options.add_user, options.password)
+        return
+    if options.stats or options.export:
+        if not hasattr(backend, 'map_shards'):
+            parser.error('--stats and --export need --storage sharded')
+        if options.stats:
+            print simplejson.dumps(backend.stats(), indent=2)
+        if options.export:
+            written = backend.export(options.export)
+            logging.info('Exported %s records of %s users to %s' % (
+                sum(written.values()), len(written), options.export))
+        backend.close()
+        return
+
+    from fxsync.server import PooledWSGIServer
+    from fxsync import sampler
+    import app
+    sampler.start(options.sample_rate)
+    server = PooledWSGIServer((options.host, options.port),
+        app.LazyDispatcher(ROUTES), workers=options.workers,
+        keep_alive_timeout=options.keep_alive, quiet=options.quiet)
+
+    def stop(signum, frame):
+        logging.info('Shutting down, waiting for in-flight requests')
+        # serve_forever() runs on this thread, so stop from another
+        threading.Thread(target=server.stop,
+            args=(options.shutdown_timeout,)).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logging.info('Serving on http://%s:%s/ with %s workers, %s storage' % (
+        options.host, options.port, options.workers, options.storage))
+    server.serve_forever()
+    sampler.stop()
+    if hasattr(backend, 'close'):
+        backend.close()
+
+def setup(options):
+    """Install the in-process service stubs and the storage backend"""
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub('memcache',
+        memcache_stub.MemcacheServiceStub())
+    apiproxy_stub_map.apiproxy.RegisterStub('user',
+        user_service_stub.UserServiceStub())
+
+    # Import the models first, so that stored entities can be rebuilt
+    from fxsync import storage, models, tracing, memtrack
+    storage.instrument(options.instrument)
+    tracing.RATE = options.trace_rate
+    tracing.PATH = options.trace_path
+    memtrack.ROUTES = set(r.strip()
+        for r in options.track_memory.split(',') if r.strip())
+    group_commit = dict(group_commit=options.group_commit,
+        group_commit_delay=options.group_commit_delay / 1000.0)
+    if 'sqlite' == options.storage:
+        backend = storage.create_backend('sqlite', options.sqlite_path,
+            **group_commit)
+    elif 'log' == options.storage:
+        backend = storage.create_backend('log', options.log_path)
+    elif 'sharded' == options.storage:
+        backend = storage.create_backend('sharded', options.shard_path,
+            options.max_open_shards, **group_commit)
+    else:
+        backend = storage.create_backend(options.storage)
+    return storage.set_backend(backend)
+
+def add_user(user_name, password=None):
+    """Create a sync profile, returning its password"""
+    from fxsync.models import Profile
+    if Profile.get_by_user_name(user_name):
+        raise SystemExit('user %s already exists' % user_name)
+    password = password or Profile.generate_password()
+    Profile(user_name=user_name, user_id=user_name, password=password).put()
+    return password
+
+if __name__ == '__main__': main()
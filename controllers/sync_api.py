@@ -7,15 +7,19 @@ import sys, os
 base_dir = os.path.dirname( os.path.dirname(__file__) )
 sys.path.extend([ os.path.join(base_dir, d) for d in ( 'lib', 'extlib' ) ])
 
-import logging, struct
+import logging, struct, hashlib
 from datetime import datetime
 from time import mktime
-from google.appengine.api import users
-from google.appengine.ext import webapp, db
-from google.appengine.ext.webapp import util, template
+from email.Utils import formatdate, parsedate_tz, mktime_tz
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp import util
 from django.utils import simplejson 
-from fxsync.utils import profile_auth, json_request, json_response
-from fxsync.models import Profile, Collection, WBO
+from fxsync.utils import profile_auth, json_request, json_response, is_admin
+from fxsync.context import ContextMiddleware
+from fxsync.storage import instrument
+from fxsync import metrics, slowlog, profiler, sampler, tracing, memtrack
+from fxsync.plan import RetrievePlan
+from fxsync.models import Profile, Collection, WBO, CollectionModifiedError
 
 WEAVE_ERROR_INVALID_PROTOCOL = 1
 WEAVE_ERROR_INCORRECT_CAPTCHA = 2
@@ -37,14 +41,20 @@ def main():
 
 def application():
     """Build the WSGI app for this package"""
-    return webapp.WSGIApplication([
+    routes = [
         (r'/sync/1.0/(.*)/info/collections', CollectionsHandler),
         (r'/sync/1.0/(.*)/info/collection_counts', CollectionCountsHandler),
         (r'/sync/1.0/(.*)/info/quota', QuotaHandler),
         (r'/sync/1.0/(.*)/storage/([^\/]*)/?$', StorageCollectionHandler),
         (r'/sync/1.0/(.*)/storage/(.*)/(.*)', StorageItemHandler),
         (r'/sync/1.0/(.*)/storage/', StorageHandler),
-    ], debug=True)
+    ]
+    app = webapp.WSGIApplication(routes, debug=True)
+    app = instrument.InstrumentMiddleware(profiler.ProfileMiddleware(app))
+    app = ContextMiddleware(tracing.TraceMiddleware(app, 'sync', routes))
+    app = sampler.SamplerMiddleware(app, 'sync', routes)
+    app = memtrack.MemoryMiddleware(app, 'sync', routes)
+    return metrics.MetricsMiddleware(app, 'sync', routes)
 
 class SyncApiBaseRequestHandler(webapp.RequestHandler):
     """Base class for all sync API request handlers"""
@@ -53,13 +63,101 @@ class SyncApiBaseRequestHandler(webapp.RequestHandler):
         self.log = logging.getLogger()
         self.response.headers['X-Weave-Timestamp'] = str(WBO.get_time_now())
 
+    def get_rpc_stats(self):
+        """Get the tallies of storage calls made so far in this request,
+        or None unless storage is instrumented"""
+        return instrument.current_stats()
+
+    def get_variant(self):
+        """Identify the listing a collection GET asks for, by its query
+        string and Accept header, so that different listings of the same
+        collection don't share an ETag"""
+        return hashlib.md5('%s\n%s' % (self.request.query_string,
+            self.request.headers.get('Accept', ''))).hexdigest()[:12]
+
+    def set_validators(self, modified, variant=None):
+        """Set the ETag and Last-Modified response headers for content last
+        modified at the given time, and of the given variant if any"""
+        tag = str(modified)
+        if variant is not None:
+            tag = '%s;%s' % (tag, variant)
+        self.response.headers['ETag'] = '"%s"' % tag
+        self.response.headers['Last-Modified'] = formatdate(modified, usegmt=True)
+
+    def is_not_modified(self, modified, variant=None):
+        """Determine whether the conditional request headers describe a
+        client copy that is still current, given the last modified time and
+        variant of the content. If so, respond with 304 Not Modified."""
+        headers = self.request.headers
+        current = False
+        if 'If-None-Match' in headers:
+            for tag in headers['If-None-Match'].split(','):
+                tag = tag.strip()
+                if tag.startswith('W/'): tag = tag[2:]
+                parts = tag.strip('"').split(';', 1)
+                if parts[1:] != (variant is not None and [ variant ] or []):
+                    # A different listing, or not a listing at all
+                    continue
+                try:
+                    if modified <= float(parts[0]):
+                        current = True
+                except ValueError:
+                    pass
+        elif 'X-If-Modified-Since' in headers:
+            try:
+                current = modified <= float(headers['X-If-Modified-Since'])
+            except ValueError:
+                pass
+        elif 'If-Modified-Since' in headers:
+            since = parsedate_tz(headers['If-Modified-Since'])
+            # HTTP dates only have whole second resolution
+            current = since is not None and int(modified) <= mktime_tz(since)
+
+        if current:
+            self.response.set_status(304)
+            self.clear_content_type()
+        return current
+
+    def clear_content_type(self):
+        """Drop the Content-Type header, for responses with no body"""
+        if 'Content-Type' in self.response.headers:
+            del self.response.headers['Content-Type']
+
+    def get_unmodified_since(self):
+        """Get the X-If-Unmodified-Since precondition timestamp, if any"""
+        try:
+            return float(self.request.headers['X-If-Unmodified-Since'])
+        except (KeyError, ValueError):
+            return None
+
+    def check_unmodified_since(self, collection_name):
+        """Check the X-If-Unmodified-Since precondition against the cached
+        last modified time of a collection, before any records are touched.
+        Responds with 412 and returns False if the precondition fails."""
+        since = self.get_unmodified_since()
+        if since is not None and since < Collection.get_modified_by_profile_and_name(
+                self.request.profile, collection_name):
+            self.precondition_failed()
+            return False
+        return True
+
+    def precondition_failed(self):
+        """Respond with 412 Precondition Failed"""
+        self.response.set_status(412, message="Precondition Failed")
+        self.clear_content_type()
+        return None
+
 class CollectionsHandler(SyncApiBaseRequestHandler):
     """Handler for collection list"""
     @profile_auth
     @json_response
     def get(self, user_name):
         """List user's collections and last modified times"""
-        return Collection.get_timestamps(self.request.profile)
+        timestamps = Collection.get_timestamps(self.request.profile)
+        modified = max(timestamps.values())
+        if self.is_not_modified(modified): return None
+        self.set_validators(modified)
+        return timestamps
 
 class CollectionCountsHandler(SyncApiBaseRequestHandler):
     """Handler for collection counts"""
@@ -85,22 +183,36 @@ class StorageItemHandler(SyncApiBaseRequestHandler):
     @json_response
     def get(self, user_name, collection_name, wbo_id):
         """Get an item from the collection"""
-        collection = Collection.get_by_profile_and_name(
+        # Nothing in the collection has changed, so neither has the item.
+        modified = Collection.get_modified_by_profile_and_name(
             self.request.profile, collection_name
         )
+        if self.is_not_modified(modified): return None
+
+        collection = Collection.lookup_by_profile_and_name(
+            self.request.profile, collection_name
+        )
+        if not collection: return self.error(404)
         wbo = WBO.get_by_collection_and_wbo_id(collection, wbo_id)
         if not wbo: return self.error(404)
+        if self.is_not_modified(wbo.modified): return None
+        self.set_validators(wbo.modified)
         return wbo.to_dict()
 
     @profile_auth
     def delete(self, user_name, collection_name, wbo_id):
         """Delete an item from the collection"""
-        collection = Collection.get_by_profile_and_name(
+        if not self.check_unmodified_since(collection_name): return None
+        collection = Collection.lookup_by_profile_and_name(
             self.request.profile, collection_name
         )
+        if not collection: return self.error(404)
         wbo = WBO.get_by_collection_and_wbo_id(collection, wbo_id)
         if not wbo: return self.error(404)
-        wbo.delete()
+        try:
+            collection.delete_wbos([wbo], self.get_unmodified_since())
+        except CollectionModifiedError:
+            return self.precondition_failed()
         self.response.out.write('%s' % WBO.get_time_now())
 
     @profile_auth
@@ -108,6 +220,7 @@ class StorageItemHandler(SyncApiBaseRequestHandler):
     @json_response
     def put(self, user_name, collection_name, wbo_id):
         """Insert or update an item in the collection"""
+        if not self.check_unmodified_since(collection_name): return None
         self.request.body_json.update({
             'profile': self.request.profile, 
             'collection_name': collection_name,
@@ -119,45 +232,127 @@ class StorageItemHandler(SyncApiBaseRequestHandler):
             self.response.out.write(WEAVE_ERROR_INVALID_WBO)
             return None
         else:
-            wbo.put()
+            try:
+                wbo.collection.put_wbos([wbo], self.get_unmodified_since())
+            except CollectionModifiedError:
+                return self.precondition_failed()
             return wbo.modified
 
 class StorageCollectionHandler(SyncApiBaseRequestHandler):
 
+    @slowlog.sample_slow
     @profile_auth
     def get(self, user_name, collection_name):
         """Filtered retrieval of WBOs from a collection"""
-        collection = Collection.get_by_profile_and_name(
+        plan = self.plan
+        plan.mark('auth')
+        if self.request.get('explain'):
+            return self.explain(collection_name)
+        modified = Collection.get_modified_by_profile_and_name(
             self.request.profile, collection_name
         )
+        plan.mark('modified')
+        variant = self.get_variant()
+        if self.is_not_modified(modified, variant): return None
+        self.set_validators(modified, variant)
+        self.response.headers['Vary'] = 'Accept'
 
-        # TODO: Need a generator here? 
-        # TODO: Find out how not to load everything into memory.
-        params = self.normalize_retrieval_parameters()
-        self.response.headers['X-Weave-Records'] = \
-            str(collection.retrieve(count=True, **params))
-        out = collection.retrieve(**params)
-
+        params = plan.params = self.normalize_retrieval_parameters()
         accept = ('Accept' not in self.request.headers 
             and 'application/json' or self.request.headers['Accept'])
 
+        collection = Collection.lookup_by_profile_and_name(
+            self.request.profile, collection_name
+        )
+        plan.mark('lookup')
+        if not collection:
+            content_type, body = self.encode_output([], accept)
+            self.response.headers['X-Weave-Records'] = '0'
+            self.response.headers['Content-Type'] = content_type
+            self.response.out.write(body)
+            return None
+
+        # Repeated polls of an unchanged collection are served from cache.
+        cache_key = collection.build_retrieval_cache_key(params, accept)
+        result = collection.get_cached_retrieval(cache_key)
+        plan.mark('cache')
+        if result is None:
+            # TODO: Need a generator here? 
+            # TODO: Find out how not to load everything into memory.
+            count = collection.retrieve(count=True, plan=plan, **params)
+            plan.mark('count')
+            out = collection.retrieve(plan=plan, **params)
+            plan.mark('retrieve')
+            content_type, body = self.encode_output(out, accept)
+            plan.mark('encode')
+            result = (count, content_type, body)
+            collection.set_cached_retrieval(cache_key, result, len(body))
+            plan.mark('store')
+
+        (count, content_type, body) = result
+        self.response.headers['X-Weave-Records'] = str(count)
+        self.response.headers['Content-Type'] = content_type
+        self.response.out.write(body)
+
+    def explain(self, collection_name):
+        """Respond with how a retrieval was carried out, instead of the
+        records retrieved. Runs the count and retrieval as a GET would,
+        bypassing the cache. Admins only."""
+        if not is_admin(self.request):
+            self.response.set_status(403, message="Forbidden")
+            self.response.out.write("Forbidden")
+            return None
+        plan = self.plan
+        plan.estimate = True
+        params = plan.params = self.normalize_retrieval_parameters()
+        collection = Collection.lookup_by_profile_and_name(
+            self.request.profile, collection_name
+        )
+        plan.mark('lookup')
+        count_plan = RetrievePlan()
+        count = 0
+        if collection:
+            count = collection.retrieve(count=True, plan=count_plan,
+                **params)
+            count_plan.mark('count')
+            plan.mark('count')
+            # Exhaust the results, so that lazy loading is included
+            for x in collection.retrieve(plan=plan, **params): pass
+            plan.mark('retrieve')
+
+        rv = plan.as_dict()
+        rv['collection'] = collection_name
+        rv['exists'] = collection is not None
+        rv['count'] = {
+            'records': count,
+            'steps': count_plan.steps,
+            'scanned': count_plan.rows()[0],
+            'ms': round(sum(ms for name, ms in count_plan.phases), 3),
+        }
+        stats = self.get_rpc_stats()
+        if stats is not None:
+            rv['rpcs'] = stats.as_dict()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(simplejson.dumps(rv))
+
+    @tracing.traced('serialize')
+    def encode_output(self, out, accept):
+        """Encode retrieved WBOs in the format named by the Accept header,
+        returning the content type and response body"""
         if 'application/newlines' == accept:
-            self.response.headers['Content-Type'] = 'application/newlines'
-            for x in out:
-                self.response.out.write("%s\n" % simplejson.dumps(x))
+            return ('application/newlines', ''.join(
+                "%s\n" % simplejson.dumps(x) for x in out
+            ))
 
         elif 'application/whoisi' == accept:
-            self.response.headers['Content-Type'] = 'application/whoisi'
-            for x in out:
-                rec = simplejson.dumps(x)
-                self.response.out.write('%s%s' % (
-                    struct.pack('!I', len(rec)), rec
-                ))
+            recs = [ simplejson.dumps(x) for x in out ]
+            return ('application/whoisi', ''.join(
+                '%s%s' % (struct.pack('!I', len(rec)), rec) for rec in recs
+            ))
 
         else:
-            self.response.headers['Content-Type'] = 'application/json'
             rv = [x for x in out]
-            self.response.out.write(simplejson.dumps(rv))
+            return ('application/json', simplejson.dumps(rv))
 
     @profile_auth
     @json_request
@@ -166,6 +361,7 @@ class StorageCollectionHandler(SyncApiBaseRequestHandler):
         """Bulk update of WBOs in a collection"""
         out = { 'modified': None, 'success': [], 'failed': {} }
 
+        if not self.check_unmodified_since(collection_name): return None
         collection = Collection.get_by_profile_and_name(
             self.request.profile, collection_name
         )
@@ -184,21 +380,36 @@ class StorageCollectionHandler(SyncApiBaseRequestHandler):
                 out['failed'][wbo_id] = errors
 
         if (len(wbos) > 0):
-            db.put(wbos)
+            try:
+                collection.put_wbos(wbos, self.get_unmodified_since())
+            except CollectionModifiedError:
+                return self.precondition_failed()
 
         return out
 
+    @slowlog.sample_slow
     @profile_auth
     @json_response
     def delete(self, user_name, collection_name):
         """Bulk deletion of WBOs from a collection"""
-        collection = Collection.get_by_profile_and_name(
+        plan = self.plan
+        plan.mark('auth')
+        if not self.check_unmodified_since(collection_name): return None
+        collection = Collection.lookup_by_profile_and_name(
             self.request.profile, collection_name
         )
-        params = self.normalize_retrieval_parameters()
+        plan.mark('lookup')
+        if not collection: return WBO.get_time_now()
+        params = plan.params = self.normalize_retrieval_parameters()
         params['wbo'] = True
-        out = collection.retrieve(**params)
-        db.delete(out)
+        out = list(collection.retrieve(plan=plan, **params))
+        plan.mark('retrieve')
+        try:
+            collection.delete_wbos(out, self.get_unmodified_since())
+        except CollectionModifiedError:
+            return self.precondition_failed()
+        finally:
+            plan.mark('delete')
         return WBO.get_time_now()
 
     def normalize_retrieval_parameters(self):
@@ -6,22 +6,33 @@ base_dir = os.path.dirname( os.path.dirname(__file__) )
 sys.path.extend([ os.path.join(base_dir, d) for d in ( 'lib', 'extlib' ) ])
 
 import urllib
-from google.appengine.api import users
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import util
 from fxsync.models import *
 from fxsync.utils import profile_auth
+from fxsync.context import ContextMiddleware
+from fxsync.storage import instrument
+from fxsync import metrics, profiler, sampler, tracing, memtrack
 
 def main():
     """Main entry point for controller"""
-    application = webapp.WSGIApplication([
+    util.run_wsgi_app(application())
+
+def application():
+    """Build the WSGI app for this package"""
+    routes = [
         (r'/sync/user/1.0/(.*)/node/weave', NodeHandler), # GET (unauth)
         (r'/sync/user/1.0/(.*)/email', EmailHandler), # POST
         (r'/sync/user/1.0/(.*)/password', PasswordHandler), # POST
         (r'/sync/user/1.0/(.*)/password_reset', PasswordResetHandler), # GET
         (r'/sync/user/1.0/(.*)/?', UserHandler), # GET (unauth), PUT, DELETE
-    ], debug=True)
-    util.run_wsgi_app(application)
+    ]
+    app = webapp.WSGIApplication(routes, debug=True)
+    app = instrument.InstrumentMiddleware(profiler.ProfileMiddleware(app))
+    app = ContextMiddleware(tracing.TraceMiddleware(app, 'user', routes))
+    app = sampler.SamplerMiddleware(app, 'user', routes)
+    app = memtrack.MemoryMiddleware(app, 'user', routes)
+    return metrics.MetricsMiddleware(app, 'user', routes)
 
 class NodeHandler(webapp.RequestHandler):
     """Sync cluster node location"""
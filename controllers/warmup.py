@@ -0,0 +1,69 @@
+"""
+Controller for warmup requests, sent to new instances before they are
+given any user traffic
+"""
+import sys, os
+base_dir = os.path.dirname( os.path.dirname(__file__) )
+sys.path.extend([ os.path.join(base_dir, d) for d in ( 'lib', 'extlib' ) ])
+
+import logging, time
+from google.appengine.api import memcache
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp import util
+from django.utils import simplejson
+
+# Controller modules whose apps are imported and built while warming up
+WARMUP_MODULES = ('sync_api', 'user_api')
+
+def main():
+    """Main entry point for controller"""
+    util.run_wsgi_app(application())
+
+def application():
+    """Build the WSGI app for this package"""
+    return webapp.WSGIApplication([
+        ('/_ah/warmup', WarmupHandler),
+    ], debug=True)
+
+class WarmupHandler(webapp.RequestHandler):
+    """Handler for warmup requests"""
+
+    def get(self):
+        """Warm up the instance, and report how long each step took"""
+        dispatcher = self.request.environ.get('fxsync.dispatcher', None)
+        timings = warm_up(dispatcher)
+        total = sum(ms for step, ms in timings)
+        logging.info('Warmed up in %.2fms: %s' % (total, ', '.join(
+            '%s %.2fms' % (step, ms) for step, ms in timings
+        )))
+        self.response.headers['Content-Type'] = 'text/plain'
+        for step, ms in timings:
+            self.response.out.write('%-24s %8.2fms\n' % (step, ms))
+        self.response.out.write('%-24s %8.2fms\n' % ('total', total))
+
+def warm_up(dispatcher=None):
+    """Import and build the API apps (compiling their routes), then prime
+    JSON encoding and the memcache and datastore RPC paths. Returns a list
+    of (step, milliseconds) timings."""
+    timings = []
+    def timed(step, fn, *args):
+        start = time.time()
+        fn(*args)
+        timings.append((step, (time.time() - start) * 1000.0))
+
+    for name in WARMUP_MODULES:
+        if dispatcher:
+            timed('app %s' % name, dispatcher.get_app, name)
+        else:
+            timed('app %s' % name, lambda: __import__(name).application())
+
+    from fxsync.models import Profile
+    timed('json', lambda: simplejson.loads(simplejson.dumps(
+        { 'id': 'warmup', 'modified': 1.5, 'payload': '{}', 'sortindex': 1 }
+    )))
+    timed('memcache', memcache.get, 'fxsync.warmup')
+    timed('datastore', lambda: Profile.all(keys_only=True).get())
+
+    return timings
+
+if __name__ == '__main__': main()
@@ -0,0 +1,83 @@
+"""
+Request-scoped context for fxsync
+
+Holds an identity map of entities loaded during a request, along with
+memoized lookups, so that model helpers can avoid repeating datastore
+reads within a request. Everything is discarded when the request ends.
+Outside of a request, lookups pass straight through.
+"""
+import threading
+
+local = threading.local()
+
+class RequestContext(object):
+    """State kept for the duration of a single request"""
+
+    def __init__(self):
+        self.memo = {}
+
+class ContextMiddleware(object):
+    """WSGI middleware wrapping each request in a fresh request context"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        begin()
+        try:
+            return self.app(environ, start_response)
+        finally:
+            end()
+
+def begin():
+    """Start a fresh request context for the current thread"""
+    local.context = RequestContext()
+    return local.context
+
+def end():
+    """Discard the request context for the current thread"""
+    local.context = None
+
+def current():
+    """Get the request context for the current thread, or None"""
+    return getattr(local, 'context', None)
+
+def memo(key, fn, *args):
+    """Call fn(*args), memoizing the result by key for the rest of the
+    current request"""
+    ctx = current()
+    if ctx is None:
+        return fn(*args)
+    try:
+        return ctx.memo[key]
+    except KeyError:
+        rv = ctx.memo[key] = fn(*args)
+        return rv
+
+def remember(key, value):
+    """Record a value under a memo key for the rest of the current request"""
+    ctx = current()
+    if ctx is not None:
+        ctx.memo[key] = value
+
+def forget(key):
+    """Forget a memoized value"""
+    ctx = current()
+    if ctx is not None:
+        ctx.memo.pop(key, None)
+
+def forget_prefix(prefix):
+    """Forget all memoized values whose tuple keys start with a prefix"""
+    ctx = current()
+    if ctx is not None:
+        n = len(prefix)
+        for key in [ k for k in ctx.memo if k[:n] == prefix ]:
+            del ctx.memo[key]
+
+def get(model, key):
+    """Get an entity by key through the identity map"""
+    return memo(('entity', str(key)), model.get, key)
+
+def remember_entity(entity):
+    """Add an entity to the identity map"""
+    remember(('entity', str(entity.key())), entity)
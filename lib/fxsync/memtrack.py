@@ -0,0 +1,142 @@
+"""
+Tracking of memory used by requests, by route and collection
+
+MemoryMiddleware measures requests to the routes named in ROUTES, eg.
+sync.StorageCollectionHandler, or all routes given '*'. For each request,
+it notes how far the process's resident memory grew between the start
+and end of the request, and for one in OBJECT_SAMPLE requests, how many
+more objects the garbage collector tracks at the end. Totals are kept by
+route and collection, along with the WORST_SIZE requests with the most
+growth, for /sync/admin/memory.
+
+Python 2 can't attribute allocations to a request, so the measures are of
+the whole process, and include whatever other threads did at the same
+time. Memory freed before the request ends isn't seen, so growth is a
+floor on what the request used. Counting objects walks all of them while
+holding up every other thread, which is why only a sample of requests
+are counted.
+
+Routes are set with FXSYNC_MEMORY_ROUTES, comma separated, the sample
+with FXSYNC_MEMORY_OBJECT_SAMPLE, and records are kept per process.
+"""
+import os, gc, time, heapq, threading, itertools
+from fxsync import metrics
+
+ROUTES = set(r.strip() for r in
+    os.environ.get('FXSYNC_MEMORY_ROUTES', '').split(',') if r.strip())
+
+WORST_SIZE = 20
+
+# Objects are counted for one in this many tracked requests, or none at 0
+OBJECT_SAMPLE = int(os.environ.get('FXSYNC_MEMORY_OBJECT_SAMPLE', 100))
+
+# Tracked requests seen, for picking those whose objects are counted
+requests_seen = itertools.count()
+
+class MemoryStats(object):
+    """Totals by route and collection, and the worst requests seen"""
+
+    def __init__(self):
+        self.totals = {}
+        self.worst = []
+        self.lock = threading.Lock()
+
+    def record(self, rec):
+        self.lock.acquire()
+        try:
+            key = (rec['route'], rec['collection'])
+            totals = self.totals.get(key)
+            if totals is None:
+                totals = self.totals[key] = {
+                    'route': rec['route'], 'collection': rec['collection'],
+                    'requests': 0, 'max_growth': 0, 'total_growth': 0,
+                    'counted': 0, 'max_objects': 0,
+                }
+            totals['requests'] += 1
+            totals['max_growth'] = max(totals['max_growth'], rec['growth'])
+            totals['total_growth'] += rec['growth']
+            if rec['objects'] is not None:
+                totals['counted'] += 1
+                totals['max_objects'] = max(totals['max_objects'],
+                    rec['objects'])
+            # A min-heap, so the least of the worst is the one to go
+            item = (rec['growth'], rec['time'], rec)
+            if len(self.worst) < WORST_SIZE:
+                heapq.heappush(self.worst, item)
+            elif item > self.worst[0]:
+                heapq.heapreplace(self.worst, item)
+        finally:
+            self.lock.release()
+
+    def as_dict(self):
+        self.lock.acquire()
+        try:
+            return {
+                'routes': sorted(self.totals.values(),
+                    key=lambda t: t['max_growth'], reverse=True),
+                'worst': [ rec for growth, t, rec in
+                    sorted(self.worst, reverse=True) ],
+            }
+        finally:
+            self.lock.release()
+
+stats = MemoryStats()
+
+def is_tracked(route):
+    return '*' in ROUTES or route in ROUTES
+
+def resident_size():
+    """Get the resident memory of this process in bytes, or 0 if unknown"""
+    try:
+        statm = open('/proc/self/statm')
+        try:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        finally:
+            statm.close()
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    try:
+        from google.appengine.api import runtime
+        return int(runtime.memory_usage().current() * 1024 * 1024)
+    except Exception:
+        return 0
+
+class MemoryMiddleware(object):
+    """WSGI middleware measuring the memory used by requests to tracked
+    routes"""
+
+    def __init__(self, app, api, routes):
+        self.app = app
+        self.api = api
+        self.routes = metrics.compile_routes(routes)
+
+    def __call__(self, environ, start_response):
+        if not ROUTES:
+            return self.app(environ, start_response)
+        route, collection = metrics.match_route(self.routes,
+            environ.get('PATH_INFO', ''))
+        route = '%s.%s' % (self.api, route)
+        if not is_tracked(route):
+            return self.app(environ, start_response)
+
+        objects_before = None
+        if OBJECT_SAMPLE and requests_seen.next() % OBJECT_SAMPLE == 0:
+            objects_before = len(gc.get_objects())
+        size_before = resident_size()
+        try:
+            # Take in the whole body, in case it is made lazily
+            return list(self.app(environ, start_response))
+        finally:
+            size_after = resident_size()
+            objects = None
+            if objects_before is not None:
+                objects = len(gc.get_objects()) - objects_before
+            stats.record({
+                'route': route,
+                'collection': collection,
+                'method': environ.get('REQUEST_METHOD'),
+                'path': environ.get('PATH_INFO'),
+                'time': time.time(),
+                'growth': size_after - size_before,
+                'objects': objects,
+            })
@@ -0,0 +1,265 @@
+"""
+Request latency histograms and throughput counters, by route
+
+MetricsMiddleware times every request to an API app, recording its
+latency in fixed buckets along with its count and response bytes, by API,
+route, method, status and collection. The admin controller renders the
+results at /sync/admin/metrics in the Prometheus text format.
+
+On App Engine, each instance adds its counts to shared counters in
+memcache every FLUSH_INTERVAL seconds, so that the endpoint shows the
+totals of all instances. Counters evicted from memcache just start over,
+as after a restart. With FXSYNC_METRICS=local, as in the standalone
+server, counts stay in process instead, and FXSYNC_METRICS=off disables
+recording.
+"""
+import os, re, time, hashlib, threading, logging
+from google.appengine.api import memcache
+
+# Upper bounds of the latency buckets, in milliseconds
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Seconds between flushes of counts to memcache
+FLUSH_INTERVAL = 10
+
+# Label names of each series, in order
+LABELS = ('api', 'route', 'method', 'status', 'collection')
+
+# Collections recorded by name, all others being lumped together, so that
+# clients can't create unbounded numbers of series.
+KNOWN_COLLECTIONS = (
+    'clients', 'crypto', 'forms', 'history', 'keys', 'meta',
+    'bookmarks', 'prefs', 'tabs', 'passwords'
+)
+
+METHODS = ('GET', 'HEAD', 'PUT', 'POST', 'DELETE', 'OPTIONS')
+
+CACHE_PREFIX = 'metrics:'
+SERIES_KEY = 'series'
+
+mode = os.environ.get('FXSYNC_METRICS', 'memcache')
+
+class Registry(object):
+    """Counts by series, each a tuple of label values. Counts for a series
+    are a list of request count, total microseconds, total response bytes,
+    then the count of requests in each latency bucket and above them."""
+
+    def __init__(self):
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, elapsed_ms, size):
+        self.lock.acquire()
+        try:
+            counts = self.series.get(labels)
+            if counts is None:
+                counts = self.series[labels] = [ 0 ] * (len(BUCKETS) + 4)
+            counts[0] += 1
+            counts[1] += int(elapsed_ms * 1000)
+            counts[2] += size
+            for i, bound in enumerate(BUCKETS):
+                if elapsed_ms <= bound:
+                    counts[3 + i] += 1
+                    break
+            else:
+                counts[-1] += 1
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            return dict( (k, list(v)) for k, v in self.series.items() )
+        finally:
+            self.lock.release()
+
+    def take(self):
+        """Take all the counts, leaving the registry empty"""
+        self.lock.acquire()
+        try:
+            series, self.series = self.series, {}
+            return series
+        finally:
+            self.lock.release()
+
+registry = Registry()
+last_flush = [ time.time() ]
+flush_lock = threading.Lock()
+
+def series_id(labels):
+    return hashlib.md5(repr(labels)).hexdigest()[:16]
+
+def observe(labels, elapsed_ms, size):
+    """Record a request, flushing counts to memcache now and then"""
+    if 'off' == mode:
+        return
+    registry.observe(labels, elapsed_ms, size)
+    if 'memcache' == mode and time.time() - last_flush[0] >= FLUSH_INTERVAL:
+        # Only one request thread flushes at a time, and others don't wait
+        if flush_lock.acquire(False):
+            try:
+                last_flush[0] = time.time()
+                flush()
+            finally:
+                flush_lock.release()
+
+def flush():
+    """Add the counts taken from this instance to the counters in
+    memcache, registering any series not seen there before"""
+    series = registry.take()
+    if not series:
+        return
+    try:
+        register_series(series.keys())
+        deltas = {}
+        for labels, counts in series.items():
+            sid = series_id(labels)
+            for i, count in enumerate(counts):
+                if count:
+                    deltas['%s:%s' % (sid, i)] = count
+        memcache.offset_multi(deltas, key_prefix=CACHE_PREFIX,
+            initial_value=0)
+    except Exception, e:
+        logging.warning('Failed to flush metrics: %s' % e)
+
+def register_series(all_labels):
+    """Add series to the list of known series in memcache"""
+    client = memcache.Client()
+    for attempt in range(5):
+        known = client.gets(CACHE_PREFIX + SERIES_KEY)
+        if known is None:
+            known = dict( (series_id(l), l) for l in all_labels )
+            if client.add(CACHE_PREFIX + SERIES_KEY, known):
+                return
+            continue
+        new = [ l for l in all_labels if series_id(l) not in known ]
+        if not new:
+            return
+        for labels in new:
+            known[series_id(labels)] = labels
+        if client.cas(CACHE_PREFIX + SERIES_KEY, known):
+            return
+
+def collect():
+    """Get the counts of every series, from memcache or this process"""
+    if 'memcache' != mode:
+        return registry.snapshot()
+    # Include what this instance hasn't flushed yet
+    flush()
+    known = memcache.get(CACHE_PREFIX + SERIES_KEY) or {}
+    keys = [ '%s:%s' % (sid, i) for sid in known
+        for i in range(len(BUCKETS) + 4) ]
+    values = memcache.get_multi(keys, key_prefix=CACHE_PREFIX)
+    return dict( (labels, [ int(values.get('%s:%s' % (sid, i), 0))
+        for i in range(len(BUCKETS) + 4) ])
+        for sid, labels in known.items() )
+
+def render(series):
+    """Render counts by series in the Prometheus text format"""
+    lines = [
+        '# HELP fxsync_request_duration_milliseconds Request latency.',
+        '# TYPE fxsync_request_duration_milliseconds histogram',
+    ]
+    for labels, counts in sorted(series.items()):
+        label_text = format_labels(labels)
+        cumulative = 0
+        for bound, count in zip(BUCKETS, counts[3:]):
+            cumulative += count
+            lines.append('fxsync_request_duration_milliseconds_bucket'
+                '{%s,le="%s"} %d' % (label_text, bound, cumulative))
+        lines.append('fxsync_request_duration_milliseconds_bucket'
+            '{%s,le="+Inf"} %d' % (label_text, counts[0]))
+        lines.append('fxsync_request_duration_milliseconds_sum{%s} %.3f' % (
+            label_text, counts[1] / 1000.0))
+        lines.append('fxsync_request_duration_milliseconds_count{%s} %d' % (
+            label_text, counts[0]))
+    lines.extend([
+        '# HELP fxsync_response_bytes_total Response body bytes sent.',
+        '# TYPE fxsync_response_bytes_total counter',
+    ])
+    for labels, counts in sorted(series.items()):
+        lines.append('fxsync_response_bytes_total{%s} %d' % (
+            format_labels(labels), counts[2]))
+    return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    return ','.join('%s="%s"' % (name, value)
+        for name, value in zip(LABELS, labels))
+
+def compile_routes(routes):
+    """Compile the URL patterns of an app's routes, noting the name of
+    each handler and the group of the collection in the pattern, if any"""
+    rv = []
+    for pattern, handler in routes:
+        # The collection is the path component after /storage/
+        group = None
+        if '/storage/(' in pattern:
+            group = pattern[:pattern.index('/storage/(')].count('(')
+        rv.append((re.compile(pattern + '$'), handler.__name__, group))
+    return rv
+
+def match_route(routes, path):
+    """Get the handler name and collection label of a path, from compiled
+    routes"""
+    for regex, name, group in routes:
+        match = regex.match(path)
+        if match:
+            collection = ''
+            if group is not None:
+                collection = match.group(group + 1)
+                if collection not in KNOWN_COLLECTIONS:
+                    collection = 'other'
+            return name, collection
+    return 'unknown', ''
+
+class MetricsMiddleware(object):
+    """WSGI middleware timing each request to an API app, labelled with
+    the name of the handler its URL routes to"""
+
+    def __init__(self, app, api, routes):
+        self.app = app
+        self.api = api
+        self.routes = compile_routes(routes)
+
+    def labels(self, environ, status):
+        route, collection = match_route(self.routes,
+            environ.get('PATH_INFO', ''))
+        method = environ.get('REQUEST_METHOD', '')
+        if method not in METHODS:
+            method = 'other'
+        return (self.api, route, method, status, collection)
+
+    def __call__(self, environ, start_response):
+        if 'off' == mode:
+            return self.app(environ, start_response)
+        start = time.time()
+        state = { 'status': '500', 'size': 0 }
+
+        def metrics_start_response(status, headers, exc_info=None):
+            state['status'] = status[:3]
+            write = start_response(status, headers, exc_info)
+            def metrics_write(data):
+                state['size'] += len(data)
+                write(data)
+            return metrics_write
+
+        try:
+            rv = self.app(environ, metrics_start_response)
+        except:
+            observe(self.labels(environ, '500'),
+                (time.time() - start) * 1000.0, 0)
+            raise
+        return self.iterate(rv, environ, start, state)
+
+    def iterate(self, rv, environ, start, state):
+        """Pass the response body along, recording the request once it
+        has all been sent"""
+        try:
+            for chunk in rv:
+                state['size'] += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(rv, 'close'):
+                rv.close()
+            observe(self.labels(environ, state['status']),
+                (time.time() - start) * 1000.0, state['size'])
@@ -5,16 +5,50 @@ import sys, os
 base_dir = os.path.dirname( os.path.dirname(__file__) )
 sys.path.extend([ os.path.join(base_dir, d) for d in ( 'lib', 'extlib' ) ])
 
-import datetime, random, string, hashlib, logging
+import datetime, random, string, hashlib, logging, threading
 from google.appengine.ext import db
-from google.appengine.api import users
+from google.appengine.api import users, memcache
 from django.utils import simplejson
+from fxsync import context, storage
+from fxsync.plan import RetrievePlan
+from fxsync.tracing import traced
 
 from datetime import datetime
-from time import mktime
+from time import mktime, time
 
 WBO_PAGE_SIZE = 25
 
+# Cached retrieval results expire after this many seconds, and results
+# encoded larger than this many bytes are not cached at all. (memcache
+# values are limited to 1MB)
+RETRIEVE_CACHE_TIME = 3600
+RETRIEVE_CACHE_MAX_SIZE = 512000
+
+# Cached modified times expire after this many seconds, bounding how long
+# a value cached by a reader racing a writer can go stale.
+METADATA_CACHE_TIME = 60
+
+# Tries at raising a cached modified time before giving up and clearing it
+CAS_ATTEMPTS = 5
+
+# Rows counted at most when estimating the rows a query matches, for plans
+PLAN_ESTIMATE_LIMIT = 10000
+
+# Per-process cache of names of collections known to exist, by profile key,
+# so that reads of known collections can skip the datastore lookup. Each
+# name maps to the collection's write generation when it was last seen, and
+# is only trusted while the generation is unchanged, since any instance
+# deleting the collection bumps it. Shared between request threads, so only
+# touched while holding the lock.
+KNOWN_COLLECTIONS_MAX_PROFILES = 1000
+known_collections = {}
+known_collections_lock = threading.Lock()
+
+class CollectionModifiedError(Exception):
+    """A write was refused, because the collection has been modified since
+    the time given as a precondition"""
+    pass
+
 def paginate(items, page_len):
     """Paginage a list of items into a list of page lists"""
     total_len = len(items)
@@ -27,7 +61,29 @@ def paginate(items, page_len):
         for i in xrange(num_pages)
     )
 
-class Profile(db.Model):
+class StoredModel(object):
+    """Mixin routing a model's gets, puts, deletes and queries through the
+    current storage backend"""
+
+    @classmethod
+    def all(cls, keys_only=False):
+        return storage.get_backend().query(cls, keys_only)
+
+    @classmethod
+    def get(cls, keys):
+        return storage.get_backend().get(keys)
+
+    @classmethod
+    def get_or_insert(cls, key_name, **kwds):
+        return storage.get_backend().get_or_insert(cls, key_name, **kwds)
+
+    def put(self):
+        return storage.get_backend().put(self)
+
+    def delete(self):
+        storage.get_backend().delete(self)
+
+class Profile(StoredModel, db.Model):
     """Sync profile associated with logged in account"""
     user        = db.UserProperty(auto_current_user_add=True)
     user_name   = db.StringProperty(required=True)
@@ -46,7 +102,8 @@ class Profile(db.Model):
     @classmethod
     def get_by_user_name(cls, user_name):
         """Get a profile by user name"""
-        return cls.all().filter('user_name =', user_name).get()        
+        return context.memo(('profile_by_user_name', user_name),
+            cls.all().filter('user_name =', user_name).get)
 
     @classmethod
     def generate_password(cls):
@@ -60,21 +117,26 @@ class Profile(db.Model):
         return ( profile and profile.password == password )
 
     def delete(self):
+        backend = storage.get_backend()
         c_keys = []
         cs = Collection.all().ancestor(self)
         for c in cs:
             c_keys.append(c.key())
+            Collection.note_write(c.key(), None)
+            Collection.forget_known(c.key())
             while True:
                 # HACK: This smells like trouble - switch to Task Queue?
                 w_keys = WBO.all(keys_only=True).ancestor(c).fetch(500)
                 if not w_keys: break
-                db.delete(w_keys)
-        db.delete(c_keys)
-        db.Model.delete(self)
+                backend.delete(w_keys)
+        backend.delete(c_keys)
+        backend.delete(self)
+        context.forget(('profile_by_user_name', self.user_name))
     
-class Collection(db.Model):
-    profile = db.ReferenceProperty(Profile, required=True)
-    name    = db.StringProperty(required=True)
+class Collection(StoredModel, db.Model):
+    profile  = db.ReferenceProperty(Profile, required=True)
+    name     = db.StringProperty(required=True)
+    modified = db.FloatProperty()
 
     builtin_names = (
         'clients', 'crypto', 'forms', 'history', 'keys', 'meta', 
@@ -86,80 +148,242 @@ class Collection(db.Model):
             # HACK: This smells like trouble - switch to Task Queue?
             w_keys = WBO.all(keys_only=True).ancestor(self).fetch(500)
             if not w_keys: break
-            db.delete(w_keys)
-        db.Model.delete(self)
+            storage.get_backend().delete(w_keys)
+        storage.get_backend().delete(self)
+        Collection.note_write(self.key(), None)
+        Collection.forget_known(self.key())
+
+    def put_wbos(self, wbos, unmodified_since=None):
+        """Store a list of WBOs in this collection, optionally refusing if
+        the collection has been modified since the given time"""
+        modified = max(w.modified for w in wbos)
+        def write():
+            # The collection rides along in the same batch put as its WBOs
+            return storage.get_backend().put([self] + list(wbos))[1:]
+        keys = self.write_if_unmodified(write, modified, unmodified_since)
+        Collection.note_write(self.key(), self.modified)
+        for w in wbos:
+            context.remember(('wbo_exists', str(self.key()), w.wbo_id), True)
+        return keys
+
+    def delete_wbos(self, wbos, unmodified_since=None):
+        """Delete a list of WBOs (or WBO keys) from this collection,
+        optionally refusing if the collection has been modified since the
+        given time"""
+        modified = WBO.get_time_now()
+        def write():
+            storage.get_backend().delete(wbos)
+            self.put()
+        self.write_if_unmodified(write, modified, unmodified_since)
+        Collection.note_write(self.key(), self.modified)
+        context.forget_prefix(('wbo_exists', str(self.key())))
+
+    def write_if_unmodified(self, write, modified, unmodified_since=None):
+        """Perform a write to this collection in a transaction, raising
+        CollectionModifiedError instead if the collection has been modified
+        since the given time. The collection's modified time is raised to
+        the given time, but never lowered, so that a writer overlapping a
+        later one can't move it backwards."""
+        # Refuse early on the cached modified time, then make sure of it
+        # inside the transaction.
+        if unmodified_since is not None and \
+                Collection.get_modified_by_key(self.key()) > unmodified_since:
+            raise CollectionModifiedError()
+
+        def txn():
+            stored = Collection.get(self.key())
+            stored_modified = stored and stored.get_modified() or 0
+            if unmodified_since is not None and \
+                    stored_modified > unmodified_since:
+                raise CollectionModifiedError()
+            self.modified = max(stored_modified, modified)
+            return write()
+        return storage.get_backend().run_in_transaction(txn)
+
+    def get_generation(self):
+        """Get the write generation of this collection, which changes
+        whenever the contents of the collection change"""
+        return Collection.get_generation_by_key(self.key())
+
+    @classmethod
+    def get_generation_by_key(cls, key):
+        """Get the write generation of a collection key"""
+        gen_key = cls.build_generation_cache_key(key)
+        gen = memcache.get(gen_key)
+        if gen is None:
+            # Seed with the current time, so that a generation lost to
+            # eviction never comes back around to revive stale results.
+            gen = int(time() * 1000)
+            if not memcache.add(gen_key, gen):
+                gen = memcache.get(gen_key) or gen
+        return gen
+
+    def build_retrieval_cache_key(self, params, *variant):
+        """Build a memcache key for a retrieval result, versioned by the
+        current generation of this collection"""
+        params_hash = hashlib.md5(repr((sorted(params.items()), variant)))
+        return 'fxsync.retrieve:%s:%s:%s' % (
+            self.key(), self.get_generation(), params_hash.hexdigest()
+        )
+
+    def get_cached_retrieval(self, cache_key):
+        """Get a cached retrieval result, or None on a miss"""
+        return memcache.get(cache_key)
 
+    def set_cached_retrieval(self, cache_key, result, size):
+        """Cache a retrieval result, unless it is too large to bother"""
+        if size > RETRIEVE_CACHE_MAX_SIZE: return False
+        return memcache.set(cache_key, result, time=RETRIEVE_CACHE_TIME)
+
+    @traced('Collection.retrieve')
     def retrieve(self, 
             full=None, wbo=None, count=None, direct_output=None, 
             id=None, ids=None, 
             parentid=None, predecessorid=None, 
             newer=None, older=None, 
             index_above=None, index_below=None,
-            sort=None, limit=None, offset=None):
+            sort=None, limit=None, offset=None, plan=None):
 
         limit  = (limit is not None) and limit or 1000 #False
         offset = (offset is not None) and offset or 0 #False
         sort   = (sort is not None) and sort or 'index'
+        if plan is None: plan = RetrievePlan()
+
+        def estimate(q):
+            """Count the rows a query matches, up to a bound, for plans
+            asking for estimates"""
+            if plan.estimate: return q.count(PLAN_ESTIMATE_LIMIT)
 
         if id:
+            plan.strategy = 'id'
+            start = time()
             w = WBO.all().ancestor(self).filter('wbo_id =', id).get()
+            found = int(w is not None)
+            plan.step('query', start, filters=['wbo_id = %r' % id],
+                estimated=1, scanned=found, returned=found)
             if count: return 1
             if wbo: return [ w ]
             if full: return [ w.to_dict() ]
             return [ w.wbo_id ]
 
         elif ids:
+            plan.strategy = 'ids'
             if count: return len(ids)
+            start = time()
             wbos = []
             id_pages = paginate(ids, WBO_PAGE_SIZE)
             for id_page in id_pages:
                 q = WBO.all().ancestor(self).filter('wbo_id IN', id_page)
                 wbos.extend(q.fetch(WBO_PAGE_SIZE))
+            plan.step('query', start,
+                filters=['wbo_id IN (%s ids)' % len(ids)],
+                pages=len(id_pages), estimated=len(ids),
+                scanned=len(wbos), returned=len(wbos))
             if wbo: return wbos
             if full: return ( w.to_dict() for w in wbos )
             return ( w.wbo_id for w in wbos )
 
+        index_cache = storage.get_backend().index_cache
+        if index_cache:
+            plan.strategy = 'index'
+            start = time()
+            criteria = dict(parentid=parentid, predecessorid=predecessorid,
+                newer=newer, older=older,
+                index_above=index_above, index_below=index_below,
+                sort=sort)
+            selected = index_cache.select(self.key(), **criteria)
+            if count:
+                plan.step('index', start, criteria=criteria,
+                    count=len(selected), scanned=len(selected))
+                return len(selected)
+            step = plan.step('index', start, criteria=criteria,
+                scanned=len(selected))
+            selected = selected[offset:offset + limit]
+            step['returned'] = len(selected)
+            if not wbo and not full:
+                return ( wbo_id for str_key, wbo_id in selected )
+            # Payloads only for the page actually returned
+            start = time()
+            wbos = [ w for w in WBO.get([ db.Key(str_key)
+                for str_key, wbo_id in selected ]) if w is not None ]
+            plan.step('get', start, estimated=len(selected),
+                loaded=len(wbos))
+            if wbo: return iter(wbos)
+            return ( w.to_dict() for w in wbos )
+
         final_query = None
         queries = []
+        filters = []
 
         # TODO: Work out how to use keys_only=True here again.
 
         if parentid is not None:
             queries.append(WBO.all().ancestor(self)
                 .filter('parentid =', parentid))
+            filters.append([ 'parentid = %r' % parentid ])
             
         if predecessorid is not None:
             queries.append(WBO.all().ancestor(self)
                 .filter('predecessorid =', predecessorid))
+            filters.append([ 'predecessorid = %r' % predecessorid ])
 
         if index_above is not None or index_below is not None:
             q = WBO.all().ancestor(self)
-            if index_above: q.filter('sortindex >', index_above)
-            if index_below: q.filter('sortindex <', index_below)
+            f = []
+            if index_above:
+                q.filter('sortindex >', index_above)
+                f.append('sortindex > %r' % index_above)
+            if index_below:
+                q.filter('sortindex <', index_below)
+                f.append('sortindex < %r' % index_below)
             q.order('sortindex')
             queries.append(q)
+            filters.append(f)
 
         if newer is not None or older is not None:
             q = WBO.all().ancestor(self)
-            if newer: q.filter('modified >', newer)
-            if older: q.filter('modified <', older)
+            f = []
+            if newer:
+                q.filter('modified >', newer)
+                f.append('modified > %r' % newer)
+            if older:
+                q.filter('modified <', older)
+                f.append('modified < %r' % older)
             q.order('modified')
             queries.append(q)
+            filters.append(f)
 
+        truncated = False
         if len(queries) == 0:
+            plan.strategy = 'query'
             final_query = WBO.all().ancestor(self)
+            final_filters = []
         elif len(queries) == 1:
+            plan.strategy = 'query'
             final_query = queries[0]
+            final_filters = filters[0]
         else:
+            plan.strategy = 'intersect'
             key_set = None
-            for q in queries:
+            for q, f in zip(queries, filters):
                 # HACK: I don't think setting _keys_only is kosher
                 q._keys_only = True
+                estimated = estimate(q)
+                start = time()
                 keys = set(str(x) for x in q.fetch(limit, offset))
+                # Matches past the page fetched from each query are left
+                # out of the intersection
+                q_truncated = offset > 0 or len(keys) >= limit
+                truncated = truncated or q_truncated
+                plan.step('query', start, filters=f, keys_only=True,
+                    estimated=estimated, scanned=len(keys) + offset,
+                    truncated=q_truncated)
                 if key_set is None:
                     key_set = keys
                 else:
                     key_set = key_set & keys
+            plan.step('intersect', in_memory=True, queries=len(queries),
+                keys=len(key_set), truncated=truncated)
             
             keys = [db.Key(x) for x in key_set]
             key_pages = paginate(keys, WBO_PAGE_SIZE)
@@ -167,6 +391,7 @@ class Collection(db.Model):
             # Use the key pages for a combo result here.
 
             final_query = WBO.all().ancestor(self).filter('__key__ IN', keys)
+            final_filters = [ '__key__ IN (%s keys)' % len(keys) ]
 
         # Determine which sort order to use.
         if 'oldest' == sort: order = 'modified'
@@ -175,29 +400,197 @@ class Collection(db.Model):
         final_query.order(order)
 
         # Return IDs / full objects as appropriate for full option.
+        estimated = None
+        if not count: estimated = estimate(final_query)
+        start = time()
         if count:
-            return final_query.count()
-        if wbo:
-            return ( w for w in final_query.fetch(limit, offset) )
-        if not full:
-            return ( w.wbo_id for w in final_query.fetch(limit, offset) )
+            rv = final_query.count()
+            plan.step('count', start, filters=final_filters, order=order,
+                count=rv, scanned=rv)
+            return rv
+        if not wbo and not full:
+            # IDs alone, which some backends can answer from an index
+            rows = storage.get_backend().fetch_values(
+                final_query, 'wbo_id', limit, offset)
         else:
-            return ( w.to_dict() for w in final_query.fetch(limit, offset) )
+            rows = final_query.fetch(limit, offset)
+        plan.step('query', start, filters=final_filters, order=order,
+            limit=limit, offset=offset, estimated=estimated,
+            scanned=len(rows) + offset, returned=len(rows),
+            truncated=truncated or None)
+        if wbo or not full: return iter(rows)
+        return ( w.to_dict() for w in rows )
 
     @classmethod
     def build_key_name(cls, name):
         return name
 
     @classmethod
+    @traced('Collection.get_by_profile_and_name')
     def get_by_profile_and_name(cls, profile, name):
-        """Get a collection by name and user"""
-        return Collection.get_or_insert(
-            parent=profile,
-            key_name=cls.build_key_name(name),
-            profile=profile,
-            name=name
+        """Get a collection by name and user, creating it if necessary"""
+        c = context.get(cls, cls.build_key(profile, name))
+        if c is None:
+            c = Collection.get_or_insert(
+                parent=profile,
+                key_name=cls.build_key_name(name),
+                profile=profile,
+                name=name
+            )
+            context.remember_entity(c)
+        cls.note_known(c.key())
+        return c
+
+    @classmethod
+    @traced('Collection.lookup_by_profile_and_name')
+    def lookup_by_profile_and_name(cls, profile, name):
+        """Get an existing collection by name and user, or None. Unlike
+        get_by_profile_and_name, this never creates the collection."""
+        key = cls.build_key(profile, name)
+        if cls.is_known(key):
+            # Known to exist, so build it from its key without a lookup.
+            return context.memo(('entity', str(key)), lambda: Collection(
+                parent=profile, key_name=key.name(),
+                profile=profile, name=name
+            ))
+        c = context.get(cls, key)
+        if c: cls.note_known(key)
+        return c
+
+    @classmethod
+    def is_known(cls, key):
+        """Determine whether a collection key is known to exist, as of its
+        current write generation"""
+        known_collections_lock.acquire()
+        try:
+            names = known_collections.get(str(key.parent()))
+            gen = names and names.get(key.name())
+        finally:
+            known_collections_lock.release()
+        if gen is None:
+            return False
+        if gen == cls.get_generation_by_key(key):
+            return True
+        # Written since, perhaps deleted by another instance
+        cls.forget_known(key)
+        return False
+
+    @classmethod
+    def note_known(cls, key, gen=None):
+        """Remember that a collection key is known to exist, as of its
+        current write generation or the one given"""
+        if gen is None:
+            gen = cls.get_generation_by_key(key)
+        profile_key = str(key.parent())
+        known_collections_lock.acquire()
+        try:
+            if profile_key not in known_collections:
+                if len(known_collections) >= KNOWN_COLLECTIONS_MAX_PROFILES:
+                    known_collections.clear()
+                known_collections[profile_key] = {}
+            known_collections[profile_key][key.name()] = gen
+        finally:
+            known_collections_lock.release()
+
+    @classmethod
+    def forget_known(cls, key):
+        """Forget that a collection key is known to exist"""
+        known_collections_lock.acquire()
+        try:
+            names = known_collections.get(str(key.parent()))
+            if names: names.pop(key.name(), None)
+        finally:
+            known_collections_lock.release()
+
+    def get_modified(self):
+        """Get the last modified time for this collection"""
+        if self.modified is None:
+            # Collections stored before modified times were maintained
+            w = WBO.all().ancestor(self).order('-modified').get()
+            return w and w.modified or 0
+        return self.modified
+
+    @classmethod
+    def build_key(cls, profile, name):
+        """Build the key for a named collection, without a datastore hit"""
+        return db.Key.from_path(
+            cls.kind(), cls.build_key_name(name), parent=profile.key()
         )
 
+    @classmethod
+    def build_modified_cache_key(cls, key):
+        return 'fxsync.modified:%s' % key
+
+    @classmethod
+    def build_timestamps_cache_key(cls, profile_key):
+        return 'fxsync.timestamps:%s' % profile_key
+
+    @classmethod
+    def get_modified_by_profile_and_name(cls, profile, name):
+        """Get the last modified time for a collection, from cache if
+        possible, without loading or creating the collection otherwise"""
+        return cls.get_modified_by_key(cls.build_key(profile, name))
+
+    @classmethod
+    def get_modified_by_key(cls, key):
+        """Get the last modified time for a collection key, from cache if
+        possible"""
+        cache_key = cls.build_modified_cache_key(key)
+        modified = memcache.get(cache_key)
+        if modified is None:
+            c = context.get(cls, key)
+            modified = c and c.get_modified() or 0
+            # Only fill a miss, so a read begun before a write can't
+            # overwrite the time the writer cached.
+            memcache.add(cache_key, modified, time=METADATA_CACHE_TIME)
+        return modified
+
+    @classmethod
+    def note_write(cls, key, modified):
+        """Update cached metadata after the contents of a collection have
+        changed, given the new modified time (or None, if deleted)"""
+        cache_key = cls.build_modified_cache_key(key)
+        if modified is None:
+            # Cache the deletion rather than clearing the key, so that a
+            # racing reader can't fill it with the old time.
+            context.forget(('entity', str(key)))
+            memcache.set(cache_key, 0, time=METADATA_CACHE_TIME)
+        else:
+            # Only ever raise the cached time, so that the note of a write
+            # overtaken by a later one can't move it backwards.
+            client = memcache.Client()
+            for attempt in range(CAS_ATTEMPTS):
+                cached = client.gets(cache_key)
+                if cached is None:
+                    if client.add(cache_key, modified,
+                            time=METADATA_CACHE_TIME):
+                        break
+                elif cached >= modified:
+                    break
+                elif client.cas(cache_key, modified,
+                        time=METADATA_CACHE_TIME):
+                    break
+            else:
+                # Too contended, so leave it to be filled from storage
+                memcache.delete(cache_key)
+        memcache.delete(cls.build_timestamps_cache_key(key.parent()))
+        gen = cls.bump_generation(key)
+        if modified is not None and gen is not None:
+            # Just written here, so still known as of the new generation
+            cls.note_known(key, gen)
+
+    @classmethod
+    def build_generation_cache_key(cls, key):
+        return 'fxsync.generation:%s' % key
+
+    @classmethod
+    def bump_generation(cls, key):
+        """Advance the write generation for a collection key, orphaning
+        any cached retrieval results for the previous generation"""
+        # If the counter was evicted, incr does nothing and the next
+        # get_generation() seeds a fresh one.
+        return memcache.incr(cls.build_generation_cache_key(key))
+
     @classmethod
     def is_builtin(cls, name):
         """Determine whether a named collection is built-in"""
@@ -206,11 +599,14 @@ class Collection(db.Model):
     @classmethod
     def get_timestamps(cls, profile):
         """Assemble last modified for user's built-in and ad-hoc collections"""
-        c_list = dict((n, 0) for n in cls.builtin_names)
-        q = Collection.all().ancestor(profile)
-        for c in q:
-            w = WBO.all().ancestor(c).order('-modified').get()
-            c_list[c.name] = w and w.modified or 0
+        cache_key = cls.build_timestamps_cache_key(profile.key())
+        c_list = memcache.get(cache_key)
+        if c_list is None:
+            c_list = dict((n, 0) for n in cls.builtin_names)
+            q = Collection.all().ancestor(profile)
+            for c in q:
+                c_list[c.name] = c.get_modified()
+            memcache.add(cache_key, c_list, time=METADATA_CACHE_TIME)
         return c_list 
 
     @classmethod
@@ -222,7 +618,7 @@ class Collection(db.Model):
             c_list[c.name] = WBO.all().ancestor(c).count()
         return c_list 
 
-class WBO(db.Model):
+class WBO(StoredModel, db.Model):
     collection      = db.ReferenceProperty(Collection, required=True)
     wbo_id          = db.StringProperty(required=True)
     modified        = db.FloatProperty(required=True)
@@ -235,6 +631,14 @@ class WBO(db.Model):
     # TODO: Move this to config somewhere
     WEAVE_PAYLOAD_MAX_SIZE = 262144 
 
+    def put(self):
+        """Store this WBO, noting the write against its collection"""
+        return self.collection.put_wbos([self])[0]
+
+    def delete(self):
+        """Delete this WBO, noting the write against its collection"""
+        self.collection.delete_wbos([self])
+
     def to_dict(self):
         """Produce a dict representation, usable for JSON response"""
         wbo_data = dict( (k,getattr(self, k)) for k in ( 
@@ -319,13 +723,19 @@ class WBO(db.Model):
 
     @classmethod
     def exists_by_collection_and_wbo_id(cls, collection, wbo_id):
-        """Get a WBO by wbo_id"""
-        return WBO.all().ancestor(collection).filter('wbo_id =', wbo_id).count() > 0
+        """Determine whether a WBO exists by wbo_id"""
+        return context.memo(
+            ('wbo_exists', str(collection.key()), wbo_id),
+            lambda: WBO.all().ancestor(collection)
+                .filter('wbo_id =', wbo_id).count(1) > 0
+        )
 
     @classmethod
-    def validate(cls, wbo_data):
-        """Validate the contents of this WBO"""
+    def validate(cls, wbo_data, exists=None):
+        """Validate the contents of this WBO. Parent and predecessor WBOs
+        are looked up with exists(collection, wbo_id), by default a query."""
         errors = []
+        if exists is None: exists = cls.exists_by_collection_and_wbo_id
 
         if 'id' in wbo_data:
             wbo_data['wbo_id'] = wbo_data['id']
@@ -343,14 +753,14 @@ class WBO(db.Model):
             if (len(wbo_data['parentid']) > 64):
                 errors.append('invalid parentid')
             elif 'collection' in wbo_data:
-                if not cls.exists_by_collection_and_wbo_id(wbo_data['collection'], wbo_data['parentid']):
+                if not exists(wbo_data['collection'], wbo_data['parentid']):
                     errors.append('invalid parentid')
 
         if ('predecessorid' in wbo_data):
             if (len(wbo_data['predecessorid']) > 64):
                 errors.append('invalid predecessorid')
             elif 'collection' in wbo_data:
-                if not cls.exists_by_collection_and_wbo_id(wbo_data['collection'], wbo_data['predecessorid']):
+                if not exists(wbo_data['collection'], wbo_data['predecessorid']):
                     errors.append('invalid predecessorid')
 
         if 'modified' not in wbo_data or not wbo_data['modified']:
@@ -0,0 +1,284 @@
+"""
+Asynchronous model classes for fxsync, built on ndb
+
+An alternative to fxsync.models over the same datastore entities. ndb
+batches concurrent gets and puts automatically and caches entities in a
+per-request context, while the *_async methods return futures so that
+callers can overlap auth, collection resolution and record fetches, eg.
+
+    profile_f = Profile.authenticate_async(user_name, password)
+    ...
+    collection = yield Collection.lookup_by_profile_and_name_async(
+        (yield profile_f).key, name
+    )
+
+Writes note themselves against the same cached collection metadata as
+fxsync.models, so the two layers can be mixed freely.
+"""
+import sys, os
+base_dir = os.path.dirname( os.path.dirname(__file__) )
+sys.path.extend([ os.path.join(base_dir, d) for d in ( 'lib', 'extlib' ) ])
+
+from google.appengine.ext import ndb
+from fxsync import models
+from fxsync.models import paginate, WBO_PAGE_SIZE
+
+def to_ndb_key(entity_or_key):
+    """Get an ndb key for an entity or key from either model layer"""
+    if isinstance(entity_or_key, ndb.Key):
+        return entity_or_key
+    if isinstance(entity_or_key, ndb.Model):
+        return entity_or_key.key
+    if isinstance(entity_or_key, models.db.Model):
+        entity_or_key = entity_or_key.key()
+    return ndb.Key.from_old_key(entity_or_key)
+
+class Profile(ndb.Model):
+    """Sync profile associated with logged in account"""
+    # fxsync.models writes these entities too, so ndb must not cache them
+    # anywhere that outlives the request.
+    _use_memcache = False
+
+    user        = ndb.UserProperty()
+    user_name   = ndb.StringProperty(required=True)
+    user_id     = ndb.StringProperty(required=True)
+    password    = ndb.StringProperty(required=True)
+    created_at  = ndb.DateTimeProperty(auto_now_add=True)
+    updated_at  = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def get_by_user_name_async(cls, user_name):
+        """Get a profile by user name"""
+        return cls.query(cls.user_name == user_name).get_async()
+
+    @classmethod
+    @ndb.tasklet
+    def authenticate_async(cls, user_name, password):
+        """Attempt to authenticate the given user name and password,
+        resolving to the profile if successful or None otherwise"""
+        profile = yield cls.get_by_user_name_async(user_name)
+        if profile and profile.password == password:
+            raise ndb.Return(profile)
+        raise ndb.Return(None)
+
+class Collection(ndb.Model):
+    _use_memcache = False
+
+    profile  = ndb.KeyProperty(kind='Profile', required=True)
+    name     = ndb.StringProperty(required=True)
+    modified = ndb.FloatProperty()
+
+    @classmethod
+    def build_key(cls, profile_key, name):
+        return ndb.Key(cls, models.Collection.build_key_name(name),
+            parent=to_ndb_key(profile_key))
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_profile_and_name_async(cls, profile_key, name):
+        """Get a collection by name and user, creating it if necessary"""
+        profile_key = to_ndb_key(profile_key)
+        c = yield cls.get_or_insert_async(
+            models.Collection.build_key_name(name),
+            parent=profile_key, profile=profile_key, name=name
+        )
+        models.Collection.note_known(c.key.to_old_key())
+        raise ndb.Return(c)
+
+    @classmethod
+    def lookup_by_profile_and_name_async(cls, profile_key, name):
+        """Get an existing collection by name and user, resolving to None
+        if it does not exist"""
+        return cls.build_key(profile_key, name).get_async()
+
+    @ndb.tasklet
+    def put_wbos_async(self, wbos):
+        """Store a list of WBOs in this collection"""
+        self.modified = max(w.modified for w in wbos)
+        keys = yield ndb.put_multi_async([self] + list(wbos))
+        models.Collection.note_write(self.key.to_old_key(), self.modified)
+        raise ndb.Return(keys[1:])
+
+    @ndb.tasklet
+    def delete_wbos_async(self, wbo_keys):
+        """Delete a list of WBO keys from this collection"""
+        self.modified = models.WBO.get_time_now()
+        yield ndb.delete_multi_async(wbo_keys) + [ self.put_async() ]
+        models.Collection.note_write(self.key.to_old_key(), self.modified)
+
+    @ndb.tasklet
+    def retrieve_async(self,
+            full=None, wbo=None, count=None, direct_output=None,
+            id=None, ids=None,
+            parentid=None, predecessorid=None,
+            newer=None, older=None,
+            index_above=None, index_below=None,
+            sort=None, limit=None, offset=None):
+        """Filtered retrieval of WBOs, accepting the same parameters as
+        fxsync.models.Collection.retrieve"""
+
+        limit  = (limit is not None) and limit or 1000
+        offset = (offset is not None) and offset or 0
+        sort   = (sort is not None) and sort or 'index'
+
+        if id:
+            if count: raise ndb.Return(1)
+            w = yield WBO.query(WBO.wbo_id == id, ancestor=self.key).get_async()
+            raise ndb.Return(WBO.format_results([ w ], full, wbo))
+
+        elif ids:
+            if count: raise ndb.Return(len(ids))
+            # Fetch all the pages of IDs concurrently
+            pages = yield [
+                WBO.query(WBO.wbo_id.IN(id_page), ancestor=self.key)
+                    .fetch_async(WBO_PAGE_SIZE)
+                for id_page in paginate(ids, WBO_PAGE_SIZE)
+            ]
+            wbos = [ w for page in pages for w in page ]
+            raise ndb.Return(WBO.format_results(wbos, full, wbo))
+
+        queries = []
+
+        if parentid is not None:
+            queries.append(WBO.query(WBO.parentid == parentid,
+                ancestor=self.key))
+
+        if predecessorid is not None:
+            queries.append(WBO.query(WBO.predecessorid == predecessorid,
+                ancestor=self.key))
+
+        if index_above is not None or index_below is not None:
+            q = WBO.query(ancestor=self.key)
+            if index_above: q = q.filter(WBO.sortindex > index_above)
+            if index_below: q = q.filter(WBO.sortindex < index_below)
+            queries.append(q.order(WBO.sortindex))
+
+        if newer is not None or older is not None:
+            q = WBO.query(ancestor=self.key)
+            if newer: q = q.filter(WBO.modified > newer)
+            if older: q = q.filter(WBO.modified < older)
+            queries.append(q.order(WBO.modified))
+
+        if 'oldest' == sort: order = WBO.modified
+        elif 'newest' == sort: order = -WBO.modified
+        else: order = -WBO.sortindex
+
+        if len(queries) <= 1:
+            q = queries and queries[0] or WBO.query(ancestor=self.key)
+            q = q.order(order)
+            if count:
+                raise ndb.Return((yield q.count_async()))
+            wbos = yield q.fetch_async(limit, offset=offset)
+            raise ndb.Return(WBO.format_results(wbos, full, wbo))
+
+        # Run all the criteria queries concurrently, intersect the keys in
+        # memory, then batch get and sort the survivors.
+        key_lists = yield [ q.fetch_async(keys_only=True) for q in queries ]
+        key_set = set(key_lists[0])
+        for keys in key_lists[1:]:
+            key_set &= set(keys)
+        if count:
+            raise ndb.Return(len(key_set))
+
+        wbos = yield ndb.get_multi_async(list(key_set))
+        wbos = [ w for w in wbos if w is not None ]
+        if 'oldest' == sort: wbos.sort(key=lambda w: w.modified)
+        elif 'newest' == sort: wbos.sort(key=lambda w: -w.modified)
+        else: wbos.sort(key=lambda w: -(w.sortindex or 0))
+        wbos = wbos[offset:offset + limit]
+        raise ndb.Return(WBO.format_results(wbos, full, wbo))
+
+class WBO(ndb.Model):
+    _use_memcache = False
+
+    collection      = ndb.KeyProperty(kind='Collection', required=True)
+    wbo_id          = ndb.StringProperty(required=True)
+    modified        = ndb.FloatProperty(required=True)
+    parentid        = ndb.StringProperty()
+    predecessorid   = ndb.StringProperty()
+    sortindex       = ndb.IntegerProperty(default=0)
+    payload         = ndb.TextProperty(required=True)
+    payload_size    = ndb.IntegerProperty(default=0)
+
+    def to_dict(self):
+        """Produce a dict representation, usable for JSON response"""
+        wbo_data = dict( (k,getattr(self, k)) for k in (
+            'sortindex', 'parentid', 'predecessorid',
+            'payload', 'payload_size', 'modified'
+        ) if getattr(self, k))
+        wbo_data['id'] = self.wbo_id
+        return wbo_data
+
+    @classmethod
+    def format_results(cls, wbos, full=None, wbo=None):
+        """Produce WBOs, dicts or IDs, as for Collection.retrieve"""
+        if wbo: return wbos
+        if full: return [ w.to_dict() for w in wbos ]
+        return [ w.wbo_id for w in wbos ]
+
+    @classmethod
+    @ndb.tasklet
+    def exists_by_collection_and_wbo_id_async(cls, collection, wbo_id):
+        """Determine whether a WBO exists by wbo_id"""
+        key = yield cls.query(cls.wbo_id == wbo_id,
+            ancestor=to_ndb_key(collection)).get_async(keys_only=True)
+        raise ndb.Return(key is not None)
+
+    @classmethod
+    @ndb.tasklet
+    def validate_async(cls, wbo_data):
+        """Validate the contents of a WBO, as fxsync.models.WBO.validate
+        does, but looking up parent and predecessor concurrently"""
+        collection = wbo_data.get('collection', None)
+        ref_ids = []
+        if collection:
+            ref_ids = [ wbo_data[k] for k in ('parentid', 'predecessorid')
+                if k in wbo_data and len(wbo_data[k]) <= 64 ]
+        found = yield [
+            cls.exists_by_collection_and_wbo_id_async(collection, ref_id)
+            for ref_id in ref_ids
+        ]
+        known = dict(zip(ref_ids, found))
+        raise ndb.Return(models.WBO.validate(wbo_data,
+            exists=lambda c, wbo_id: known.get(wbo_id, False)))
+
+    @classmethod
+    @ndb.tasklet
+    def from_json_async(cls, data_in):
+        """Build a WBO from decoded JSON, as fxsync.models.WBO.from_json
+        does, resolving to a (wbo, errors) tuple"""
+        if 'collection' not in data_in:
+            if 'user_name' in data_in:
+                data_in['profile'] = yield Profile.get_by_user_name_async(
+                    data_in.pop('user_name')
+                )
+            if 'collection_name' in data_in:
+                data_in['collection'] = yield \
+                    Collection.get_by_profile_and_name_async(
+                        data_in.pop('profile'), data_in.pop('collection_name')
+                    )
+
+        if 'id' in data_in:
+            data_in['wbo_id'] = data_in.pop('id')
+
+        wbo_data = dict((k,data_in[k]) for k in (
+            'sortindex', 'parentid', 'predecessorid', 'payload',
+        ) if (k in data_in))
+
+        collection = data_in['collection']
+        wbo_data.update({
+            'collection': collection,
+            'modified': models.WBO.get_time_now(),
+            'wbo_id': data_in['wbo_id'],
+        })
+
+        if 'payload' in wbo_data:
+            wbo_data['payload_size'] = len(wbo_data['payload'])
+
+        errors = yield cls.validate_async(wbo_data)
+        if len(errors) > 0: raise ndb.Return((None, errors))
+
+        wbo_data['collection'] = collection.key
+        wbo = cls(id=models.WBO.build_key_name(wbo_data),
+            parent=collection.key, **wbo_data)
+        raise ndb.Return((wbo, errors))
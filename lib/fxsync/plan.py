@@ -0,0 +1,61 @@
+"""
+Record of how a collection retrieval was carried out
+
+A RetrievePlan passed to Collection.retrieve collects a step for each
+lookup, index selection or query it runs, with the rows each scanned and
+returned. Handlers mark the end of each phase of a request, so the plan
+also shows where the time went. Results of retrieve are partly lazy, so
+time spent loading entities may show up in a later phase, like encoding.
+
+Queries note the rows they are estimated to match only when the plan asks
+for estimates, as for explain, since each costs a bounded count query.
+"""
+import time
+
+class RetrievePlan(object):
+    """Steps and phase timings of a retrieval"""
+
+    def __init__(self, estimate=False):
+        self.estimate = estimate
+        self.params = None
+        self.strategy = None
+        self.steps = []
+        self.phases = []
+        self.start = self.last_mark = time.time()
+
+    def step(self, name, start=None, **details):
+        """Note a step of the retrieval, eg. a query and its row counts,
+        along with its time if begun at start. Details given as None are
+        left out."""
+        details = dict( (k, v) for k, v in details.items() if v is not None )
+        details['step'] = name
+        if start is not None:
+            details['ms'] = round((time.time() - start) * 1000.0, 3)
+        self.steps.append(details)
+        return details
+
+    def mark(self, phase):
+        """Note the end of a phase, begun at the end of the previous one"""
+        now = time.time()
+        self.phases.append((phase, (now - self.last_mark) * 1000.0))
+        self.last_mark = now
+
+    def elapsed(self):
+        return (time.time() - self.start) * 1000.0
+
+    def rows(self):
+        """Total rows scanned and returned over all steps"""
+        return (sum(s.get('scanned', 0) for s in self.steps),
+            sum(s.get('returned', 0) for s in self.steps))
+
+    def as_dict(self):
+        scanned, returned = self.rows()
+        return {
+            'params': self.params,
+            'strategy': self.strategy,
+            'steps': self.steps,
+            'phases': [ { 'phase': name, 'ms': round(ms, 3) }
+                for name, ms in self.phases ],
+            'scanned': scanned,
+            'returned': returned,
+        }
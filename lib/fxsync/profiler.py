@@ -0,0 +1,137 @@
+"""
+Profiling of single requests on demand
+
+Requests from admins with an X-Fxsync-Profile header are run under
+cProfile by ProfileMiddleware. The stats are stored under the request's
+id, given in an X-Fxsync-Profile-Id response header, and can be
+downloaded from /sync/admin/profiles/<id>, either in the marshalled
+format read by pstats or as collapsed stacks for flamegraph.pl.
+
+Stats are kept in memcache for PROFILE_CACHE_TIME on App Engine, and in
+process for the last MAX_PROFILES requests with FXSYNC_METRICS=local.
+Requests without the header only pay for checking it.
+"""
+import os, time, uuid, zlib, marshal, cProfile, threading, logging
+from collections import OrderedDict
+from google.appengine.api import memcache
+from google.appengine.ext import webapp
+from fxsync import metrics
+from fxsync.utils import is_admin
+
+PROFILE_HEADER = 'HTTP_X_FXSYNC_PROFILE'
+PROFILE_ID_HEADER = 'X-Fxsync-Profile-Id'
+
+CACHE_PREFIX = 'profile:'
+PROFILE_CACHE_TIME = 86400
+MAX_PROFILES = 20
+
+# Calls deeper than this are left out of collapsed stacks
+MAX_STACK_DEPTH = 100
+
+profiles = OrderedDict()
+profiles_lock = threading.Lock()
+
+class ProfileMiddleware(object):
+    """WSGI middleware profiling requests which ask for it"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if not environ.get(PROFILE_HEADER):
+            return self.app(environ, start_response)
+        if not is_admin(webapp.Request(environ)):
+            logging.warning('Ignored profile request from non-admin')
+            return self.app(environ, start_response)
+
+        profile_id = (os.environ.get('REQUEST_LOG_ID') or
+            uuid.uuid4().hex)
+
+        def profile_start_response(status, headers, exc_info=None):
+            headers = list(headers) + [ (PROFILE_ID_HEADER, profile_id) ]
+            return start_response(status, headers, exc_info)
+
+        profile = cProfile.Profile()
+        try:
+            # Run the whole body under the profiler, in case it is lazy
+            return profile.runcall(lambda: list(
+                self.app(environ, profile_start_response)))
+        finally:
+            profile.create_stats()
+            save(profile_id, {
+                'time': time.time(),
+                'method': environ.get('REQUEST_METHOD'),
+                'path': environ.get('PATH_INFO'),
+                'stats': profile.stats,
+            })
+
+def save(profile_id, data):
+    """Store the stats and description of a profiled request"""
+    if 'memcache' != metrics.mode:
+        profiles_lock.acquire()
+        try:
+            profiles[profile_id] = data
+            while len(profiles) > MAX_PROFILES:
+                profiles.popitem(last=False)
+        finally:
+            profiles_lock.release()
+        return
+    try:
+        memcache.set(CACHE_PREFIX + profile_id,
+            zlib.compress(marshal.dumps(data)), time=PROFILE_CACHE_TIME)
+    except Exception, e:
+        # Including values too large for memcache
+        logging.warning('Failed to save profile %s: %s' % (profile_id, e))
+
+def load(profile_id):
+    """Get the stats and description of a profiled request, if kept"""
+    if 'memcache' != metrics.mode:
+        return profiles.get(profile_id)
+    value = memcache.get(CACHE_PREFIX + profile_id)
+    return value and marshal.loads(zlib.decompress(value)) or None
+
+def dump_stats(stats):
+    """Encode stats in the format of pstats.Stats.dump_stats"""
+    return marshal.dumps(stats)
+
+def collapse_stacks(stats):
+    """Convert stats to collapsed stacks with microseconds of own time,
+    one per line, eg. "main.py:10(get);models.py:20(retrieve) 1234"
+
+    cProfile only records callers one level up, so the time of a function
+    is shared among the stacks it appears in according to the time it
+    spent under each of its callers."""
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge))
+
+    totals = {}
+    def walk(func, stack, funcs, tt, ct):
+        stack = stack + [ frame_name(func) ]
+        key = ';'.join(stack)
+        totals[key] = totals.get(key, 0.0) + tt
+        total_ct = stats[func][3]
+        if not total_ct or len(stack) >= MAX_STACK_DEPTH:
+            return
+        share = ct / total_ct
+        for callee, (nc, cc, edge_tt, edge_ct) in callees.get(func, ()):
+            # Recursion is folded into the outermost call
+            if callee not in funcs and edge_ct * share >= 0.000001:
+                walk(callee, stack, funcs | set([ callee ]),
+                    edge_tt * share, edge_ct * share)
+
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        if not callers:
+            walk(func, [], set([ func ]), tt, ct)
+
+    return ''.join('%s %d\n' % (stack, int(seconds * 1000000))
+        for stack, seconds in sorted(totals.items())
+        if int(seconds * 1000000))
+
+def frame_name(func):
+    filename, line, name = func
+    if '~' == filename:
+        # Built-in functions have no file
+        return name
+    return '%s:%d(%s)' % (os.path.basename(filename), line, name)
@@ -0,0 +1,126 @@
+"""
+Continuous sampling of the stacks of requests, by route
+
+Once start() is called, a background thread looks at the stack of every
+thread serving a request RATE times a second, and counts each stack seen
+under the route of the request. The counts are exported as collapsed
+stacks, each headed by its route, at /sync/admin/samples for
+flamegraph.pl.
+
+App Engine frontend instances can't keep background threads, so only the
+standalone server starts sampling, with --sample-rate or
+FXSYNC_SAMPLE_RATE. While sampling is off, SamplerMiddleware passes
+requests straight through.
+"""
+import os, sys, thread, threading, logging
+from fxsync import metrics
+
+RATE = float(os.environ.get('FXSYNC_SAMPLE_RATE', 0) or 0)
+
+# Frames nearest the top of the stack kept in each sample
+MAX_DEPTH = 64
+
+# Thread id -> (route, frame of SamplerMiddleware) of requests in progress
+active = {}
+
+sampler = None
+
+class Sampler(object):
+    """Background thread counting the stacks of requests in progress"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run,
+            name='fxsync-sampler')
+        self.thread.setDaemon(True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.sample()
+            except Exception, e:
+                logging.warning('Failed to sample stacks: %s' % e)
+
+    def sample(self):
+        frames = sys._current_frames()
+        samples = []
+        for ident, (route, top) in active.items():
+            frame = frames.get(ident)
+            stack = []
+            # Frames from the server down to the middleware are the same
+            # in every sample, so leave them out.
+            while frame is not None and frame is not top:
+                if len(stack) < MAX_DEPTH:
+                    code = frame.f_code
+                    stack.append('%s:%s' % (
+                        os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack.append(route)
+            stack.reverse()
+            samples.append(';'.join(stack))
+        self.lock.acquire()
+        try:
+            for stack in samples:
+                self.counts[stack] = self.counts.get(stack, 0) + 1
+        finally:
+            self.lock.release()
+
+    def collapsed(self, route=None, clear=False):
+        """Get counts of stacks in the collapsed format, optionally only
+        those of one route, and clearing the counts"""
+        self.lock.acquire()
+        try:
+            counts = self.counts
+            if clear:
+                self.counts = {}
+        finally:
+            self.lock.release()
+        prefix = route and route + ';' or ''
+        return ''.join('%s %d\n' % (stack, count)
+            for stack, count in sorted(counts.items())
+            if stack.startswith(prefix))
+
+def start(rate=RATE):
+    """Start sampling, at rate samples a second"""
+    global sampler
+    if sampler is None and rate > 0:
+        sampler = Sampler(rate)
+        sampler.start()
+    return sampler
+
+def stop():
+    global sampler
+    if sampler is not None:
+        sampler.stop()
+        sampler = None
+
+class SamplerMiddleware(object):
+    """WSGI middleware noting the route of each request on its thread, for
+    the sampler to attribute stacks to"""
+
+    def __init__(self, app, api, routes):
+        self.app = app
+        self.api = api
+        self.routes = metrics.compile_routes(routes)
+
+    def __call__(self, environ, start_response):
+        if sampler is None:
+            return self.app(environ, start_response)
+        route, collection = metrics.match_route(self.routes,
+            environ.get('PATH_INFO', ''))
+        ident = thread.get_ident()
+        active[ident] = ('%s.%s' % (self.api, route), sys._getframe())
+        try:
+            return self.app(environ, start_response)
+        finally:
+            del active[ident]
@@ -0,0 +1,265 @@
+"""
+Threaded WSGI server for running fxsync outside App Engine
+
+Connections are handed to a fixed pool of worker threads, which serve
+HTTP/1.1 keep-alive connections until the client closes them or they sit
+idle past a timeout. Between requests, idle connections wait on a thread
+of their own, which hands each back to the pool once its next request
+arrives, so that idle clients don't hold up workers. stop() stops
+accepting connections, lets in-flight requests finish, and closes the
+rest.
+"""
+import os, socket, select, threading, time, Queue
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+
+WORKERS = 16
+KEEP_ALIVE_TIMEOUT = 15
+SHUTDOWN_TIMEOUT = 30
+
+class RequestBody(object):
+    """The request body as wsgi.input, limited to Content-Length, so that
+    whatever the app leaves unread can be skipped before the next request
+    on the connection"""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def drain(self):
+        while self.remaining > 0 and self.read(65536):
+            pass
+
+class KeepAliveServerHandler(ServerHandler):
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        request_handler = self.request_handler
+        # Without a length, only closing the connection ends the response.
+        if 'Content-Length' not in self.headers:
+            request_handler.close_connection = 1
+        if request_handler.server.stopping:
+            request_handler.close_connection = 1
+        if request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+        elif request_handler.request_version == 'HTTP/1.0':
+            self.headers['Connection'] = 'keep-alive'
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """Request handler serving any number of requests on a connection"""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        WSGIRequestHandler.setup(self)
+        if self.server.keep_alive_timeout:
+            self.connection.settimeout(self.server.keep_alive_timeout)
+
+    def handle(self):
+        self.close_connection = 1
+        self.parked = False
+        self.handle_one_request()
+        # Requests already read off the socket can only be served here,
+        # but otherwise the connection waits for the next one without
+        # holding a worker.
+        while not self.close_connection and self.buffered():
+            self.handle_one_request()
+        self.parked = not self.close_connection
+
+    def buffered(self):
+        """Whether anything more has been read into the buffer of rfile"""
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        if rbuf is None:
+            # Can't tell, so keep serving the connection here
+            return True
+        return rbuf.tell() > 0
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, socket.error):
+            self.close_connection = 1
+            return
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if not self.parse_request():
+            return
+        if not self.server.keep_alive_timeout:
+            self.close_connection = 1
+
+        environ = self.get_environ()
+        body = RequestBody(self.rfile, int(environ.get('CONTENT_LENGTH') or 0))
+        handler = KeepAliveServerHandler(body, self.wfile,
+            self.get_stderr(), environ, multithread=True)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        body.drain()
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            WSGIRequestHandler.log_message(self, format, *args)
+
+class IdleConnections(object):
+    """Thread waiting on idle keep-alive connections, handing each back to
+    the server's workers once readable, and closing those left idle past
+    the timeout"""
+
+    def __init__(self, server, timeout):
+        self.server = server
+        self.timeout = timeout
+        # Socket -> (client address, time to close it by)
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.stopping = False
+        # Written to wake the thread for a newly parked connection
+        self.wake_r, self.wake_w = os.pipe()
+        self.thread = threading.Thread(target=self.loop,
+            name='idle-connections')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def park(self, request, client_address):
+        if self.stopping:
+            self.server.shutdown_request(request)
+            return
+        self.lock.acquire()
+        try:
+            self.idle[request] = (client_address, time.time() + self.timeout)
+        finally:
+            self.lock.release()
+        os.write(self.wake_w, '.')
+
+    def stop(self):
+        """Close every idle connection, and end the thread"""
+        self.stopping = True
+        os.write(self.wake_w, '.')
+        self.thread.join()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def loop(self):
+        while not self.stopping:
+            self.lock.acquire()
+            try:
+                idle = dict(self.idle)
+            finally:
+                self.lock.release()
+            wait = min([ deadline for a, deadline in idle.values() ] +
+                [ time.time() + self.timeout ]) - time.time()
+            try:
+                readable = select.select(idle.keys() + [ self.wake_r ],
+                    [], [], max(0, wait))[0]
+            except (select.error, socket.error):
+                # Interrupted by a signal
+                continue
+            if self.wake_r in readable:
+                os.read(self.wake_r, 4096)
+            now = time.time()
+            for request, (client_address, deadline) in idle.items():
+                ready = request in readable
+                if not ready and deadline > now:
+                    continue
+                self.lock.acquire()
+                try:
+                    del self.idle[request]
+                finally:
+                    self.lock.release()
+                if ready:
+                    # Including the client having closed the connection,
+                    # which the worker finds on reading
+                    self.server.connections.put((request, client_address))
+                else:
+                    self.server.shutdown_request(request)
+        self.lock.acquire()
+        try:
+            for request in self.idle:
+                self.server.shutdown_request(request)
+            self.idle.clear()
+        finally:
+            self.lock.release()
+
+class PooledWSGIServer(WSGIServer):
+    """WSGI server with a fixed pool of worker threads"""
+    request_queue_size = 128
+    daemon_threads = True
+
+    def __init__(self, address, app, workers=WORKERS,
+            keep_alive_timeout=KEEP_ALIVE_TIMEOUT, quiet=False):
+        WSGIServer.__init__(self, address, KeepAliveRequestHandler)
+        self.set_app(app)
+        self.keep_alive_timeout = keep_alive_timeout
+        self.quiet = quiet
+        self.stopping = False
+        self.idle = None
+        if keep_alive_timeout:
+            self.idle = IdleConnections(self, keep_alive_timeout)
+        # Bounded, so that a burst of connections waits in the listen
+        # backlog rather than piling up here.
+        self.connections = Queue.Queue(workers)
+        self.workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self.work, name='worker-%s' % i)
+            t.setDaemon(self.daemon_threads)
+            t.start()
+            self.workers.append(t)
+
+    def process_request(self, request, client_address):
+        self.connections.put((request, client_address))
+
+    def work(self):
+        """Serve connections from the queue until given None"""
+        while True:
+            item = self.connections.get()
+            if item is None:
+                break
+            request, client_address = item
+            parked = False
+            try:
+                handler = self.finish_request(request, client_address)
+                parked = getattr(handler, 'parked', False)
+            except:
+                self.handle_error(request, client_address)
+            if parked and self.idle is not None:
+                self.idle.park(request, client_address)
+            else:
+                self.shutdown_request(request)
+
+    def finish_request(self, request, client_address):
+        """Serve a connection, returning its request handler"""
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def stop(self, timeout=SHUTDOWN_TIMEOUT):
+        """Stop serving, waiting up to timeout seconds for workers to
+        finish their in-flight requests. Call from a thread other than the
+        one running serve_forever()."""
+        self.stopping = True
+        self.shutdown()
+        if self.idle is not None:
+            self.idle.stop()
+        for t in self.workers:
+            self.connections.put(None)
+        deadline = time.time() + timeout
+        for t in self.workers:
+            t.join(max(0, deadline - time.time()))
+        self.server_close()
+        return not [ t for t in self.workers if t.isAlive() ]
@@ -0,0 +1,84 @@
+"""
+Sampling of slow collection requests
+
+Handler methods decorated with sample_slow get a RetrievePlan as
+self.plan, to pass to Collection.retrieve and mark phases on. Requests
+taking longer than THRESHOLD_MS are recorded with their retrieval
+parameters, plan and storage call tallies, in a ring buffer of the last
+RING_SIZE records, which admins can browse at /sync/admin/slow.
+
+Records are kept wherever metrics are: in a ring of memcache slots shared
+by all instances on App Engine, in process with FXSYNC_METRICS=local, and
+not at all with FXSYNC_METRICS=off. The threshold can be set in
+milliseconds with FXSYNC_SLOW_MS.
+"""
+import os, time, threading, logging
+from collections import deque
+from google.appengine.api import memcache
+from fxsync import metrics
+from fxsync.plan import RetrievePlan
+from fxsync.storage import instrument
+
+THRESHOLD_MS = float(os.environ.get('FXSYNC_SLOW_MS', 1000))
+RING_SIZE = 100
+
+CACHE_PREFIX = 'slowlog:'
+NEXT_KEY = 'next'
+
+ring = deque(maxlen=RING_SIZE)
+ring_lock = threading.Lock()
+
+def sample_slow(func):
+    """Decorator recording calls to a handler method that run slow"""
+    def cb(wh, *args, **kwargs):
+        wh.plan = RetrievePlan()
+        try:
+            return func(wh, *args, **kwargs)
+        finally:
+            elapsed = wh.plan.elapsed()
+            if elapsed >= THRESHOLD_MS and 'off' != metrics.mode:
+                record(build_record(wh, elapsed))
+    return cb
+
+def build_record(wh, elapsed):
+    """Describe a slow request, from its handler"""
+    rv = wh.plan.as_dict()
+    rv.update({
+        'time': wh.plan.start,
+        'ms': round(elapsed, 3),
+        'method': wh.request.method,
+        'path': wh.request.path,
+    })
+    stats = instrument.current_stats()
+    if stats is not None:
+        rv['rpcs'] = stats.as_dict()
+    return rv
+
+def record(rec):
+    """Add a record to the ring, overwriting the oldest when it's full"""
+    if 'memcache' != metrics.mode:
+        ring_lock.acquire()
+        try:
+            ring.append(rec)
+        finally:
+            ring_lock.release()
+        return
+    try:
+        n = memcache.incr(CACHE_PREFIX + NEXT_KEY, initial_value=0)
+        memcache.set('%s%s' % (CACHE_PREFIX, n % RING_SIZE), rec)
+    except Exception, e:
+        logging.warning('Failed to record slow request: %s' % e)
+
+def records(limit=RING_SIZE):
+    """Get the most recent records, newest first"""
+    if 'memcache' != metrics.mode:
+        ring_lock.acquire()
+        try:
+            rv = list(ring)
+        finally:
+            ring_lock.release()
+    else:
+        rv = memcache.get_multi([ str(i) for i in range(RING_SIZE) ],
+            key_prefix=CACHE_PREFIX).values()
+    rv.sort(key=lambda r: r['time'], reverse=True)
+    return rv[:limit]
@@ -0,0 +1,68 @@
+"""
+Pluggable storage backends for fxsync.models
+
+The models make every datastore call through the current backend, which
+is the App Engine datastore unless FXSYNC_STORAGE names another, eg.
+
+    FXSYNC_STORAGE=memory
+
+Setting FXSYNC_INSTRUMENT tallies the storage calls of each request (see
+fxsync.storage.instrument).
+"""
+import os
+
+# Backend names, and the modules and classes implementing them
+BACKENDS = {
+    'datastore': ('fxsync.storage.datastore', 'DatastoreBackend'),
+    'memory':    ('fxsync.storage.memory', 'MemoryBackend'),
+    'sqlite':    ('fxsync.storage.sqlite', 'SqliteBackend'),
+    'log':       ('fxsync.storage.log', 'LogBackend'),
+    'sharded':   ('fxsync.storage.shards', 'ShardedBackend'),
+}
+
+current = None
+instrumented = bool(os.environ.get('FXSYNC_INSTRUMENT'))
+
+def get_backend():
+    """Get the current storage backend, creating it if necessary"""
+    if current is None:
+        set_backend(os.environ.get('FXSYNC_STORAGE', 'datastore'))
+    return current
+
+def set_backend(backend):
+    """Switch storage backends, given a backend instance or name"""
+    global current
+    if isinstance(backend, basestring):
+        backend = create_backend(backend)
+    if instrumented:
+        from fxsync.storage.instrument import InstrumentedBackend
+        if not isinstance(backend, InstrumentedBackend):
+            backend = InstrumentedBackend(backend)
+    current = backend
+    return current
+
+def get_raw_backend():
+    """Get the current storage backend, without any instrumentation"""
+    from fxsync.storage.instrument import InstrumentedBackend
+    backend = get_backend()
+    if isinstance(backend, InstrumentedBackend):
+        return backend.backend
+    return backend
+
+def instrument(enabled=True):
+    """Switch tallying of storage calls per request on or off"""
+    global instrumented
+    if current is None:
+        instrumented = enabled
+    else:
+        backend = get_raw_backend()
+        instrumented = enabled
+        set_backend(backend)
+
+def create_backend(name, *args, **kwargs):
+    """Create a new instance of a named storage backend"""
+    if name not in BACKENDS:
+        raise ValueError('unknown storage backend %s' % name)
+    module_name, class_name = BACKENDS[name]
+    module = __import__(module_name, {}, {}, [class_name])
+    return getattr(module, class_name)(*args, **kwargs)
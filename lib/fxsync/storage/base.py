@@ -0,0 +1,92 @@
+"""
+Interface for fxsync storage backends, and helpers for backends storing
+property values outside the datastore
+"""
+import calendar, datetime
+from google.appengine.ext import db
+from google.appengine.api import users
+
+
+class StorageBackend(object):
+    """The persistence operations used by fxsync.models
+
+    Entities are fxsync.models instances (db.Model subclasses) throughout.
+    Backends other than the datastore just keep them somewhere else.
+
+    Local backends may also keep an index_cache, an IndexCache of WBO
+    metadata by collection, which Collection.retrieve uses when present.
+    """
+    index_cache = None
+
+    def get(self, keys):
+        """Get an entity by key, or a list of entities by a list of keys.
+        Missing entities come back as None."""
+        raise NotImplementedError()
+
+    def put(self, entities):
+        """Store an entity or a list of entities, returning the key(s)"""
+        raise NotImplementedError()
+
+    def delete(self, entities):
+        """Delete an entity or key, or a list of entities or keys"""
+        raise NotImplementedError()
+
+    def query(self, model_class, keys_only=False):
+        """Start a query for a model class.
+
+        The query supports the subset of db.Query used by fxsync.models:
+        ancestor(), filter() with =, <, <=, >, >= and IN (including on
+        __key__), order(), fetch(limit, offset), get(), count(limit) and
+        iteration."""
+        raise NotImplementedError()
+
+    def fetch_values(self, query, name, limit, offset=0):
+        """Fetch a single property of each result of a query. Backends
+        able to answer from an index alone can do better than this."""
+        return [ getattr(e, name) for e in query.fetch(limit, offset) ]
+
+    def index_rows(self, collection_key):
+        """List (str(key), wbo_id, modified, sortindex, parentid,
+        predecessorid) for each WBO in a collection, to build its index
+        from"""
+        q = self.query(db.class_for_kind('WBO')).ancestor(collection_key)
+        return [ (str(w.key()), w.wbo_id, w.modified, w.sortindex,
+            w.parentid, w.predecessorid) for w in q ]
+
+    def get_or_insert(self, model_class, key_name, **kwds):
+        """Get an entity by key name, creating it atomically if missing"""
+        raise NotImplementedError()
+
+    def run_in_transaction(self, fn, *args, **kwargs):
+        """Run a function atomically against a single entity group,
+        discarding its writes if it raises an exception"""
+        raise NotImplementedError()
+
+def to_column(prop, entity):
+    """Convert an entity's property value to a stored value"""
+    # get_value_for_datastore also takes care of auto_now properties
+    value = prop.get_value_for_datastore(entity)
+    if value is None:
+        return None
+    if isinstance(value, db.Key):
+        return str(value)
+    if isinstance(value, users.User):
+        return value.email()
+    if isinstance(value, datetime.datetime):
+        return (calendar.timegm(value.timetuple()) +
+            value.microsecond / 1000000.0)
+    if isinstance(value, unicode):
+        # Plain unicode, since eg. sqlite3 refuses subclasses like db.Text
+        return unicode(value)
+    return value
+
+def from_column(prop, value):
+    """Convert a stored value to a property value, leaving references as
+    key strings for the caller to resolve"""
+    if value is None:
+        return None
+    if isinstance(prop, db.UserProperty):
+        return users.User(value)
+    if isinstance(prop, db.DateTimeProperty):
+        return datetime.datetime.utcfromtimestamp(value)
+    return value
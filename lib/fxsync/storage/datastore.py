@@ -0,0 +1,27 @@
+"""
+Storage backend for the App Engine datastore
+"""
+from google.appengine.ext import db
+from fxsync.storage.base import StorageBackend
+
+class DatastoreBackend(StorageBackend):
+    """Storage in the App Engine datastore, straight through the db API"""
+
+    def get(self, keys):
+        return db.get(keys)
+
+    def put(self, entities):
+        return db.put(entities)
+
+    def delete(self, entities):
+        db.delete(entities)
+
+    def query(self, model_class, keys_only=False):
+        return db.Query(model_class, keys_only=keys_only)
+
+    def get_or_insert(self, model_class, key_name, **kwds):
+        # Call the db implementation, rather than the model's override
+        return db.Model.get_or_insert.im_func(model_class, key_name, **kwds)
+
+    def run_in_transaction(self, fn, *args, **kwargs):
+        return db.run_in_transaction(fn, *args, **kwargs)
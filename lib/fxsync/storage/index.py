@@ -0,0 +1,282 @@
+"""
+In-memory indexes of WBO metadata, one per collection, for answering the
+filters and sorts of Collection.retrieve without going to storage
+
+Each index keeps the key and wbo_id of every WBO of a collection, along
+with modified, sortindex, parentid and predecessorid in parallel typed
+arrays, with the string IDs interned as integer codes. Rows are found by
+the WBO's key, since nothing outside WBO.from_json makes its key name
+the same as its wbo_id. Range filters bisect sorted views of the
+arrays, and the remaining criteria are checked against the arrays for
+just the narrowest range's rows, so that storage is only asked for the
+payloads of the page finally returned.
+
+Indexes are loaded on first use and evicted least recently used first,
+once the indexes held together cover too many records. They are only
+coherent while every write goes through the same process, as in the
+standalone server, so only the local storage backends use them.
+"""
+import sys, threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+# Records covered by all indexes held at once, before evicting
+MAX_RECORDS = 1000000
+
+# The kind indexed, whose entities are children of collections
+INDEXED_KIND = 'WBO'
+
+class CollectionIndex(object):
+    """Metadata of the WBOs in one collection"""
+
+    def __init__(self, rows=()):
+        # Row number by str(key), and str(key) and wbo_id by row number
+        # (None if deleted)
+        self.rows = {}
+        self.keys = []
+        self.ids = []
+        self.modified = array('d')
+        self.sortindex = array('l')
+        self.parentid = array('l')
+        self.predecessorid = array('l')
+        # Codes interning parentid and predecessorid strings, 0 for None
+        self.codes = { None: 0 }
+        self.deleted = 0
+        self.views = None
+        for row in rows:
+            self.put(*row)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.codes)
+        return code
+
+    def put(self, str_key, wbo_id, modified, sortindex, parentid,
+            predecessorid):
+        """Add or update the metadata of a WBO"""
+        values = (modified, sortindex or 0,
+            self.code(parentid), self.code(predecessorid))
+        row = self.rows.get(str_key)
+        if row is None:
+            self.rows[str_key] = len(self.keys)
+            self.keys.append(str_key)
+            self.ids.append(wbo_id)
+            self.modified.append(values[0])
+            self.sortindex.append(values[1])
+            self.parentid.append(values[2])
+            self.predecessorid.append(values[3])
+        else:
+            self.ids[row] = wbo_id
+            (self.modified[row], self.sortindex[row],
+                self.parentid[row], self.predecessorid[row]) = values
+        self.views = None
+
+    def delete(self, str_key):
+        row = self.rows.pop(str_key, None)
+        if row is not None:
+            self.keys[row] = self.ids[row] = None
+            self.deleted += 1
+            self.views = None
+
+    def compact(self):
+        """Rebuild the arrays without the rows of deleted WBOs"""
+        live = [ row for row, str_key in enumerate(self.keys)
+            if str_key is not None ]
+        self.keys = [ self.keys[row] for row in live ]
+        self.ids = [ self.ids[row] for row in live ]
+        self.rows = dict( (str_key, row)
+            for row, str_key in enumerate(self.keys) )
+        for name in ('modified', 'sortindex', 'parentid', 'predecessorid'):
+            values = getattr(self, name)
+            setattr(self, name, array(values.typecode,
+                [ values[row] for row in live ]))
+        self.deleted = 0
+
+    def get_views(self):
+        """Get the rows sorted by modified and by sortindex, along with the
+        sorted values of each, rebuilding them after any change"""
+        if self.views is None:
+            if self.deleted > len(self.rows):
+                self.compact()
+            live = [ row for row, str_key in enumerate(self.keys)
+                if str_key is not None ]
+            views = {}
+            for name in ('modified', 'sortindex'):
+                values = getattr(self, name)
+                rows = sorted(live, key=values.__getitem__)
+                views[name] = (array('l', rows),
+                    array(values.typecode, [ values[r] for r in rows ]))
+            self.views = views
+        return self.views
+
+    def range(self, name, above=None, below=None):
+        """Find the rows with a value strictly between above and below"""
+        rows, values = self.get_views()[name]
+        start, end = 0, len(values)
+        if above is not None:
+            start = bisect_right(values, above)
+        if below is not None:
+            end = bisect_left(values, below)
+        return rows[start:end]
+
+    def select(self, parentid=None, predecessorid=None, newer=None,
+            older=None, index_above=None, index_below=None, sort='index'):
+        """List (str(key), wbo_id) of the WBOs matching the criteria, in
+        sort order, filtering as Collection.retrieve does"""
+        ranges, checks = [], []
+        if index_above or index_below:
+            ranges.append(self.range('sortindex', index_above or None,
+                index_below or None))
+        if newer or older:
+            ranges.append(self.range('modified', newer or None,
+                older or None))
+        for name, value in (('parentid', parentid),
+                ('predecessorid', predecessorid)):
+            if value is not None:
+                code = self.codes.get(value)
+                if code is None: return []
+                checks.append((getattr(self, name), code))
+
+        if ranges:
+            ranges.sort(key=len)
+            rows = ranges[0]
+            for other in ranges[1:]:
+                other = set(other)
+                rows = [ r for r in rows if r in other ]
+        else:
+            rows = self.get_views()['sortindex'][0]
+        for values, code in checks:
+            rows = [ r for r in rows if values[r] == code ]
+
+        if 'oldest' == sort:
+            rows = sorted(rows, key=self.modified.__getitem__)
+        elif 'newest' == sort:
+            rows = sorted(rows, key=self.modified.__getitem__, reverse=True)
+        else:
+            rows = sorted(rows, key=self.sortindex.__getitem__, reverse=True)
+        return [ (self.keys[r], self.ids[r]) for r in rows ]
+
+    def memory_size(self):
+        """Estimate the bytes used by this index"""
+        size = sys.getsizeof(self.rows) + sys.getsizeof(self.keys) + \
+            sys.getsizeof(self.ids) + sys.getsizeof(self.codes)
+        for row, str_key in enumerate(self.keys):
+            if str_key is not None:
+                size += sys.getsizeof(str_key) + \
+                    sys.getsizeof(self.ids[row])
+        for code in self.codes:
+            size += sys.getsizeof(code)
+        arrays = [ self.modified, self.sortindex, self.parentid,
+            self.predecessorid ]
+        for rows, values in (self.views or {}).values():
+            arrays.extend([ rows, values ])
+        for a in arrays:
+            size += a.itemsize * len(a)
+        return size
+
+class IndexCache(object):
+    """Collection indexes for a storage backend, loaded on demand and
+    evicted least recently used first"""
+
+    def __init__(self, load, max_records=MAX_RECORDS, lock=None):
+        # load(collection_key) lists the (str(key), wbo_id, modified,
+        # sortindex, parentid, predecessorid) rows of a collection. Backends that
+        # update indexes while holding a lock of their own, which load
+        # also takes, pass it in to share.
+        self.load = load
+        self.max_records = max_records
+        self.indexes = {}
+        self.last_used = {}
+        self.records = 0
+        self.tick = 0
+        self.lock = lock or threading.RLock()
+
+    def select(self, collection_key, **criteria):
+        """List (str(key), wbo_id) of a collection's WBOs matching the
+        criteria"""
+        self.lock.acquire()
+        try:
+            return self.get(collection_key).select(**criteria)
+        finally:
+            self.lock.release()
+
+    def get(self, collection_key):
+        str_key = str(collection_key)
+        index = self.indexes.get(str_key)
+        if index is None:
+            index = self.indexes[str_key] = CollectionIndex(
+                self.load(collection_key))
+            self.records += len(index)
+            self.evict(keep=str_key)
+        self.tick += 1
+        self.last_used[str_key] = self.tick
+        return index
+
+    def evict(self, keep=None):
+        while self.records > self.max_records and len(self.indexes) > 1:
+            str_key = min([ k for k in self.last_used if k != keep ],
+                key=self.last_used.get)
+            self.forget(str_key)
+
+    def forget(self, collection_key):
+        """Drop the index of a collection, if loaded"""
+        self.lock.acquire()
+        try:
+            index = self.indexes.pop(str(collection_key), None)
+            self.last_used.pop(str(collection_key), None)
+            if index is not None:
+                self.records -= len(index)
+        finally:
+            self.lock.release()
+
+    def put(self, entities):
+        """Update loaded indexes with entities just stored"""
+        self.lock.acquire()
+        try:
+            for w in entities:
+                if INDEXED_KIND != w.kind(): continue
+                index = self.indexes.get(str(w.key().parent()))
+                if index is not None:
+                    size = len(index)
+                    index.put(str(w.key()), w.wbo_id, w.modified,
+                        w.sortindex, w.parentid, w.predecessorid)
+                    self.records += len(index) - size
+            self.evict()
+        finally:
+            self.lock.release()
+
+    def delete(self, keys):
+        """Update loaded indexes with keys just deleted"""
+        self.lock.acquire()
+        try:
+            for key in keys:
+                if INDEXED_KIND != key.kind():
+                    # A collection, whose index goes with it
+                    self.forget(key)
+                    continue
+                index = self.indexes.get(str(key.parent()))
+                if index is not None:
+                    size = len(index)
+                    index.delete(str(key))
+                    self.records -= size - len(index)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Report the collections and records indexed, and memory used"""
+        self.lock.acquire()
+        try:
+            size = sum(i.memory_size() for i in self.indexes.values())
+            return {
+                'collections': len(self.indexes),
+                'records': self.records,
+                'bytes': size,
+                'bytes_per_record': self.records and
+                    float(size) / self.records or 0,
+            }
+        finally:
+            self.lock.release()
@@ -0,0 +1,236 @@
+"""
+Per-request accounting of storage calls
+
+Every datastore operation in fxsync.models and fxsync.utils goes through
+the current storage backend, so wrapping the backend in an
+InstrumentedBackend sees them all. Calls, entities, bytes and wall time
+are tallied by operation on the request context. Instrumentation is off
+unless FXSYNC_INSTRUMENT is set or storage.instrument() is called, and
+while it is off, the backend is not wrapped at all.
+
+InstrumentMiddleware logs the tallies of each request, and adds them to
+the response as an X-Fxsync-Rpcs header when the request asks for them
+with an X-Fxsync-Debug-Rpcs header.
+"""
+import time, logging
+from google.appengine.ext import db
+from fxsync import context, storage
+
+DEBUG_HEADER = 'HTTP_X_FXSYNC_DEBUG_RPCS'
+STATS_HEADER = 'X-Fxsync-Rpcs'
+
+class RpcStats(object):
+    """Tallies of storage calls made during a request"""
+
+    def __init__(self):
+        # Operation name -> [ calls, entities, bytes, seconds ]
+        self.ops = {}
+
+    def record(self, op, entities, size, elapsed):
+        tally = self.ops.get(op)
+        if tally is None:
+            tally = self.ops[op] = [ 0, 0, 0, 0.0 ]
+        tally[0] += 1
+        tally[1] += entities
+        tally[2] += size
+        tally[3] += elapsed
+
+    def totals(self):
+        """Sum the tallies over all operations"""
+        totals = [ 0, 0, 0, 0.0 ]
+        for tally in self.ops.values():
+            for i, value in enumerate(tally):
+                totals[i] += value
+        return dict(zip(('calls', 'entities', 'bytes', 'seconds'), totals))
+
+    def as_dict(self):
+        return dict( (op, dict(zip(('calls', 'entities', 'bytes', 'seconds'),
+            tally))) for op, tally in self.ops.items() )
+
+    def summary(self):
+        """Describe the tallies in one line, eg.
+        get=1/1/312/0.8ms query=2/25/9120/4.1ms"""
+        return ' '.join('%s=%s/%s/%s/%.1fms' % (op, calls, entities, size,
+            elapsed * 1000.0) for op, (calls, entities, size, elapsed)
+            in sorted(self.ops.items()))
+
+def current_stats(create=False):
+    """Get the storage call tallies of the current request, if any"""
+    ctx = context.current()
+    if ctx is None:
+        return None
+    stats = getattr(ctx, 'rpc_stats', None)
+    if stats is None and create:
+        stats = ctx.rpc_stats = RpcStats()
+    return stats
+
+def record(op, start, results=(), entities=None):
+    """Tally a call begun at start, with its results, or just a count of
+    the entities it covered"""
+    stats = current_stats(create=True)
+    if stats is None:
+        return
+    size = 0
+    if entities is None:
+        results = [ r for r in results if r is not None ]
+        entities = len(results)
+        size = sum(entity_size(r) for r in results)
+    stats.record(op, entities, size, time.time() - start)
+
+def entity_size(entity):
+    """Estimate the stored size of an entity, as encoded for the
+    datastore, or of a key or other value"""
+    if entity is None:
+        return 0
+    if isinstance(entity, db.Model):
+        return db.model_to_protobuf(entity).ByteSize()
+    return len(str(entity))
+
+def as_list(value):
+    if isinstance(value, (list, tuple)):
+        return value
+    return [ value ]
+
+class InstrumentedBackend(object):
+    """Storage backend wrapper recording each call on the request context"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        # Anything else backend-specific, like close() or index_cache
+        return getattr(self.backend, name)
+
+    def get(self, keys):
+        start = time.time()
+        rv = self.backend.get(keys)
+        record('get', start, as_list(rv))
+        return rv
+
+    def put(self, entities):
+        start = time.time()
+        rv = self.backend.put(entities)
+        record('put', start, as_list(entities))
+        return rv
+
+    def delete(self, entities):
+        start = time.time()
+        self.backend.delete(entities)
+        record('delete', start, entities=len(as_list(entities)))
+
+    def query(self, model_class, keys_only=False):
+        return InstrumentedQuery(self.backend.query(model_class, keys_only))
+
+    def fetch_values(self, query, name, limit, offset=0):
+        start = time.time()
+        rv = self.backend.fetch_values(query.query, name, limit, offset)
+        record('query', start, rv)
+        return rv
+
+    def get_or_insert(self, model_class, key_name, **kwds):
+        start = time.time()
+        rv = self.backend.get_or_insert(model_class, key_name, **kwds)
+        record('get_or_insert', start, [ rv ])
+        return rv
+
+    def run_in_transaction(self, fn, *args, **kwargs):
+        start = time.time()
+        try:
+            return self.backend.run_in_transaction(fn, *args, **kwargs)
+        finally:
+            record('transaction', start, entities=0)
+
+class InstrumentedQuery(object):
+    """Query wrapper recording fetches, counts and iteration"""
+
+    def __init__(self, query):
+        self.__dict__['query'] = query
+
+    def __getattr__(self, name):
+        return getattr(self.query, name)
+
+    def __setattr__(self, name, value):
+        # HACK: fxsync.models sets _keys_only on queries directly
+        setattr(self.query, name, value)
+
+    def ancestor(self, ancestor):
+        self.query.ancestor(ancestor)
+        return self
+
+    def filter(self, property_operator, value):
+        self.query.filter(property_operator, value)
+        return self
+
+    def order(self, name):
+        self.query.order(name)
+        return self
+
+    def fetch(self, limit, offset=0):
+        start = time.time()
+        rv = self.query.fetch(limit, offset)
+        record('query', start, rv)
+        return rv
+
+    def get(self):
+        start = time.time()
+        rv = self.query.get()
+        record('query', start, [ rv ])
+        return rv
+
+    def count(self, limit=None):
+        start = time.time()
+        if limit is None:
+            rv = self.query.count()
+        else:
+            rv = self.query.count(limit)
+        record('count', start, entities=rv)
+        return rv
+
+    def __iter__(self):
+        # Results may be fetched lazily in batches, so time each step, and
+        # record once iteration ends.
+        elapsed, entities, size = 0.0, 0, 0
+        start = time.time()
+        results = iter(self.query)
+        try:
+            while True:
+                try:
+                    result = results.next()
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.time() - start
+                entities += 1
+                size += entity_size(result)
+                yield result
+                start = time.time()
+        finally:
+            stats = current_stats(create=True)
+            if stats is not None:
+                stats.record('query', entities, size, elapsed)
+
+class InstrumentMiddleware(object):
+    """WSGI middleware logging the storage calls of each request, and
+    reporting them in a response header on request. Goes inside
+    ContextMiddleware, so the request context is still there at the end.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if not storage.instrumented:
+            return self.app(environ, start_response)
+
+        def instrumented_start_response(status, headers, exc_info=None):
+            stats = current_stats()
+            if stats is not None and environ.get(DEBUG_HEADER):
+                headers = list(headers) + [ (STATS_HEADER, stats.summary()) ]
+            return start_response(status, headers, exc_info)
+
+        rv = self.app(environ, instrumented_start_response)
+        stats = current_stats()
+        if stats is not None:
+            logging.info('storage %s %s %s' % (environ.get('REQUEST_METHOD'),
+                environ.get('PATH_INFO'), stats.summary()))
+        return rv
@@ -0,0 +1,375 @@
+"""
+Log-structured storage backend, for the standalone server
+
+Writes are only ever appended to log files. WBOs go to a segment file per
+user, and profiles and collections to a shared metadata log. Opening the
+backend replays the logs into memory, where WBOs are indexed by their
+metadata along with the offset of their payload in the segment. Queries
+filter and sort on the index alone, and payloads are only read, through a
+memory map of the segment, for the records actually returned.
+
+Deletes and overwrites leave garbage behind in the logs, so once enough
+of a segment is garbage, a background thread compacts it by rewriting
+just the live records. Writes carry on meanwhile, and whatever they
+append is copied over when the rewritten file takes the segment's place.
+
+The logs are kept in the directory FXSYNC_LOG_PATH, or fxsync-log in the
+current directory.
+"""
+import os, struct, mmap, hashlib, threading
+from django.utils import simplejson
+from google.appengine.ext import db
+from fxsync.storage.base import StorageBackend, to_column, from_column
+from fxsync.storage.memory import MemoryBackend
+from fxsync.storage.index import IndexCache
+
+DEFAULT_PATH = 'fxsync-log'
+
+# Kinds stored in per-user segments, and the property of each kept as the
+# raw payload of its records rather than in the JSON metadata
+SEGMENT_KINDS = { 'WBO': 'payload' }
+
+# Segments are compacted once they hold at least this many bytes of
+# garbage, making up at least this fraction of the segment
+COMPACT_MIN_GARBAGE = 1048576
+COMPACT_MIN_RATIO = 0.5
+
+PUT, DELETE = 1, 2
+
+# Record header: record length, operation, key length, metadata length
+HEADER = struct.Struct('>IBHI')
+
+class Segment(object):
+    """An append-only file of records, read through a memory map"""
+
+    def __init__(self, path, sync=True):
+        self.path = path
+        self.sync = sync
+        # str(key) -> size of the record holding its current version
+        self.live = {}
+        self.garbage = 0
+        self.compacting = False
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, 'ab+')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def get_map(self):
+        """Map the file, remapping if it has grown since"""
+        if self.map is None or len(self.map) < self.size:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), self.size,
+                access=mmap.ACCESS_READ)
+        return self.map
+
+    def read(self, offset, length):
+        if not length:
+            return ''
+        return self.get_map()[offset:offset + length]
+
+    def records(self):
+        """Yield (op, key, meta, payload offset, payload length, size) for
+        each record, dropping any torn record left at the end by a crash"""
+        offset = 0
+        while offset + HEADER.size <= self.size:
+            mm = self.get_map()
+            size, op, key_len, meta_len = HEADER.unpack_from(mm, offset)
+            if size < HEADER.size + key_len + meta_len or \
+                    offset + size > self.size:
+                break
+            pos = offset + HEADER.size
+            key = mm[pos:pos + key_len]
+            meta = simplejson.loads(mm[pos + key_len:pos + key_len + meta_len])
+            pos += key_len + meta_len
+            yield (op, key, meta, pos, offset + size - pos, size)
+            offset += size
+        if offset < self.size:
+            self.map.close()
+            self.map = None
+            self.file.truncate(offset)
+            self.size = offset
+
+    def append(self, records):
+        """Append (op, key, meta, payload) records, returning (payload
+        offset, payload length, size) for each"""
+        chunks, positions = [], []
+        offset = self.size
+        for op, key, meta, payload in records:
+            meta = simplejson.dumps(meta, separators=(',', ':'))
+            size = HEADER.size + len(key) + len(meta) + len(payload)
+            chunks.extend([
+                HEADER.pack(size, op, len(key), len(meta)), key, meta, payload
+            ])
+            positions.append(
+                (offset + size - len(payload), len(payload), size))
+            offset += size
+        self.file.write(''.join(chunks))
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        self.size = offset
+        return positions
+
+    def swap(self, tmp, end):
+        """Replace this file with the rewritten segment tmp, after copying
+        over whatever was appended past end in the meantime. Returns how
+        far those records moved."""
+        shift = tmp.size - end
+        if self.size > end:
+            tmp.file.write(self.read(end, self.size - end))
+            tmp.file.flush()
+            if tmp.sync:
+                os.fsync(tmp.file.fileno())
+            tmp.size += self.size - end
+        tmp.close()
+        self.close()
+        os.rename(tmp.path, self.path)
+        self.open()
+        return shift
+
+    def note_live(self, str_key, size):
+        self.garbage += self.live.get(str_key, 0)
+        self.live[str_key] = size
+
+    def note_dead(self, str_key, size):
+        self.garbage += self.live.pop(str_key, 0) + size
+
+    def wants_compaction(self):
+        return (not self.compacting and
+            self.garbage >= COMPACT_MIN_GARBAGE and
+            self.garbage >= self.size * COMPACT_MIN_RATIO)
+
+class LogEntry(object):
+    """Index entry standing in for a stored entity, with its metadata as
+    attributes for queries to filter on, and the location of its payload"""
+
+    def __init__(self, key, meta, values, segment, offset, length):
+        self.__dict__.update(values)
+        self._key = key
+        self.meta = meta
+        self.values = values
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+
+    def key(self):
+        return self._key
+
+class LogBackend(MemoryBackend):
+    """Storage in append-only log files, indexed in memory"""
+
+    def __init__(self, path=None, sync=True, index=True):
+        MemoryBackend.__init__(self)
+        if index:
+            self.index_cache = IndexCache(self.index_rows, lock=self.lock)
+        self.path = path or os.environ.get('FXSYNC_LOG_PATH', DEFAULT_PATH)
+        self.sync = sync
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.segments = {}
+        self.meta = Segment(os.path.join(self.path, 'meta.log'), sync)
+        self.replay(self.meta)
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith('.compact'):
+                # Left by a compaction that never finished
+                os.remove(os.path.join(self.path, name))
+            elif name.startswith('user-') and name.endswith('.log'):
+                self.replay(self.get_segment(name))
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for segment in [ self.meta ] + self.segments.values():
+                segment.close()
+        finally:
+            self.lock.release()
+
+    def get_segment(self, name):
+        segment = self.segments.get(name)
+        if segment is None:
+            segment = self.segments[name] = Segment(
+                os.path.join(self.path, name), self.sync)
+        return segment
+
+    def segment_for(self, key):
+        """Find the segment for a key, by the user at the root of its path"""
+        if key.kind() not in SEGMENT_KINDS:
+            return self.meta
+        while key.parent():
+            key = key.parent()
+        return self.get_segment('user-%s.log' %
+            hashlib.md5(str(key)).hexdigest())
+
+    def replay(self, segment):
+        """Index the records of a segment"""
+        for op, str_key, meta, offset, length, size in segment.records():
+            key = db.Key(str_key)
+            if PUT == op:
+                self.store(key, self.build_record(key, meta, segment,
+                    offset, length))
+                segment.note_live(str_key, size)
+            else:
+                self.unstore(key)
+                segment.note_dead(str_key, size)
+
+    def build_record(self, key, meta, segment, offset, length):
+        """Build an index entry for a segment kind, or the entity itself
+        for any other kind"""
+        model_class = db.class_for_kind(key.kind())
+        props = model_class.properties()
+        values = dict( (str(name), from_column(props[name], value))
+            for name, value in meta.items() )
+        if key.kind() in SEGMENT_KINDS:
+            return LogEntry(key, meta, values, segment, offset, length)
+        return self.build_entity(model_class, key, values)
+
+    def build_entity(self, model_class, key, values):
+        """Build an entity, resolving its references from the index"""
+        for name, prop in model_class.properties().items():
+            if isinstance(prop, db.ReferenceProperty) and values.get(name):
+                values[name] = self.get_one(values[name])
+        return model_class(key=key, **values)
+
+    def load(self, record):
+        if not isinstance(record, LogEntry):
+            return record
+        self.lock.acquire()
+        try:
+            payload = record.segment.read(record.offset, record.length)
+        finally:
+            self.lock.release()
+        values = dict(record.values)
+        values[SEGMENT_KINDS[record.key().kind()]] = payload.decode('utf-8')
+        return self.build_entity(db.class_for_kind(record.key().kind()),
+            record.key(), values)
+
+    def encode(self, entity):
+        """Encode an entity as a PUT record"""
+        payload_name = SEGMENT_KINDS.get(entity.kind(), None)
+        meta = dict( (name, to_column(prop, entity))
+            for name, prop in entity.properties().items()
+            if name != payload_name )
+        payload = ''
+        if payload_name:
+            payload = (getattr(entity, payload_name) or u'').encode('utf-8')
+        return (PUT, str(entity.key()), meta, payload)
+
+    def store_entities(self, entities):
+        by_segment = {}
+        for entity in entities:
+            by_segment.setdefault(self.segment_for(entity.key()), []).append(
+                (entity, self.encode(entity)))
+        for segment, items in by_segment.items():
+            positions = segment.append([ record for e, record in items ])
+            for (entity, record), (offset, length, size) in zip(items,
+                    positions):
+                key = entity.key()
+                if key.kind() in SEGMENT_KINDS:
+                    self.store(key, self.build_record(key, record[2],
+                        segment, offset, length))
+                else:
+                    self.store(key, entity)
+                segment.note_live(record[1], size)
+            self.check_compaction(segment)
+        if self.index_cache:
+            self.index_cache.put(entities)
+
+    def remove_keys(self, keys):
+        by_segment = {}
+        for key in keys:
+            by_segment.setdefault(self.segment_for(key), []).append(key)
+        for segment, seg_keys in by_segment.items():
+            positions = segment.append([ (DELETE, str(k), {}, '')
+                for k in seg_keys ])
+            for key, (offset, length, size) in zip(seg_keys, positions):
+                self.unstore(key)
+                segment.note_dead(str(key), size)
+            self.check_compaction(segment)
+        if self.index_cache:
+            self.index_cache.delete(keys)
+
+    def fetch_values(self, query, name, limit, offset=0):
+        if name in SEGMENT_KINDS.values():
+            return StorageBackend.fetch_values(self, query, name,
+                limit, offset)
+        return MemoryBackend.fetch_values(self, query, name, limit, offset)
+
+    def check_compaction(self, segment):
+        if segment.wants_compaction():
+            segment.compacting = True
+            t = threading.Thread(target=self.compact, args=(segment,))
+            t.setDaemon(True)
+            t.start()
+
+    def compact(self, segment):
+        """Rewrite a segment with only the current version of each record.
+        The lock is only held to snapshot the segment's records and, once
+        they are rewritten, to carry over any written since and swap the
+        files, so that writes don't wait on the rewrite or its fsync."""
+        tmp = None
+        try:
+            self.lock.acquire()
+            try:
+                end = segment.size
+                records = [ self.get_record(k) for k in segment.live ]
+                # Parents before children, so that replay resolves
+                # references
+                records.sort(key=lambda r: len(r.key().to_path()))
+                encoded = []
+                for r in records:
+                    if isinstance(r, LogEntry):
+                        encoded.append((PUT, str(r.key()), r.meta,
+                            (r.offset, r.length)))
+                    else:
+                        encoded.append(self.encode(r))
+            finally:
+                self.lock.release()
+
+            # The file is only ever appended to, so payloads before end
+            # can be read through a file of our own without the lock.
+            source = open(segment.path, 'rb')
+            try:
+                for i, (op, key, meta, payload) in enumerate(encoded):
+                    if isinstance(payload, tuple):
+                        source.seek(payload[0])
+                        encoded[i] = (op, key, meta, source.read(payload[1]))
+            finally:
+                source.close()
+            tmp = Segment(segment.path + '.compact', segment.sync)
+            positions = tmp.append(encoded)
+
+            self.lock.acquire()
+            try:
+                shift = segment.swap(tmp, end)
+                tmp = None
+                compacted = dict( (str(r.key()), (r, position))
+                    for r, position in zip(records, positions) )
+                for str_key in segment.live.keys():
+                    r = self.get_record(str_key)
+                    old = compacted.get(str_key)
+                    if old is not None and old[0] is r:
+                        offset, length, size = old[1]
+                        if isinstance(r, LogEntry):
+                            r.offset, r.length = offset, length
+                        segment.live[str_key] = size
+                    elif isinstance(r, LogEntry):
+                        # Written since the snapshot, and moved along with
+                        # the rest of the tail
+                        r.offset += shift
+                segment.garbage = segment.size - sum(segment.live.values())
+            finally:
+                self.lock.release()
+        finally:
+            if tmp is not None:
+                tmp.close()
+                os.remove(tmp.path)
+            segment.compacting = False
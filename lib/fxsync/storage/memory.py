@@ -0,0 +1,250 @@
+"""
+In-memory storage backend, for profiling, load testing and unit tests
+without the datastore
+"""
+import threading, itertools
+from google.appengine.ext import db
+from fxsync.storage.base import StorageBackend
+
+# IDs for entities stored without key names, unique across all backend
+# instances in the process so that keys are never reused.
+id_sequence = itertools.count(1)
+
+class MemoryBackend(StorageBackend):
+    """Storage in process memory, lost when the process ends
+
+    Entities are kept by reference rather than copied, so changes to an
+    entity after it has been put are visible to later gets and queries.
+    """
+
+    def __init__(self):
+        # str(key) -> entity (or other record, in subclasses), by kind
+        self.entities = {}
+        # str(parent key) -> set of str(child key), by kind
+        self.children = {}
+        self.lock = threading.RLock()
+        self.journal = None
+
+    def get(self, keys):
+        if isinstance(keys, (list, tuple)):
+            return [ self.get_one(k) for k in keys ]
+        return self.get_one(keys)
+
+    def get_one(self, key):
+        record = self.get_record(key)
+        return record is not None and self.load(record) or None
+
+    def get_record(self, key):
+        """Get whatever is stored for a key, which queries filter on"""
+        if isinstance(key, basestring):
+            key = db.Key(key)
+        return self.entities.get(key.kind(), {}).get(str(key), None)
+
+    def load(self, record):
+        """Get the entity for a stored record"""
+        return record
+
+    def put(self, entities):
+        if not isinstance(entities, (list, tuple)):
+            return self.put([ entities ])[0]
+        self.lock.acquire()
+        try:
+            for entity in entities:
+                if not entity.has_key():
+                    # HACK: Reaching into db.Model, to give the entity
+                    # the kind of key the datastore would have.
+                    entity._key = db.Key.from_path(entity.kind(),
+                        id_sequence.next(), parent=entity.parent_key())
+                self.note_journal(entity.key())
+            self.store_entities(entities)
+        finally:
+            self.lock.release()
+        return [ e.key() for e in entities ]
+
+    def delete(self, entities):
+        if not isinstance(entities, (list, tuple)):
+            entities = [ entities ]
+        keys = [ isinstance(e, db.Key) and e or e.key() for e in entities ]
+        self.lock.acquire()
+        try:
+            for key in keys:
+                self.note_journal(key)
+            self.remove_keys(keys)
+        finally:
+            self.lock.release()
+
+    def store_entities(self, entities):
+        for entity in entities:
+            self.store(entity.key(), entity)
+
+    def remove_keys(self, keys):
+        for key in keys:
+            self.unstore(key)
+
+    def store(self, key, record):
+        """Index a record by kind, key and parent"""
+        self.entities.setdefault(key.kind(), {})[str(key)] = record
+        if key.parent():
+            self.children.setdefault(key.kind(), {}).setdefault(
+                str(key.parent()), set()).add(str(key))
+
+    def unstore(self, key):
+        self.entities.get(key.kind(), {}).pop(str(key), None)
+        if key.parent():
+            self.children.get(key.kind(), {}).get(
+                str(key.parent()), set()).discard(str(key))
+
+    def query(self, model_class, keys_only=False):
+        return MemoryQuery(self, model_class, keys_only)
+
+    def fetch_values(self, query, name, limit, offset=0):
+        return [ getattr(r, name) for r in query.run()[offset:offset + limit] ]
+
+    def index_rows(self, collection_key):
+        q = self.query(db.class_for_kind('WBO')).ancestor(collection_key)
+        return [ (str(r.key()), r.wbo_id, r.modified, r.sortindex,
+            r.parentid, r.predecessorid) for r in q.run() ]
+
+    def get_or_insert(self, model_class, key_name, **kwds):
+        self.lock.acquire()
+        try:
+            key = db.Key.from_path(model_class.kind(), key_name,
+                parent=self.parent_key_of(kwds.get('parent', None)))
+            entity = self.get_one(key)
+            if entity is None:
+                entity = model_class(key_name=key_name, **kwds)
+                self.put(entity)
+            return entity
+        finally:
+            self.lock.release()
+
+    def run_in_transaction(self, fn, *args, **kwargs):
+        self.lock.acquire()
+        try:
+            if self.journal is not None:
+                # Nested, so the outer transaction takes care of rollback
+                return fn(*args, **kwargs)
+            self.journal = {}
+            try:
+                rv = fn(*args, **kwargs)
+            except:
+                journal, self.journal = self.journal, None
+                for key, record in journal.items():
+                    if record is None:
+                        self.delete(key)
+                    else:
+                        self.put(self.load(record))
+                raise
+            self.journal = None
+            return rv
+        finally:
+            self.lock.release()
+
+    def note_journal(self, key):
+        """Remember the state of an entity before a transaction changes it"""
+        if self.journal is not None and key not in self.journal:
+            self.journal[key] = self.get_record(key)
+
+    def parent_key_of(self, parent):
+        if parent is None or isinstance(parent, db.Key):
+            return parent
+        return parent.key()
+
+    def candidates(self, kind, ancestor):
+        """List the str(key)s of entities of a kind, optionally limited to
+        the descendants of an ancestor key"""
+        if ancestor is None:
+            return self.entities.get(kind, {}).keys()
+        found = []
+        for child_kind, by_parent in self.children.items():
+            for key in by_parent.get(str(ancestor), ()):
+                if child_kind == kind: found.append(key)
+                found.extend(self.candidates(kind, db.Key(key)))
+        return found
+
+class MemoryQuery(object):
+    """Query over entities in a MemoryBackend, mimicking db.Query"""
+
+    OPERATORS = {
+        '=':  lambda a, b: a == b,
+        '<':  lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>':  lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+        'IN': lambda a, b: a in b,
+    }
+
+    def __init__(self, backend, model_class, keys_only=False):
+        self.backend = backend
+        self.model_class = model_class
+        self._keys_only = keys_only
+        self.ancestor_key = None
+        self.filters = []
+        self.orders = []
+
+    def ancestor(self, ancestor):
+        self.ancestor_key = self.backend.parent_key_of(ancestor)
+        return self
+
+    def filter(self, property_operator, value):
+        parts = property_operator.split()
+        name, op = parts[0], (len(parts) > 1 and parts[1] or '=')
+        if 'IN' == op:
+            value = set(value)
+        self.filters.append((name, self.OPERATORS[op], value))
+        return self
+
+    def order(self, name):
+        self.orders.append(name)
+        return self
+
+    def run(self):
+        """List matching records, in order"""
+        backend, kind = self.backend, self.model_class.kind()
+        results = []
+        backend.lock.acquire()
+        try:
+            entities = backend.entities.get(kind, {})
+            for str_key in backend.candidates(kind, self.ancestor_key):
+                entity = entities.get(str_key, None)
+                if entity is None: continue
+                for name, op, value in self.filters:
+                    if not op(self.value_of(entity, name), value): break
+                else:
+                    results.append(entity)
+        finally:
+            backend.lock.release()
+
+        results.sort(key=lambda e: e.key())
+        # Stable sorts, applied last order first, give a multi-key sort.
+        for name in reversed(self.orders):
+            reverse = name.startswith('-')
+            name = name.lstrip('-')
+            results.sort(key=lambda e: getattr(e, name), reverse=reverse)
+        return results
+
+    def value_of(self, entity, name):
+        if '__key__' == name:
+            return entity.key()
+        return getattr(entity, name)
+
+    def fetch(self, limit, offset=0):
+        if limit is None:
+            results = self.run()[offset:]
+        else:
+            results = self.run()[offset:offset + limit]
+        if self._keys_only:
+            return [ r.key() for r in results ]
+        return [ self.backend.load(r) for r in results ]
+
+    def get(self):
+        results = self.fetch(1)
+        return results and results[0] or None
+
+    def count(self, limit=None):
+        count = len(self.run())
+        if limit is not None: count = min(count, limit)
+        return count
+
+    def __iter__(self):
+        return iter(self.fetch(None))
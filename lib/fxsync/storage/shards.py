@@ -0,0 +1,509 @@
+"""
+Per-user sharded SQLite storage backend, for the standalone server
+
+Each profile's collections and WBOs are kept in an SQLite file of their
+own, so that writers for different users never wait on the same database
+lock. Every collection and WBO key has its profile's key at the root, and
+that profile is the one profile_auth found by user name, so routing on
+the root key sends all of a user's requests to their shard. Profiles
+themselves are kept in a shared directory database, since they are
+looked up by user name before there is a key to route on.
+
+Open shards are kept in an LRU, with the least recently used closed once
+too many are open, to stay within the file descriptor limit. Admin
+operations across all users, stats() and export(), run over the shard
+files in parallel.
+
+With group commit on, each open shard has a writer thread of its own, and
+a transaction is handed to the writer of the first shard it touches.
+
+The files are kept in the directory FXSYNC_SHARD_PATH, or fxsync-shards
+in the current directory.
+"""
+import os, hashlib, threading, Queue
+from collections import OrderedDict
+from django.utils import simplejson
+from google.appengine.ext import db
+from fxsync.storage.base import StorageBackend
+from fxsync.storage.sqlite import SqliteBackend, TABLES, GROUP_COMMIT_DELAY
+from fxsync.storage.index import MAX_RECORDS
+
+DEFAULT_PATH = 'fxsync-shards'
+
+# Shards kept open at once, each holding SHARD_POOL_SIZE connections
+MAX_OPEN_SHARDS = 64
+SHARD_POOL_SIZE = 2
+
+# Threads working through the shards in admin operations
+ADMIN_WORKERS = 8
+
+# Kinds kept in the directory, rather than in a user's shard
+DIRECTORY_KINDS = ('Profile',)
+
+class RouteTransaction(Exception):
+    """Raised on first touching a group committed shard in a transaction,
+    for the transaction to start over on the shard's writer thread"""
+
+    def __init__(self, name):
+        Exception.__init__(self, name)
+        self.name = name
+
+class ShardBackend(SqliteBackend):
+    """SQLite storage for one user, finding profiles in the directory"""
+
+    def __init__(self, directory, path, pool_size, index=True, **kwargs):
+        self.directory = directory
+        # Callers currently using the shard, which keep it from closing
+        self.users = 0
+        SqliteBackend.__init__(self, path, pool_size, index, **kwargs)
+
+    def get_reference(self, conn, str_key, known):
+        if db.Key(str_key).kind() in DIRECTORY_KINDS:
+            return self.directory.get(str_key)
+        return SqliteBackend.get_reference(self, conn, str_key, known)
+
+class ShardedBackend(StorageBackend):
+    """Storage in an SQLite file per user"""
+
+    def __init__(self, path=None, max_open=MAX_OPEN_SHARDS,
+            pool_size=SHARD_POOL_SIZE, index=True, group_commit=False,
+            group_commit_delay=GROUP_COMMIT_DELAY):
+        self.path = path or os.environ.get('FXSYNC_SHARD_PATH', DEFAULT_PATH)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.directory = SqliteBackend(
+            os.path.join(self.path, 'directory.sqlite'), index=False)
+        self.max_open = max_open
+        self.pool_size = pool_size
+        self.index = index
+        # Each open shard has a group commit writer thread of its own
+        self.group_commit = group_commit
+        self.group_commit_delay = group_commit_delay
+        if index:
+            self.index_cache = ShardIndexes(self)
+        # Shard name -> ShardBackend, least recently used first
+        self.shards = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for shard in self.shards.values():
+                shard.close()
+            self.shards.clear()
+            self.directory.close()
+        finally:
+            self.lock.release()
+
+    def route(self, key):
+        """Name the shard holding a key, or None for the directory"""
+        if isinstance(key, basestring):
+            key = db.Key(key)
+        if key.kind() in DIRECTORY_KINDS:
+            return None
+        return self.route_ancestor(key)
+
+    def route_ancestor(self, key):
+        """Name the shard holding the descendants of a key, which is that
+        of the user at its root, even for a profile key itself"""
+        if isinstance(key, basestring):
+            key = db.Key(key)
+        while key.parent():
+            key = key.parent()
+        return 'user-%s.sqlite' % hashlib.md5(str(key)).hexdigest()
+
+    def route_entity(self, entity):
+        if entity.kind() in DIRECTORY_KINDS:
+            return None
+        if entity.has_key():
+            return self.route(entity.key())
+        return self.route_ancestor(entity.parent_key())
+
+    def acquire(self, name, create=True):
+        """Get a shard by name, or the directory for None, keeping it open
+        until released. Only shards already open are returned unless
+        create is true."""
+        if name is None:
+            return self.directory
+        self.lock.acquire()
+        try:
+            shard = self.shards.pop(name, None)
+            if shard is None:
+                if not create: return None
+                shard = ShardBackend(self.directory,
+                    os.path.join(self.path, name), self.pool_size,
+                    self.index, group_commit=self.group_commit,
+                    group_commit_delay=self.group_commit_delay)
+                if self.index:
+                    shard.index_cache.max_records = \
+                        MAX_RECORDS // self.max_open
+            self.shards[name] = shard
+            shard.users += 1
+            self.evict()
+            return shard
+        finally:
+            self.lock.release()
+
+    def release(self, backend):
+        if backend is self.directory:
+            return
+        self.lock.acquire()
+        try:
+            backend.users -= 1
+            self.evict()
+        finally:
+            self.lock.release()
+
+    def evict(self):
+        """Close least recently used shards, while too many are open.
+        Shards in use stay open, even past the limit, until released."""
+        excess = len(self.shards) - self.max_open
+        for name, shard in self.shards.items():
+            if excess <= 0: break
+            if not shard.users:
+                del self.shards[name]
+                shard.close()
+                excess -= 1
+
+    def call(self, name, fn, *args, **kwargs):
+        """Call fn(backend, *args, **kwargs) on the named shard, or the
+        directory, joining it to the current transaction if any"""
+        txn = getattr(self.local, 'txn', None)
+        if txn is None:
+            backend = self.acquire(name)
+            try:
+                return fn(backend, *args, **kwargs)
+            finally:
+                self.release(backend)
+        if name not in txn:
+            backend = self.acquire(name)
+            if backend.committer is not None and self.local.routed is None:
+                self.release(backend)
+                raise RouteTransaction(name)
+            try:
+                backend.begin()
+            except:
+                self.release(backend)
+                raise
+            txn[name] = backend
+        return fn(txn[name], *args, **kwargs)
+
+    def get(self, keys):
+        if not isinstance(keys, (list, tuple)):
+            return self.get([ keys ])[0]
+        keys = [ isinstance(k, basestring) and db.Key(k) or k for k in keys ]
+        by_shard = {}
+        for key in keys:
+            by_shard.setdefault(self.route(key), []).append(key)
+        found = {}
+        for name, shard_keys in by_shard.items():
+            entities = self.call(name, SqliteBackend.get, shard_keys)
+            found.update(zip([ str(k) for k in shard_keys ], entities))
+        return [ found[str(k)] for k in keys ]
+
+    def put(self, entities):
+        if not isinstance(entities, (list, tuple)):
+            return self.put([ entities ])[0]
+        by_shard = {}
+        for entity in entities:
+            by_shard.setdefault(self.route_entity(entity), []).append(entity)
+        for name, shard_entities in by_shard.items():
+            self.call(name, SqliteBackend.put, shard_entities)
+        return [ e.key() for e in entities ]
+
+    def delete(self, entities):
+        if not isinstance(entities, (list, tuple)):
+            entities = [ entities ]
+        by_shard = {}
+        for entity in entities:
+            key = isinstance(entity, db.Key) and entity or entity.key()
+            by_shard.setdefault(self.route(key), []).append(key)
+        for name, keys in by_shard.items():
+            self.call(name, SqliteBackend.delete, keys)
+
+    def query(self, model_class, keys_only=False):
+        return ShardedQuery(self, model_class, keys_only)
+
+    def fetch_values(self, query, name, limit, offset=0):
+        return query.fetch_values(name, limit, offset)
+
+    def get_or_insert(self, model_class, key_name, **kwds):
+        name = None
+        if model_class.kind() not in DIRECTORY_KINDS:
+            parent = kwds.get('parent', None)
+            if isinstance(parent, db.Model): parent = parent.key()
+            name = self.route_ancestor(parent)
+        return self.call(name, SqliteBackend.get_or_insert, model_class,
+            key_name, **kwds)
+
+    def run_in_transaction(self, fn, *args, **kwargs):
+        if getattr(self.local, 'txn', None) is not None:
+            # Nested, so the outer transaction commits or rolls back
+            return fn(*args, **kwargs)
+        try:
+            return self.run_joined(fn, args, kwargs)
+        except RouteTransaction, e:
+            name = e.name
+        # With group commit, the transaction starts over as a job of the
+        # writer thread of the first shard it touched. Nothing had been
+        # written to the shard yet, and anything in the directory was
+        # rolled back, so it runs again from the top, as datastore
+        # transactions may be retried.
+        shard = self.acquire(name)
+        try:
+            return shard.run_in_transaction(self.run_joined, fn, args,
+                kwargs, name, shard)
+        finally:
+            self.release(shard)
+
+    def run_joined(self, fn, args, kwargs, name=None, routed=None):
+        """Call fn(*args, **kwargs) in a transaction which shards join as
+        they are first touched, besides the named routed shard, whose own
+        transaction the call is already in"""
+        # Shards join the transaction as they are first touched, and are
+        # committed together at the end. That is not atomic across shards,
+        # but a transaction only ever touches one user's data.
+        txn = self.local.txn = {}
+        self.local.routed = routed
+        if routed is not None:
+            txn[name] = routed
+        joined = lambda: [ b for b in txn.values() if b is not routed ]
+        try:
+            try:
+                rv = fn(*args, **kwargs)
+            except:
+                for backend in joined():
+                    backend.rollback()
+                raise
+            backends = joined()
+            while backends:
+                try:
+                    backends[0].commit()
+                except:
+                    for backend in backends[1:]:
+                        backend.rollback()
+                    raise
+                backends.pop(0)
+            return rv
+        finally:
+            self.local.txn = self.local.routed = None
+            for backend in joined():
+                self.release(backend)
+
+    def shard_names(self):
+        return sorted( name for name in os.listdir(self.path)
+            if name.startswith('user-') and name.endswith('.sqlite') )
+
+    def map_shards(self, fn, workers=ADMIN_WORKERS):
+        """Call fn(shard) for every shard on disk, in parallel threads,
+        returning the results by shard name. Shards not already open are
+        opened just for the call, so that they don't push busy shards out
+        of the LRU."""
+        names = Queue.Queue()
+        for name in self.shard_names():
+            names.put(name)
+        results, errors = {}, []
+
+        def work():
+            while True:
+                try:
+                    name = names.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    shard = self.acquire(name, create=False)
+                    if shard is not None:
+                        try:
+                            results[name] = fn(shard)
+                        finally:
+                            self.release(shard)
+                        continue
+                    shard = ShardBackend(self.directory,
+                        os.path.join(self.path, name), 1, False)
+                    try:
+                        results[name] = fn(shard)
+                    finally:
+                        shard.close()
+                except Exception, e:
+                    errors.append(e)
+
+        threads = [ threading.Thread(target=work) for i in range(workers) ]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def stats(self):
+        """Count the collections, WBOs and bytes of every shard"""
+        def shard_stats(shard):
+            def count(conn):
+                return {
+                    'collections': conn.execute(
+                        'SELECT count(*) FROM Collection').fetchone()[0],
+                    'wbos': conn.execute(
+                        'SELECT count(*) FROM WBO').fetchone()[0],
+                    'payload_bytes': conn.execute(
+                        'SELECT total(payload_size) FROM WBO').fetchone()[0],
+                    'file_bytes': os.path.getsize(shard.path),
+                }
+            return shard.read(count)
+        shards = self.map_shards(shard_stats)
+        totals = { 'shards': len(shards), 'open_shards': len(self.shards) }
+        for stats in shards.values():
+            for name, value in stats.items():
+                totals[name] = totals.get(name, 0) + value
+        return { 'totals': totals, 'shards': shards }
+
+    def export(self, out_dir):
+        """Write the collections and WBOs of every shard to a file of JSON
+        lines per shard in out_dir, returning the records written by
+        shard name"""
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+
+        def export_shard(shard):
+            out = open(os.path.join(out_dir,
+                os.path.basename(shard.path)[:-len('.sqlite')] + '.json'), 'w')
+            def dump(conn):
+                written = 0
+                for kind in ('Collection', 'WBO'):
+                    columns = [ 'key', 'parent_key' ] + [
+                        c for c, t in TABLES[kind] ]
+                    for row in conn.execute('SELECT %s FROM %s' % (
+                            ', '.join(columns), kind)):
+                        record = dict(zip(columns, row))
+                        record['kind'] = kind
+                        out.write(simplejson.dumps(record) + '\n')
+                        written += 1
+                return written
+            try:
+                return shard.read(dump)
+            finally:
+                out.close()
+        return self.map_shards(export_shard)
+
+class ShardedQuery(object):
+    """Query routed to a single shard, by its ancestor, or to the directory
+
+    Queries for kinds kept in shards are routed to the shard of the user at
+    the root of their ancestor. Without an ancestor, they are run on every
+    shard, with the results merged and sorted in memory, which is only fit
+    for admin work and tests.
+    """
+
+    def __init__(self, backend, model_class, keys_only=False):
+        self.backend = backend
+        self.model_class = model_class
+        self._keys_only = keys_only
+        self.ancestor_key = None
+        self.calls = []
+
+    def ancestor(self, ancestor):
+        if isinstance(ancestor, db.Model):
+            self.ancestor_key = ancestor.key()
+        else:
+            self.ancestor_key = ancestor
+        self.calls.append(('ancestor', ancestor))
+        return self
+
+    def filter(self, property_operator, value):
+        self.calls.append(('filter', property_operator, value))
+        return self
+
+    def order(self, name):
+        self.calls.append(('order', name))
+        return self
+
+    def run(self, name, *args):
+        """Build the query on its shard and call one of its methods"""
+        shard_name = None
+        if self.model_class.kind() not in DIRECTORY_KINDS:
+            shard_name = self.backend.route_ancestor(self.ancestor_key)
+        return self.backend.call(shard_name, self.run_on, name, *args)
+
+    def run_on(self, shard, name, *args):
+        """Build the query on a shard and call one of its methods"""
+        q = shard.query(self.model_class, self._keys_only)
+        for call in self.calls:
+            getattr(q, call[0])(*call[1:])
+        return getattr(q, name)(*args)
+
+    def is_fanned_out(self):
+        """Whether the query has to run on every shard"""
+        return (self.ancestor_key is None and
+            self.model_class.kind() not in DIRECTORY_KINDS)
+
+    def run_all(self, name, *args):
+        """Call a method of the query on every shard, in shard order"""
+        results = self.backend.map_shards(
+            lambda shard: self.run_on(shard, name, *args))
+        return [ results[n] for n in sorted(results) ]
+
+    def fetch(self, limit, offset=0):
+        if not self.is_fanned_out():
+            return self.run('fetch', limit, offset)
+        rows = []
+        for shard_rows in self.run_all('fetch',
+                limit is not None and limit + offset or None, 0):
+            rows.extend(shard_rows)
+        if not self._keys_only:
+            # Stable sorts, least significant order first
+            for call in reversed(self.calls):
+                if 'order' == call[0]:
+                    prop = call[1].lstrip('-')
+                    rows.sort(key=lambda e: getattr(e, prop),
+                        reverse=call[1].startswith('-'))
+        if limit is None:
+            return rows[offset:]
+        return rows[offset:offset + limit]
+
+    def fetch_values(self, name, limit, offset=0):
+        if not self.is_fanned_out():
+            return self.run('fetch_values', name, limit, offset)
+        return [ getattr(e, name) for e in self.fetch(limit, offset) ]
+
+    def get(self):
+        if not self.is_fanned_out():
+            return self.run('get')
+        rows = self.fetch(1)
+        return rows and rows[0] or None
+
+    def count(self, limit=None):
+        if not self.is_fanned_out():
+            return self.run('count', limit)
+        total = sum(self.run_all('count', limit))
+        if limit is not None:
+            total = min(total, limit)
+        return total
+
+    def __iter__(self):
+        return iter(self.fetch(None))
+
+class ShardIndexes(object):
+    """The collection indexes of each shard, behind the IndexCache calls
+    that Collection.retrieve makes"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def select(self, collection_key, **criteria):
+        return self.backend.call(self.backend.route(collection_key),
+            lambda shard: shard.index_cache.select(collection_key,
+                **criteria))
+
+    def stats(self):
+        self.backend.lock.acquire()
+        try:
+            shards = self.backend.shards.values()
+        finally:
+            self.backend.lock.release()
+        totals = { 'collections': 0, 'records': 0, 'bytes': 0 }
+        for shard in shards:
+            for name, value in shard.index_cache.stats().items():
+                if name in totals:
+                    totals[name] += value
+        totals['bytes_per_record'] = totals['records'] and \
+            float(totals['bytes']) / totals['records'] or 0
+        return totals
@@ -0,0 +1,527 @@
+"""
+SQLite storage backend, for self-hosting outside App Engine
+
+The tables are laid out for the query shapes of Collection.retrieve, with
+WBOs indexed by collection and each of modified, sortindex, parentid and
+predecessorid. Tables are WITHOUT ROWID (SQLite 3.8.2 or later), so every
+secondary index carries the primary key along, and ID listings and counts
+are answered from the indexes alone.
+
+The database file is FXSYNC_SQLITE_PATH, or fxsync.sqlite in the current
+directory, and is opened in WAL mode so that readers never wait on the
+writer. Collection.retrieve filters and sorts on in-memory indexes kept
+up to date as transactions commit, which is only safe while this process
+is the only writer to the file.
+
+With group commit on, transactions from every thread are handed to one
+writer thread, which runs those arriving close together in a single
+SQLite transaction, so that one commit and fsync covers them all.
+"""
+import sys, os, time, threading, Queue
+import sqlite3
+from google.appengine.ext import db
+from fxsync import context
+from fxsync.storage.base import StorageBackend, to_column, from_column
+from fxsync.storage.index import IndexCache
+
+DEFAULT_PATH = 'fxsync.sqlite'
+POOL_SIZE = 4
+
+# Statements are built with placeholders, so the per-connection cache of
+# prepared statements sees the same few SQL strings over and over.
+CACHED_STATEMENTS = 256
+
+# Rows per statement, for batch gets and deletes by key
+BATCH_SIZE = 500
+
+# Most transactions run in one group commit, and the longest the writer
+# waits for more to arrive once it has one, in seconds
+GROUP_COMMIT_SIZE = 100
+GROUP_COMMIT_DELAY = 0.002
+
+# Columns by kind, after key and parent_key, named for model properties
+TABLES = {
+    'Profile': (
+        ('user', 'TEXT'), ('user_name', 'TEXT'), ('user_id', 'TEXT'),
+        ('password', 'TEXT'), ('created_at', 'REAL'), ('updated_at', 'REAL'),
+    ),
+    'Collection': (
+        ('profile', 'TEXT'), ('name', 'TEXT'), ('modified', 'REAL'),
+    ),
+    'WBO': (
+        ('collection', 'TEXT'), ('wbo_id', 'TEXT'), ('modified', 'REAL'),
+        ('parentid', 'TEXT'), ('predecessorid', 'TEXT'),
+        ('sortindex', 'INTEGER'), ('payload', 'TEXT'),
+        ('payload_size', 'INTEGER'),
+    ),
+}
+
+INDEXES = (
+    ('Profile', ('user_name',)),
+    ('Profile', ('user_id',)),
+    ('Collection', ('parent_key', 'name', 'modified')),
+    ('WBO', ('parent_key', 'wbo_id')),
+    ('WBO', ('parent_key', 'modified', 'wbo_id')),
+    ('WBO', ('parent_key', 'sortindex', 'wbo_id')),
+    ('WBO', ('parent_key', 'parentid', 'wbo_id')),
+    ('WBO', ('parent_key', 'predecessorid', 'wbo_id')),
+)
+
+def sql_value(value):
+    """Convert a query filter value to an SQLite value"""
+    if isinstance(value, db.Model):
+        return str(value.key())
+    if isinstance(value, db.Key):
+        return str(value)
+    return value
+
+class SqliteBackend(StorageBackend):
+    """Storage in an SQLite database file"""
+
+    def __init__(self, path=None, pool_size=POOL_SIZE, index=True,
+            group_commit=False, group_commit_delay=GROUP_COMMIT_DELAY):
+        self.path = path or os.environ.get('FXSYNC_SQLITE_PATH', DEFAULT_PATH)
+        if index:
+            self.index_cache = IndexCache(self.index_rows)
+        self.local = threading.local()
+        self.group_commit = group_commit
+        self.pool = Queue.Queue()
+        for i in range(pool_size):
+            self.pool.put(self.connect())
+        self.read(self.create_tables)
+        self.committer = None
+        if group_commit:
+            self.committer = GroupCommitter(self, group_commit_delay)
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30,
+            isolation_level=None, check_same_thread=False,
+            cached_statements=CACHED_STATEMENTS)
+        conn.execute('PRAGMA journal_mode=WAL')
+        if self.group_commit:
+            # Writers are only told of commits once they are on disk,
+            # with the fsync shared by the whole group.
+            conn.execute('PRAGMA synchronous=FULL')
+        else:
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def close(self):
+        """Finish any group commit, and close all the pooled connections"""
+        if self.committer is not None:
+            self.committer.stop()
+        while not self.pool.empty():
+            self.pool.get().close()
+
+    def create_tables(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS ids '
+            '(id INTEGER PRIMARY KEY AUTOINCREMENT)')
+        for kind, columns in TABLES.items():
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, '
+                'parent_key TEXT, %s) WITHOUT ROWID' % (kind, ', '.join(
+                    '%s %s' % c for c in columns
+                ))
+            )
+        for kind, columns in INDEXES:
+            conn.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)' % (
+                kind, '_'.join(columns), kind, ', '.join(columns)
+            ))
+
+    def read(self, fn, *args):
+        """Call fn(connection, *args), in the current transaction if any"""
+        if self.in_transaction():
+            return fn(self.local.conn, *args)
+        conn = self.pool.get()
+        try:
+            return fn(conn, *args)
+        finally:
+            self.pool.put(conn)
+
+    def write(self, fn, *args):
+        """Call fn(connection, *args) inside a transaction"""
+        return self.run_in_transaction(lambda: fn(self.local.conn, *args))
+
+    def run_in_transaction(self, fn, *args, **kwargs):
+        if self.in_transaction():
+            # Nested, so the outer transaction commits or rolls back
+            return fn(*args, **kwargs)
+        if self.committer is not None:
+            return self.committer.run(fn, args, kwargs)
+        self.begin()
+        try:
+            rv = fn(*args, **kwargs)
+        except:
+            self.rollback()
+            raise
+        self.commit()
+        return rv
+
+    def in_transaction(self):
+        return getattr(self.local, 'conn', None) is not None
+
+    def begin(self):
+        """Start a transaction on this thread, holding a pooled connection
+        until commit() or rollback()"""
+        conn = self.pool.get()
+        self.local.conn = conn
+        self.local.changes = []
+        try:
+            # Take the write lock up front, so that reads in the
+            # transaction cannot go stale before its writes.
+            conn.execute('BEGIN IMMEDIATE')
+        except:
+            self.end()
+            raise
+
+    def commit(self):
+        try:
+            self.local.conn.execute('COMMIT')
+        except:
+            self.rollback()
+            raise
+        self.end()
+        # Indexes only see what has been committed
+        for name, items in self.local.changes:
+            getattr(self.index_cache, name)(items)
+
+    def rollback(self):
+        try:
+            self.local.conn.execute('ROLLBACK')
+        finally:
+            self.end()
+
+    def end(self):
+        conn, self.local.conn = self.local.conn, None
+        self.pool.put(conn)
+
+    def note_change(self, name, items):
+        """Queue an index update for when the transaction commits"""
+        if self.index_cache:
+            self.local.changes.append((name, items))
+
+    def get(self, keys):
+        if isinstance(keys, (list, tuple)):
+            return self.read(self.get_rows, keys)
+        return self.read(self.get_rows, [ keys ])[0]
+
+    def get_rows(self, conn, keys, known=None):
+        keys = [ isinstance(k, basestring) and db.Key(k) or k for k in keys ]
+        found = {}
+        by_kind = {}
+        for key in keys:
+            by_kind.setdefault(key.kind(), []).append(str(key))
+        for kind, str_keys in by_kind.items():
+            model_class = db.class_for_kind(kind)
+            for i in range(0, len(str_keys), BATCH_SIZE):
+                batch = str_keys[i:i + BATCH_SIZE]
+                rows = conn.execute(
+                    'SELECT key, %s FROM %s WHERE key IN (%s)' % (
+                        ', '.join(c for c, t in TABLES[kind]), kind,
+                        ', '.join('?' for k in batch)
+                    ), batch).fetchall()
+                for entity in self.build_entities(conn, model_class, rows,
+                        known):
+                    found[str(entity.key())] = entity
+        return [ found.get(str(k), None) for k in keys ]
+
+    def get_reference(self, conn, str_key, known):
+        """Get an entity referenced by another being built"""
+        return self.get_rows(conn, [ str_key ], known)[0]
+
+    def build_entities(self, conn, model_class, rows, known=None):
+        """Build entities from rows of key and property columns, resolving
+        references from the database rather than the datastore"""
+        if known is None: known = {}
+        props = [ model_class.properties()[c] for c, t in
+            TABLES[model_class.kind()] ]
+        entities = []
+        for row in rows:
+            values = {}
+            for prop, value in zip(props, row[1:]):
+                value = from_column(prop, value)
+                if value is not None and \
+                        isinstance(prop, db.ReferenceProperty):
+                    if value not in known:
+                        known[value] = self.get_reference(conn, value, known)
+                    value = known[value]
+                values[prop.name] = value
+            entity = model_class(key=db.Key(row[0]), **values)
+            known[row[0]] = entity
+            entities.append(entity)
+        return entities
+
+    def put(self, entities):
+        if not isinstance(entities, (list, tuple)):
+            return self.write(self.put_rows, [ entities ])[0]
+        return self.write(self.put_rows, entities)
+
+    def put_rows(self, conn, entities):
+        by_kind = {}
+        for entity in entities:
+            if not entity.has_key():
+                # HACK: Reaching into db.Model, to give the entity the kind
+                # of key the datastore would have.
+                entity_id = conn.execute(
+                    'INSERT INTO ids DEFAULT VALUES').lastrowid
+                entity._key = db.Key.from_path(entity.kind(), entity_id,
+                    parent=entity.parent_key())
+            by_kind.setdefault(entity.kind(), []).append(entity)
+        for kind, kind_entities in by_kind.items():
+            columns = [ c for c, t in TABLES[kind] ]
+            props = [ kind_entities[0].properties()[c] for c in columns ]
+            conn.executemany(
+                'INSERT OR REPLACE INTO %s (key, parent_key, %s) '
+                'VALUES (?, ?, %s)' % (
+                    kind, ', '.join(columns), ', '.join('?' for c in columns)
+                ), [
+                    [ str(e.key()), sql_value(e.parent_key()) ] +
+                    [ to_column(p, e) for p in props ]
+                    for e in kind_entities
+                ])
+        self.note_change('put', entities)
+        return [ e.key() for e in entities ]
+
+    def delete(self, entities):
+        if not isinstance(entities, (list, tuple)):
+            entities = [ entities ]
+        self.write(self.delete_rows, entities)
+
+    def delete_rows(self, conn, entities):
+        by_kind = {}
+        keys = [ isinstance(e, db.Key) and e or e.key() for e in entities ]
+        for key in keys:
+            by_kind.setdefault(key.kind(), []).append(str(key))
+        for kind, str_keys in by_kind.items():
+            for i in range(0, len(str_keys), BATCH_SIZE):
+                batch = str_keys[i:i + BATCH_SIZE]
+                conn.execute('DELETE FROM %s WHERE key IN (%s)' % (
+                    kind, ', '.join('?' for k in batch)
+                ), batch)
+        self.note_change('delete', keys)
+
+    def query(self, model_class, keys_only=False):
+        return SqliteQuery(self, model_class, keys_only)
+
+    def fetch_values(self, query, name, limit, offset=0):
+        return query.fetch_values(name, limit, offset)
+
+    def index_rows(self, collection_key):
+        def select(conn):
+            return conn.execute('SELECT key, wbo_id, modified, sortindex, '
+                'parentid, predecessorid FROM WBO WHERE parent_key = ?',
+                (str(collection_key),)).fetchall()
+        return self.read(select)
+
+    def get_or_insert(self, model_class, key_name, **kwds):
+        def txn():
+            parent = kwds.get('parent', None)
+            if isinstance(parent, db.Model): parent = parent.key()
+            key = db.Key.from_path(model_class.kind(), key_name, parent=parent)
+            entity = self.get(key)
+            if entity is None:
+                entity = model_class(key_name=key_name, **kwds)
+                self.put(entity)
+            return entity
+        return self.run_in_transaction(txn)
+
+class GroupCommitter(object):
+    """Writer thread running the transactions of an SqliteBackend in groups
+
+    Each transaction function runs on the writer thread, inside a savepoint
+    of the group's SQLite transaction, so that one failing rolls back only
+    its own changes, and with the request context of the thread that
+    handed it over, so that its calls are counted, traced and remembered
+    for that request. The threads that handed them over wait until the
+    whole group has committed.
+    """
+
+    def __init__(self, backend, max_delay=GROUP_COMMIT_DELAY,
+            max_size=GROUP_COMMIT_SIZE):
+        self.backend = backend
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self, fn, args, kwargs):
+        """Run fn(*args, **kwargs) in the next group, waiting for it to
+        commit"""
+        job = GroupJob(fn, args, kwargs)
+        self.queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error[0], job.error[1], job.error[2]
+        return job.result
+
+    def stop(self):
+        """Commit whatever is queued, then end the writer thread"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def loop(self):
+        running = True
+        while running:
+            job = self.queue.get()
+            if job is None: break
+            group = [ job ]
+            deadline = time.time() + self.max_delay
+            while len(group) < self.max_size:
+                try:
+                    job = self.queue.get(True,
+                        max(0, deadline - time.time()))
+                except Queue.Empty:
+                    break
+                if job is None:
+                    running = False
+                    break
+                group.append(job)
+            self.commit(group)
+
+    def commit(self, group):
+        backend = self.backend
+        try:
+            backend.begin()
+            conn = backend.local.conn
+            for job in group:
+                changes = len(backend.local.changes)
+                conn.execute('SAVEPOINT job')
+                context.local.context = job.context
+                try:
+                    job.result = job.fn(*job.args, **job.kwargs)
+                except:
+                    job.error = sys.exc_info()
+                    conn.execute('ROLLBACK TO job')
+                    del backend.local.changes[changes:]
+                context.local.context = None
+                conn.execute('RELEASE job')
+            backend.commit()
+        except:
+            error = sys.exc_info()
+            context.local.context = None
+            if backend.in_transaction():
+                backend.rollback()
+            for job in group:
+                if job.error is None:
+                    job.error = error
+        for job in group:
+            job.done.set()
+
+class GroupJob(object):
+    """A transaction waiting on a GroupCommitter"""
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.context = context.current()
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class SqliteQuery(object):
+    """Query over entities in an SqliteBackend, mimicking db.Query
+
+    ancestor() matches only direct children of the ancestor, which is all
+    that the models ask of it.
+    """
+
+    OPERATORS = ('=', '<', '<=', '>', '>=', 'IN')
+
+    def __init__(self, backend, model_class, keys_only=False):
+        self.backend = backend
+        self.model_class = model_class
+        self._keys_only = keys_only
+        self.ancestor_entity = None
+        self.where = []
+        self.params = []
+        self.orders = []
+
+    def ancestor(self, ancestor):
+        if isinstance(ancestor, db.Model):
+            self.ancestor_entity = ancestor
+        self.where.append('parent_key = ?')
+        self.params.append(sql_value(ancestor))
+        return self
+
+    def filter(self, property_operator, value):
+        parts = property_operator.split()
+        name, op = parts[0], (len(parts) > 1 and parts[1] or '=')
+        if op not in self.OPERATORS:
+            raise ValueError('unsupported operator %s' % op)
+        if '__key__' == name:
+            name = 'key'
+        if 'IN' == op:
+            values = [ sql_value(v) for v in value ]
+            if not values:
+                self.where.append('0')
+            else:
+                self.where.append('%s IN (%s)' % (
+                    name, ', '.join('?' for v in values)
+                ))
+                self.params.extend(values)
+        else:
+            self.where.append('%s %s ?' % (name, op))
+            self.params.append(sql_value(value))
+        return self
+
+    def order(self, name):
+        if name.startswith('-'):
+            self.orders.append('%s DESC' % name[1:])
+        else:
+            self.orders.append(name)
+        return self
+
+    def build_sql(self, columns, limit=None, offset=0):
+        """Build a SELECT statement and its parameters for this query"""
+        sql = 'SELECT %s FROM %s' % (columns, self.model_class.kind())
+        params = list(self.params)
+        if self.where:
+            sql += ' WHERE ' + ' AND '.join(self.where)
+        if self.orders:
+            sql += ' ORDER BY ' + ', '.join(self.orders)
+        if limit is not None or offset:
+            sql += ' LIMIT ? OFFSET ?'
+            params.extend([ limit is None and -1 or limit, offset or 0 ])
+        return (sql, params)
+
+    def fetch(self, limit, offset=0):
+        if self._keys_only:
+            sql, params = self.build_sql('key', limit, offset)
+            rows = self.backend.read(lambda conn:
+                conn.execute(sql, params).fetchall())
+            return [ db.Key(r[0]) for r in rows ]
+
+        sql, params = self.build_sql('key, ' + ', '.join(
+            c for c, t in TABLES[self.model_class.kind()]
+        ), limit, offset)
+        known = {}
+        if self.ancestor_entity is not None:
+            known[str(self.ancestor_entity.key())] = self.ancestor_entity
+        return self.backend.read(lambda conn:
+            self.backend.build_entities(conn, self.model_class,
+                conn.execute(sql, params).fetchall(), known))
+
+    def fetch_values(self, name, limit, offset=0):
+        """Fetch just one property of each result, which an index can
+        usually answer without touching the table"""
+        prop = self.model_class.properties()[name]
+        sql, params = self.build_sql(name, limit, offset)
+        rows = self.backend.read(lambda conn:
+            conn.execute(sql, params).fetchall())
+        return [ from_column(prop, r[0]) for r in rows ]
+
+    def get(self):
+        results = self.fetch(1)
+        return results and results[0] or None
+
+    def count(self, limit=None):
+        sql, params = self.build_sql('1', limit)
+        return self.backend.read(lambda conn: conn.execute(
+            'SELECT count(*) FROM (%s)' % sql, params
+        ).fetchone()[0])
+
+    def __iter__(self):
+        return iter(self.fetch(None))
@@ -0,0 +1,115 @@
+"""
+Tracing of spans within sampled requests
+
+TraceMiddleware picks a fraction RATE of requests to trace. Within those,
+functions decorated with traced(name) record a span for each call on the
+request context, as do the auth and JSON decorators, the model lookups
+used by handlers, and output encoding. When the request ends, its spans
+are written as a file of Chrome trace events, which chrome://tracing and
+Perfetto can show, to PATH. Each trace is named after its request id,
+returned in the X-Fxsync-Trace-Id header.
+
+Tracing is off unless FXSYNC_TRACE_RATE is set, or --trace-rate is given
+to the standalone server. Requests not traced only pay for a check of the
+request context in each traced call.
+"""
+import os, time, uuid, random, thread, logging
+from django.utils import simplejson
+from fxsync import context, metrics
+
+RATE = float(os.environ.get('FXSYNC_TRACE_RATE', 0) or 0)
+PATH = os.environ.get('FXSYNC_TRACE_PATH', 'fxsync-traces')
+
+TRACE_ID_HEADER = 'X-Fxsync-Trace-Id'
+
+class Trace(object):
+    """Spans recorded during a request"""
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.spans = []
+
+    def add(self, name, start, end):
+        self.spans.append((name, start, end, thread.get_ident()))
+
+    def as_events(self):
+        """Convert the spans to complete events, in microseconds"""
+        pid = os.getpid()
+        return [ {
+            'name': name, 'cat': 'fxsync', 'ph': 'X',
+            'ts': int(start * 1000000), 'dur': int((end - start) * 1000000),
+            'pid': pid, 'tid': tid,
+            'args': { 'request_id': self.request_id },
+        } for name, start, end, tid in self.spans ]
+
+    def save(self, path=None):
+        """Write the trace to a file named after the request id"""
+        path = path or PATH
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        name = os.path.join(path, '%s.json' % self.request_id)
+        out = open(name, 'w')
+        try:
+            simplejson.dump({ 'traceEvents': self.as_events(),
+                'displayTimeUnit': 'ms' }, out)
+        finally:
+            out.close()
+        return name
+
+def current_trace():
+    """Get the trace of the current request, if it is being traced"""
+    ctx = context.current()
+    return ctx is not None and getattr(ctx, 'trace', None) or None
+
+def traced(name):
+    """Decorator recording a span for each call in a traced request"""
+    def decorator(func):
+        def cb(*args, **kwargs):
+            trace = current_trace()
+            if trace is None:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                trace.add(name, start, time.time())
+        cb.__name__, cb.__doc__ = func.__name__, func.__doc__
+        return cb
+    return decorator
+
+class TraceMiddleware(object):
+    """WSGI middleware tracing a sample of requests, with a span for the
+    whole request named after its handler. Goes inside ContextMiddleware.
+    """
+
+    def __init__(self, app, api, routes):
+        self.app = app
+        self.api = api
+        self.routes = metrics.compile_routes(routes)
+
+    def __call__(self, environ, start_response):
+        ctx = context.current()
+        if not RATE or ctx is None or random.random() >= RATE:
+            return self.app(environ, start_response)
+
+        trace = ctx.trace = Trace(os.environ.get('REQUEST_LOG_ID') or
+            uuid.uuid4().hex)
+        route, collection = metrics.match_route(self.routes,
+            environ.get('PATH_INFO', ''))
+
+        def trace_start_response(status, headers, exc_info=None):
+            headers = list(headers) + [ (TRACE_ID_HEADER, trace.request_id) ]
+            return start_response(status, headers, exc_info)
+
+        start = time.time()
+        try:
+            return self.app(environ, trace_start_response)
+        finally:
+            trace.add('%s %s.%s' % (environ.get('REQUEST_METHOD'),
+                self.api, route), start, time.time())
+            ctx.trace = None
+            try:
+                trace.save()
+            except (IOError, OSError), e:
+                logging.warning('Failed to save trace %s: %s' % (
+                    trace.request_id, e))
@@ -8,14 +8,20 @@ base_dir = os.path.dirname( os.path.dirname(__file__) )
 sys.path.extend([ os.path.join(base_dir, d) for d in ('lib', 'extlib')])
 
 import urllib, base64
+from google.appengine.api import users
 from django.utils import simplejson
 from fxsync.models import Profile
+from fxsync.tracing import traced
+
+# Header carrying the admin token, for admin access without Google
+# accounts, as in the standalone server
+ADMIN_TOKEN_HEADER = 'X-Fxsync-Admin-Token'
 
 def json_request(func):
     """Decorator to auto-decode JSON request body"""
     def cb(wh, *args, **kwargs):
         try:
-            wh.request.body_json = simplejson.loads(wh.request.body)
+            wh.request.body_json = decode_json(wh.request.body)
         except ValueError:
             wh.response.set_status(400, message="Bad Request")
             wh.response.out.write("Invalid JSON request body")
@@ -23,42 +29,83 @@ def json_request(func):
             return func(wh, *args, **kwargs)
     return cb
 
+@traced('json_request')
+def decode_json(body):
+    return simplejson.loads(body)
+
 def json_response(func):
-    """Decorator to auto-encode return value as JSON response"""
+    """Decorator to auto-encode return value as JSON response. Returns
+    None, since webapp2 would take anything else as the response."""
     def cb(wh, *args, **kwargs):
         rv = func(wh, *args, **kwargs)
         if rv is not None:
-            wh.response.headers['Content-Type'] = 'application/json'
-            wh.response.out.write(simplejson.dumps(rv))
-            return rv
+            write_json(wh, rv)
     return cb
 
+@traced('json_response')
+def write_json(wh, value):
+    wh.response.headers['Content-Type'] = 'application/json'
+    wh.response.out.write(encode_json(value))
+
+@traced('serialize')
+def encode_json(value):
+    return simplejson.dumps(value)
+
 def profile_auth(func):
     """Decorator to wrap controller methods in profile auth requirement"""
     def cb(wh, *args, **kwargs):
-        url_user = urllib.unquote(args[0])
+        if authenticate(wh, urllib.unquote(args[0])):
+            return func(wh, *args, **kwargs)
+    return cb
 
-        auth_header = wh.request.headers.get('Authorization')
-        if auth_header == None:
-            wh.response.set_status(401, message="Authorization Required")
-            wh.response.headers['WWW-Authenticate'] = 'Basic realm="firefox-sync"'
-            return
-        
-        auth_parts = auth_header.split(' ')
-        user_arg, pass_arg = base64.b64decode(auth_parts[1]).split(':')
+@traced('profile_auth')
+def authenticate(wh, url_user):
+    """Check the request's credentials against the user in the URL,
+    setting request.profile if they match and a 401 response if not"""
+    auth_header = wh.request.headers.get('Authorization')
+    if auth_header == None:
+        wh.response.set_status(401, message="Authorization Required")
+        wh.response.headers['WWW-Authenticate'] = 'Basic realm="firefox-sync"'
+        return False
+    
+    auth_parts = auth_header.split(' ')
+    user_arg, pass_arg = base64.b64decode(auth_parts[1]).split(':')
 
-        valid_authen = (
-            (url_user == user_arg) 
-                and 
-            Profile.authenticate(user_arg, pass_arg)
-        )
+    valid_authen = (
+        (url_user == user_arg) 
+            and 
+        Profile.authenticate(user_arg, pass_arg)
+    )
 
-        if not valid_authen:
-            wh.response.set_status(401, message="Authorization Required")
-            wh.response.headers['WWW-Authenticate'] = 'Basic realm="firefox-sync"'
-            wh.response.out.write("Unauthorized")
-        else:
-            wh.request.profile = Profile.get_by_user_name(user_arg)
-            return func(wh, *args, **kwargs)
+    if not valid_authen:
+        wh.response.set_status(401, message="Authorization Required")
+        wh.response.headers['WWW-Authenticate'] = 'Basic realm="firefox-sync"'
+        wh.response.out.write("Unauthorized")
+        return False
+
+    wh.request.profile = Profile.get_by_user_name(user_arg)
+    return True
 
+def is_admin(request):
+    """Determine whether a request comes from an admin, either signed in
+    as an App Engine admin or bearing the FXSYNC_ADMIN_TOKEN"""
+    token = os.environ.get('FXSYNC_ADMIN_TOKEN')
+    given = request.headers.get(ADMIN_TOKEN_HEADER)
+    if token and given and len(token) == len(given):
+        # Compare in constant time, so as not to leak the token
+        diff = 0
+        for a, b in zip(token, given):
+            diff |= ord(a) ^ ord(b)
+        if not diff:
+            return True
+    return users.is_current_user_admin()
+
+def admin_auth(func):
+    """Decorator to restrict controller methods to admins"""
+    def cb(wh, *args, **kwargs):
+        if not is_admin(wh.request):
+            wh.response.set_status(403, message="Forbidden")
+            wh.response.out.write("Forbidden")
+            return
+        return func(wh, *args, **kwargs)
     return cb
@@ -0,0 +1,72 @@
+import sys, os, os.path
+base_dir = os.path.dirname( os.path.dirname(__file__) )
+sys.path.extend([ os.path.join(base_dir, d) for d in (
+    'lib', 'extlib', 'controllers'
+)])
+
+import unittest, logging
+from django.utils import simplejson
+
+from fxsync import models
+from fxsync import ndb_models
+
+class NdbModelsTests(unittest.TestCase):
+    """Unit tests for the async ndb model layer"""
+
+    USER_NAME = 'tester-ndb'
+    PASSWD    = 'QsEdRgTh12345'
+
+    def setUp(self):
+        """Prepare for unit test"""
+        self.profile = models.Profile(
+            user_name = self.USER_NAME,
+            user_id   = '8675309',
+            password  = self.PASSWD
+        )
+        self.profile.put()
+
+    def tearDown(self):
+        """Clean up after unit test"""
+        self.profile.delete()
+
+    def test_authenticate(self):
+        """Exercise async profile lookup and authentication"""
+        profile = ndb_models.Profile.authenticate_async(
+            self.USER_NAME, self.PASSWD).get_result()
+        self.assertEqual(self.USER_NAME, profile.user_name)
+        self.assertEqual(None, ndb_models.Profile.authenticate_async(
+            self.USER_NAME, 'wrong').get_result())
+
+    def test_from_json_put_and_retrieve(self):
+        """Exercise async WBO creation, storage and retrieval"""
+        collection = ndb_models.Collection.get_by_profile_and_name_async(
+            self.profile, 'testing').get_result()
+
+        wbos, failed = [], {}
+        for i in range(10):
+            (wbo, errors) = ndb_models.WBO.from_json_async({
+                'collection': collection, 'id': 'ndb-%s' % i, 'sortindex': i,
+                'payload': simplejson.dumps({ 'i': i })
+            }).get_result()
+            wbos.append(wbo)
+        (wbo, errors) = ndb_models.WBO.from_json_async({
+            'collection': collection, 'id': 'ndb-bad', 'parentid': 'nope',
+            'payload': '{}'
+        }).get_result()
+        self.assertEqual(['invalid parentid'], errors)
+
+        collection.put_wbos_async(wbos).get_result()
+
+        # Both model layers should see the same records, in the same order.
+        db_collection = models.Collection.lookup_by_profile_and_name(
+            self.profile, 'testing')
+        for params in ({}, { 'index_above': 2, 'index_below': 8 },
+                { 'limit': 3, 'offset': 2 }):
+            self.assertEqual(
+                list(db_collection.retrieve(**params)),
+                collection.retrieve_async(**params).get_result()
+            )
+        self.assertEqual(10,
+            collection.retrieve_async(count=True).get_result())
+        self.assertEqual(max(w.modified for w in wbos),
+            models.Collection.get_modified_by_key(db_collection.key()))
@@ -4,12 +4,15 @@ sys.path.extend([ os.path.join(base_dir, d) for d in (
     'lib', 'extlib', 'controllers'
 )])
 
-import unittest, logging, datetime, time, base64
+import unittest, logging, datetime, time, base64, tempfile, shutil
 import webtest, random, string
 from google.appengine.ext import webapp, db
+from google.appengine.api import memcache
 from django.utils import simplejson
 
 from fxsync.models import Profile, Collection, WBO
+from fxsync import context, storage, models, metrics, slowlog, profiler
+from fxsync import tracing, memtrack
 import sync_api
 
 class SyncApiTests(unittest.TestCase):
@@ -95,6 +98,153 @@ class SyncApiTests(unittest.TestCase):
         )
         self.assertEqual('200 OK', resp.status)
 
+    def test_rpc_stats_header(self):
+        """Storage calls should be tallied in a header, when asked for"""
+        storage.instrument()
+        try:
+            headers = dict(self.auth_header)
+            url = '/sync/1.0/%s/info/collections' % self.USER_NAME
+            resp = self.app.get(url, headers=headers)
+            self.assert_('X-Fxsync-Rpcs' not in resp.headers)
+            headers['X-Fxsync-Debug-Rpcs'] = '1'
+            resp = self.app.get(url, headers=headers)
+            self.assert_('query=' in resp.headers['X-Fxsync-Rpcs'])
+        finally:
+            storage.instrument(False)
+
+    def test_metrics(self):
+        """Requests should be counted in latency histograms by route"""
+        prev_mode, metrics.mode = metrics.mode, 'local'
+        try:
+            metrics.registry.take()
+            self.app.get('/sync/1.0/%s/storage/history' % self.USER_NAME,
+                headers=self.auth_header)
+            text = metrics.render(metrics.collect())
+            self.assert_('fxsync_request_duration_milliseconds_count{'
+                'api="sync",route="StorageCollectionHandler",method="GET",'
+                'status="200",collection="history"} 1' in text)
+        finally:
+            metrics.mode = prev_mode
+
+    def test_slow_requests(self):
+        """Slow collection requests should be sampled with their plans"""
+        prev_mode, metrics.mode = metrics.mode, 'local'
+        prev_threshold, slowlog.THRESHOLD_MS = slowlog.THRESHOLD_MS, 0
+        try:
+            slowlog.ring.clear()
+            self.app.get('/sync/1.0/%s/storage/%s?parentid=a&newer=1' % (
+                self.USER_NAME, self.collection.name),
+                headers=self.auth_header)
+            rec = slowlog.records()[0]
+            self.assertEqual('GET', rec['method'])
+            self.assertEqual('a', rec['params']['parentid'])
+            self.assert_(rec['steps'])
+            self.assert_('encode' in [ p['phase'] for p in rec['phases'] ])
+        finally:
+            metrics.mode = prev_mode
+            slowlog.THRESHOLD_MS = prev_threshold
+
+    def test_explain(self):
+        """Admins should be able to see how a retrieval is carried out"""
+        url = '/sync/1.0/%s/storage/%s?parentid=a&newer=1&explain=1' % (
+            self.USER_NAME, self.collection.name)
+        self.app.get(url, headers=self.auth_header, status=403)
+
+        os.environ['FXSYNC_ADMIN_TOKEN'] = 'sekrit'
+        try:
+            headers = dict(self.auth_header)
+            headers['X-Fxsync-Admin-Token'] = 'sekrit'
+            resp = self.app.get(url, headers=headers)
+        finally:
+            del os.environ['FXSYNC_ADMIN_TOKEN']
+        rv = simplejson.loads(resp.body)
+        if storage.get_backend().index_cache:
+            self.assertEqual('index', rv['strategy'])
+        else:
+            self.assertEqual('intersect', rv['strategy'])
+            sub_queries = [ s for s in rv['steps'] if s.get('keys_only') ]
+            self.assertEqual(2, len(sub_queries))
+            for s in sub_queries:
+                self.assert_('estimated' in s)
+                self.assert_('truncated' in s)
+        self.assert_('records' in rv['count'])
+
+    def test_profile(self):
+        """Admins should be able to profile a request"""
+        url = '/sync/1.0/%s/storage/%s' % (
+            self.USER_NAME, self.collection.name)
+        headers = dict(self.auth_header)
+        headers['X-Fxsync-Profile'] = '1'
+        resp = self.app.get(url, headers=headers)
+        self.assert_('X-Fxsync-Profile-Id' not in resp.headers)
+
+        prev_mode, metrics.mode = metrics.mode, 'local'
+        os.environ['FXSYNC_ADMIN_TOKEN'] = 'sekrit'
+        try:
+            headers['X-Fxsync-Admin-Token'] = 'sekrit'
+            resp = self.app.get(url, headers=headers)
+            data = profiler.load(resp.headers['X-Fxsync-Profile-Id'])
+        finally:
+            metrics.mode = prev_mode
+            del os.environ['FXSYNC_ADMIN_TOKEN']
+        self.assert_('sync_api.py' in profiler.collapse_stacks(data['stats']))
+
+    def test_trace(self):
+        """Traced requests should be written as trace event files"""
+        trace_dir = tempfile.mkdtemp()
+        prev = (tracing.RATE, tracing.PATH)
+        tracing.RATE, tracing.PATH = 1.0, trace_dir
+        try:
+            resp = self.app.get('/sync/1.0/%s/storage/%s?full=1' % (
+                self.USER_NAME, self.collection.name),
+                headers=self.auth_header)
+            request_id = resp.headers['X-Fxsync-Trace-Id']
+            events = simplejson.load(open(os.path.join(trace_dir,
+                '%s.json' % request_id)))['traceEvents']
+        finally:
+            tracing.RATE, tracing.PATH = prev
+            shutil.rmtree(trace_dir)
+        names = [ e['name'] for e in events ]
+        self.assert_('profile_auth' in names)
+        self.assert_('Collection.lookup_by_profile_and_name' in names)
+        self.assert_('GET sync.StorageCollectionHandler' in names)
+        # The auth span covers only the auth, not the handler it wraps
+        by_name = dict( (e['name'], e) for e in events )
+        auth = by_name['profile_auth']
+        lookup = by_name['Collection.lookup_by_profile_and_name']
+        self.assert_(auth['ts'] + auth['dur'] <= lookup['ts'] + 1)
+        for e in events:
+            self.assertEqual(request_id, e['args']['request_id'])
+
+    def test_memory_tracking(self):
+        """Memory use should be recorded for tracked routes only"""
+        prev_routes = memtrack.ROUTES
+        memtrack.ROUTES = set([ 'sync.StorageCollectionHandler' ])
+        memtrack.stats = memtrack.MemoryStats()
+        try:
+            self.app.get('/sync/1.0/%s/storage/history?full=1' % (
+                self.USER_NAME), headers=self.auth_header)
+            self.app.get('/sync/1.0/%s/info/collections' % (
+                self.USER_NAME), headers=self.auth_header)
+        finally:
+            memtrack.ROUTES = prev_routes
+        rv = memtrack.stats.as_dict()
+        self.assertEqual(1, len(rv['worst']))
+        self.assertEqual('history', rv['worst'][0]['collection'])
+        self.assertEqual([ 'sync.StorageCollectionHandler' ],
+            [ t['route'] for t in rv['routes'] ])
+
+    def test_json_response_returns_none(self):
+        """JSON handlers should return None, since webapp2 would take any
+        other return value as the response"""
+        handler = sync_api.CollectionsHandler()
+        handler.initialize(webapp.Request.blank(
+            '/sync/1.0/%s/info/collections' % self.USER_NAME,
+            headers=self.auth_header), webapp.Response())
+        self.assertEqual(None, handler.get(self.USER_NAME))
+        self.assertEqual('application/json',
+            handler.response.headers['Content-Type'])
+
     def test_item_validation(self):
         """Exercise WBO data validation"""
         (p, c, ah) = (self.profile, self.collection, self.auth_header)
@@ -685,6 +835,123 @@ class SyncApiTests(unittest.TestCase):
             self.log.debug("RESULT2  %s" % simplejson.dumps(lines))
             self.log.debug("LINES    %s" % len(lines))
 
+    def test_retrieval_cache_follows_writes(self):
+        """Ensure cached retrievals are not served after collection writes"""
+        (p, c, ah) = (self.profile, self.collection, self.auth_header)
+        self.build_wbo_set()
+        url = '/sync/1.0/%s/storage/%s' % (p.user_name, c.name)
+
+        resp = self.app.get(url, headers=ah)
+        result_data = simplejson.loads(resp.body)
+        self.assertEqual(result_data, simplejson.loads(
+            self.app.get(url, headers=ah).body
+        ))
+
+        resp = self.put_random_wbo(url, ah)
+        resp = self.app.get(url, headers=ah)
+        self.assertEqual(len(result_data) + 1, len(simplejson.loads(resp.body)))
+        self.assertEqual(len(result_data) + 1, int(resp.headers['X-Weave-Records']))
+
+        resp = self.app.delete(url, headers=ah)
+        resp = self.app.get(url, headers=ah)
+        self.assertEqual([], simplejson.loads(resp.body))
+
+    def test_conditional_get(self):
+        """Ensure ETag, If-None-Match and X-If-Modified-Since are honored"""
+        (p, c, ah) = (self.profile, self.collection, self.auth_header)
+        c_url = '/sync/1.0/%s/storage/%s' % (p.user_name, c.name)
+        i_url = '%s/abcd-1' % c_url
+        info_url = '/sync/1.0/%s/info/collections' % p.user_name
+
+        resp = self.app.put(i_url, headers=ah,
+            params=simplejson.dumps({ 'payload': simplejson.dumps({}) }))
+        modified = float(resp.body)
+
+        for url in (c_url, i_url, info_url):
+            resp = self.app.get(url, headers=ah)
+            etag = resp.headers['ETag']
+            if url == c_url:
+                # Collection listings also vary by query and Accept
+                self.assert_(etag.startswith('"%s;' % modified))
+            else:
+                self.assertEqual('"%s"' % modified, etag)
+
+            headers = { 'If-None-Match': etag }
+            headers.update(ah)
+            resp = self.app.get(url, headers=headers, status=304)
+            self.assertEqual('', resp.body)
+
+            headers = { 'X-If-Modified-Since': str(modified) }
+            headers.update(ah)
+            resp = self.app.get(url, headers=headers, status=304)
+
+            headers = { 'X-If-Modified-Since': str(modified - 1) }
+            headers.update(ah)
+            resp = self.app.get(url, headers=headers, status=200)
+
+        # Another listing of the same collection has an ETag of its own
+        resp = self.app.get(c_url, headers=ah)
+        headers = { 'If-None-Match': resp.headers['ETag'] }
+        headers.update(ah)
+        resp = self.app.get(c_url + '?full=1', headers=headers, status=200)
+        self.assertNotEqual(headers['If-None-Match'], resp.headers['ETag'])
+        headers['Accept'] = 'application/newlines'
+        self.app.get(c_url, headers=headers, status=200)
+
+        time.sleep(0.1) # HACK: Delay to ensure modified stamps vary
+        self.put_random_wbo(c_url, ah)
+
+        for url in (c_url, info_url):
+            headers = { 'If-None-Match': '"%s"' % modified }
+            headers.update(ah)
+            resp = self.app.get(url, headers=headers, status=200)
+            self.assertNotEqual('"%s"' % modified, resp.headers['ETag'])
+
+    def test_reads_do_not_create_collections(self):
+        """Ensure GET and DELETE leave nonexistent collections uncreated"""
+        (p, c, ah) = (self.profile, self.collection, self.auth_header)
+        c_url = '/sync/1.0/%s/storage/%s' % (p.user_name, 'nonexistent')
+        i_url = '%s/abcd-1' % c_url
+        count_before = Collection.all().count()
+
+        resp = self.app.get(c_url, headers=ah)
+        self.assertEqual([], simplejson.loads(resp.body))
+        self.assertEqual('0', resp.headers['X-Weave-Records'])
+        resp = self.app.get(i_url, headers=ah, status=404)
+        resp = self.app.delete(i_url, headers=ah, status=404)
+        resp = self.app.delete(c_url, headers=ah)
+        self.assertEqual(count_before, Collection.all().count())
+
+        resp = self.put_random_wbo(c_url, ah)
+        self.assertEqual(count_before + 1, Collection.all().count())
+        resp = self.app.get(c_url, headers=ah)
+        self.assertEqual(1, len(simplejson.loads(resp.body)))
+
+    def test_request_context_identity_map(self):
+        """Ensure repeated loads within a request share entities"""
+        (p, c, ah) = (self.profile, self.collection, self.auth_header)
+        ctx = context.begin()
+        try:
+            p1 = Profile.get_by_user_name(p.user_name)
+            self.assert_(p1 is Profile.get_by_user_name(p.user_name))
+            c1 = Collection.lookup_by_profile_and_name(p1, c.name)
+            self.assert_(c1 is Collection.get_by_profile_and_name(p1, c.name))
+            self.assert_(c1 is ctx.memo[('entity', str(c1.key()))])
+
+            exists_key = ('wbo_exists', str(c1.key()), 'a1')
+            self.assertEqual(False, WBO.exists_by_collection_and_wbo_id(c1, 'a1'))
+            self.assertEqual(False, ctx.memo[exists_key])
+
+            # Written through the models, not the app, whose middleware
+            # would end this context
+            self.build_wbo_parents_and_predecessors()
+            self.assert_(ctx is context.current())
+            self.assertEqual(True, ctx.memo[exists_key])
+            self.assertEqual(True, WBO.exists_by_collection_and_wbo_id(c1, 'a1'))
+        finally:
+            context.end()
+        self.assert_(p1 is not Profile.get_by_user_name(p.user_name))
+
     def test_cascading_profile_delete(self):
         """Ensure that profile deletion cascades down to collections and WBOs"""
         (p, c, ah) = (self.profile, self.collection, self.auth_header)
@@ -715,9 +982,63 @@ class SyncApiTests(unittest.TestCase):
 
         self.assertEqual(0, WBO.all().count())
 
+    def test_modified_never_goes_backwards(self):
+        """Ensure a write overtaken by a later one can't lower the
+        collection's modified time, stored or cached"""
+        c = self.collection
+        now = WBO.get_time_now()
+        c.put_wbos([ WBO(parent=c, collection=c, wbo_id='late',
+            modified=now, payload='{}') ])
+        c.put_wbos([ WBO(parent=c, collection=c, wbo_id='early',
+            modified=now - 10, payload='{}') ])
+        self.assertEqual(now, Collection.get(c.key()).modified)
+        self.assertEqual(now, Collection.get_modified_by_key(c.key()))
+        Collection.note_write(c.key(), now - 10)
+        self.assertEqual(now, Collection.get_modified_by_key(c.key()))
+
     def test_header_if_unmodified_since(self):
         """Ensure that X-If-Unmodified-Since header is honored in PUT / POST / DELETE"""
-        self.fail("TODO")
+        (p, c, ah) = (self.profile, self.collection, self.auth_header)
+        c_url = '/sync/1.0/%s/storage/%s' % (p.user_name, c.name)
+        i_url = '%s/abcd-1' % c_url
+        wbo_json = simplejson.dumps({ 'payload': simplejson.dumps({}) })
+
+        resp = self.app.put(i_url, headers=ah, params=wbo_json)
+        modified = float(resp.body)
+        time.sleep(0.1) # HACK: Delay to ensure modified stamps vary
+
+        stale = { 'X-If-Unmodified-Since': str(modified - 1) }
+        stale.update(ah)
+        current = { 'X-If-Unmodified-Since': str(modified) }
+        current.update(ah)
+
+        resp = self.app.put(i_url, headers=stale, params=wbo_json, status=412)
+        self.assertEqual('412 Precondition Failed', resp.status)
+        resp = self.app.post(c_url, headers=stale, status=412,
+            params=simplejson.dumps([ { 'id': 'abcd-2', 'payload': '{}' } ]))
+        resp = self.app.delete(i_url, headers=stale, status=412)
+        resp = self.app.delete(c_url, headers=stale, status=412)
+
+        # Nothing should have been touched by the refused writes.
+        self.assertEqual(['abcd-1'], [ w.wbo_id for w in WBO.all() ])
+        resp = self.app.get(i_url, headers=ah)
+        self.assertEqual(modified, simplejson.loads(resp.body)['modified'])
+
+        resp = self.app.put(i_url, headers=current, params=wbo_json)
+        self.assert_(float(resp.body) > modified)
+        modified = float(resp.body)
+        current = { 'X-If-Unmodified-Since': str(modified) }
+        current.update(ah)
+
+        resp = self.app.post(c_url, headers=current,
+            params=simplejson.dumps([ { 'id': 'abcd-2', 'payload': '{}' } ]))
+        self.assertEqual(['abcd-2'], simplejson.loads(resp.body)['success'])
+        modified = simplejson.loads(resp.body)['modified']
+        current = { 'X-If-Unmodified-Since': str(modified) }
+        current.update(ah)
+
+        resp = self.app.delete(c_url, headers=current)
+        self.assertEqual(0, WBO.all().count())
 
     def build_wbo_parents_and_predecessors(self):
         (p, c, ah) = (self.profile, self.collection, self.auth_header)
@@ -783,3 +1104,124 @@ class SyncApiTests(unittest.TestCase):
                 '%s:%s' % (user_name, passwd)
             )
         }
+
+class MemoryBackendSyncApiTests(SyncApiTests):
+    """The Sync API controller unit tests, run against in-memory storage"""
+
+    def setUp(self):
+        self.prev_backend = storage.get_backend()
+        self.backend = storage.set_backend(self.create_backend())
+        # Keys from the other backend may recur, so drop anything cached
+        memcache.flush_all()
+        models.known_collections.clear()
+        SyncApiTests.setUp(self)
+
+    def tearDown(self):
+        SyncApiTests.tearDown(self)
+        storage.set_backend(self.prev_backend)
+        memcache.flush_all()
+        models.known_collections.clear()
+
+    def create_backend(self):
+        return storage.create_backend('memory')
+
+class LogBackendSyncApiTests(MemoryBackendSyncApiTests):
+    """The Sync API controller unit tests, run against log storage"""
+
+    def create_backend(self):
+        self.db_dir = tempfile.mkdtemp()
+        return self.open_backend()
+
+    def open_backend(self):
+        return storage.create_backend('log', self.db_dir)
+
+    def tearDown(self):
+        MemoryBackendSyncApiTests.tearDown(self)
+        self.backend.close()
+        shutil.rmtree(self.db_dir)
+
+    def test_reopen(self):
+        """Data written should survive closing and reopening storage"""
+        wbos = self.build_wbo_set()
+        self.backend.close()
+        self.backend = storage.set_backend(self.open_backend())
+        c = Collection.lookup_by_profile_and_name(self.profile, 'testing')
+        self.assertEqual(
+            [ w.wbo_id for w in wbos ],
+            [ w.wbo_id for w in WBO.all().ancestor(c).order('sortindex') ]
+        )
+        self.assertEqual(wbos[3].payload,
+            WBO.get_by_collection_and_wbo_id(c, wbos[3].wbo_id).payload)
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+if sqlite3:
+    class SqliteBackendSyncApiTests(LogBackendSyncApiTests):
+        """The Sync API controller unit tests, run against SQLite storage"""
+
+        def open_backend(self):
+            return storage.create_backend('sqlite',
+                os.path.join(self.db_dir, 'test.sqlite'))
+
+    class GroupCommitSyncApiTests(SqliteBackendSyncApiTests):
+        """The Sync API controller unit tests, run against SQLite storage
+        committing from a writer thread"""
+
+        def open_backend(self):
+            return storage.create_backend('sqlite',
+                os.path.join(self.db_dir, 'test.sqlite'), group_commit=True)
+
+    class ShardedBackendSyncApiTests(LogBackendSyncApiTests):
+        """The Sync API controller unit tests, run against a database per
+        user, with only one kept open at a time"""
+
+        def open_backend(self):
+            return storage.create_backend('sharded', self.db_dir, 1)
+
+        def tearDown(self):
+            # Deleting a profile should empty its shard, not just remove
+            # it from the directory.
+            self.profile.delete()
+            self.assertEqual(0,
+                Collection.all().ancestor(self.profile).count())
+            self.assertEqual(0, WBO.all().ancestor(self.collection).count())
+            LogBackendSyncApiTests.tearDown(self)
+
+        def test_queries_across_users(self):
+            """Queries without an ancestor should cover every user"""
+            self.build_wbo_set()
+            other = Profile(user_name='other', user_id='5551212',
+                password='other')
+            other.put()
+            c = Collection.get_by_profile_and_name(other, 'testing')
+            WBO(parent=c, collection=c, wbo_id='o1', payload='{}',
+                modified=WBO.get_time_now()).put()
+            try:
+                self.assertEqual(2, len(self.backend.shard_names()))
+                self.assertEqual(
+                    WBO.all().ancestor(self.collection).count() + 1,
+                    WBO.all().count())
+                self.assertEqual(2, Collection.all().count())
+                self.assertEqual(['o1'], [ w.wbo_id for w in
+                    WBO.all().filter('wbo_id =', 'o1') ])
+            finally:
+                other.delete()
+
+        def test_stats(self):
+            """Stats should count the WBOs of every user"""
+            self.build_wbo_set()
+            stats = self.backend.stats()
+            self.assertEqual(1, stats['totals']['shards'])
+            self.assertEqual(WBO.all().ancestor(self.collection).count(),
+                stats['totals']['wbos'])
+
+    class ShardedGroupCommitSyncApiTests(ShardedBackendSyncApiTests):
+        """The Sync API controller unit tests, run against a database per
+        user, with transactions committed from each shard's writer thread"""
+
+        def open_backend(self):
+            return storage.create_backend('sharded', self.db_dir, 1,
+                group_commit=True)